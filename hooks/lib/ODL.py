@@ -1,6 +1,9 @@
 '''ODL Controller API integration'''
 import requests
 from jinja2 import Environment, FileSystemLoader
+
+import lib.PCIDev as PCIDev
+
 from charmhelpers.core.hookenv import log
 from charmhelpers.core.decorators import retry_on_exception
 
@@ -100,6 +103,34 @@ class ODLConfig(requests.Session):
         self.contact_odl(
             'POST', self.netmap_url, headers=headers, data=payload)
 
+    def odl_register_macs_bulk(self, device_name, network, interfaces,
+                               device_type='vhostuser'):
+        '''Register a list of (interface, mac) pairs on one network'''
+        log('Registering {} interfaces on {}'.format(len(interfaces),
+                                                     network))
+        payload = self.render_mac_xml(device_name, network, None, None,
+                                      device_type, interfaces=interfaces)
+        headers = {'Content-Type': 'application/json'}
+        self.contact_odl(
+            'POST', self.netmap_url, headers=headers, data=payload)
+
+    def get_registered_interfaces(self, device_name, device_type='vhostuser'):
+        '''Return a set of (network, interface, mac) registered for the
+        device, fetching the network map once; macs are normalized'''
+        registered = set()
+        phy_nets = self.get_networks().get('physicalNetwork')
+        if phy_nets:
+            for net in phy_nets:
+                for dev in net.get('device', []):
+                    if (device_name == dev['device-name'] and
+                            dev['device-type'] == device_type):
+                        for interface in dev['interface']:
+                            registered.add((net['name'],
+                                            interface['interface-name'],
+                                            PCIDev.normalize_mac(
+                                                interface['macAddress'])))
+        return registered
+
     def get_macs_networks(self, mac):
         registered_networks = self.get_networks()
         nets = []
@@ -108,7 +139,9 @@ class ODLConfig(requests.Session):
             for network in phy_nets:
                 for device in network.get('device', []):
                     for interface in device['interface']:
-                        if interface['macAddress'] == mac:
+                        if PCIDev.normalize_mac(
+                                interface['macAddress']) == \
+                                PCIDev.normalize_mac(mac):
                             nets.append(network['name'])
         return nets
 
@@ -144,14 +177,15 @@ class ODLConfig(requests.Session):
         return node_xml
 
     def render_mac_xml(self, device_name, network, interface, mac,
-                       device_type='vhostuser'):
+                       device_type='vhostuser', interfaces=None):
         env = Environment(loader=FileSystemLoader('templates'))
         template = env.get_template('mac_registration')
+        if interfaces is None:
+            interfaces = [(interface, mac)]
         mac_xml = template.render(
             vpp_host=device_name,
             network=network,
-            interface=interface,
-            mac=mac,
+            interfaces=[{'interface': i, 'mac': m} for i, m in interfaces],
             device_type=device_type,
         )
         return mac_xml
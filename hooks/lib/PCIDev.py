@@ -2,13 +2,109 @@
 import re
 import os
 import glob
+import hashlib
 import subprocess
-from charmhelpers.core.decorators import retry_on_exception
 import shlex
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import netaddr
+import netifaces
+import yaml
 from charmhelpers.core.hookenv import(
+    cached,
     log,
     config,
+    INFO,
+    ERROR,
 )
+from charmhelpers.core.unitdata import kv
+
+VPE_CLI = '/opt/cisco/vpe/bin/confd_cli'
+# Upper bound on the time spent waiting for the VPE CLI to answer
+VPE_CLI_TIMEOUT = 120
+
+# Roots of the trees probed, overridable to run against a fake host
+SYSFS_ROOT = os.environ.get('PCIDEV_SYSFS_ROOT', '/sys')
+MODULES_ROOT = os.environ.get('PCIDEV_MODULES_ROOT', '/lib/modules')
+PCI_DEVICES_DIR = 'bus/pci/devices'
+PCI_DRIVERS_DIR = 'bus/pci/drivers'
+SYSNET_DIR = 'class/net'
+# Threads used to probe devices; 1 probes serially
+PROBE_WORKERS = 1
+
+# unitdata key holding the last resolved inventory
+INVENTORY_KEY = 'pcidev.inventory'
+# unitdata key holding the queue tuning applied to each mac
+QUEUE_TUNING_KEY = 'pcidev.queue-tuning'
+# VF drivers used to pass VFs through to guests or userspace
+VF_PASSTHROUGH_DRIVERS = ('vfio-pci', 'pci-stub', 'igb_uio')
+# unitdata key holding the pci address of each mac-network-map NIC
+MAPPED_DEVICES_KEY = 'pcidev.mapped-devices'
+
+# ethtool features set by each offload-profile
+OFFLOAD_PROFILES = {
+    'tunnel': {
+        'rx-checksumming': True,
+        'tx-checksumming': True,
+        'scatter-gather': True,
+        'tcp-segmentation-offload': True,
+        'generic-segmentation-offload': True,
+        'generic-receive-offload': True,
+        'tx-udp_tnl-segmentation': True,
+        'tx-udp_tnl-csum-segmentation': True,
+        # Aggregated frames cannot be forwarded, so keep LRO off
+        'large-receive-offload': False,
+    },
+    'off': {
+        'tcp-segmentation-offload': False,
+        'generic-segmentation-offload': False,
+        'generic-receive-offload': False,
+        'large-receive-offload': False,
+        'tx-udp_tnl-segmentation': False,
+        'tx-udp_tnl-csum-segmentation': False,
+    },
+}
+
+NULL_MAC = '00:00:00:00:00:00'
+VF_LINK_RE = re.compile(
+    r'vf (\d+)\s+(?:MAC|link/ether) ([0-9a-f:]{17})(?:[^\n]*?, vlan (\d+))?',
+    re.I)
+
+
+MAC_RE = re.compile(r'^([0-9a-f]{2}[:-]){5}[0-9a-f]{2}$', re.I)
+MAC_NETWORK_MAP_KEYS = ('mac', 'net', 'vlan', 'physnet')
+
+_mac_network_map_cache = {}
+
+
+class MacNetworkMapError(ValueError):
+    ''' Raised for invalid mac-network-map entries '''
+    pass
+
+
+class SriovConfigError(ValueError):
+    ''' Raised for invalid sriov-numvfs entries '''
+    pass
+
+
+def parse_sriov_numvfs(numvfs_config):
+    '''Parse sriov-numvfs into a dict of interface to VF count
+
+    Returns None for "auto", which enables every VF a PF supports.'''
+    if numvfs_config.strip() == 'auto':
+        return None
+    requested = {}
+    for entry in numvfs_config.split():
+        interface, _, numvfs = entry.rpartition(':')
+        if not interface or not numvfs.isdigit():
+            raise SriovConfigError('invalid entry {}'.format(entry))
+        requested[interface] = int(numvfs)
+    return requested
+
+
+def sysfs_path(*parts):
+    return os.path.join(SYSFS_ROOT, *parts)
 
 
 def format_pci_addr(pci_addr):
@@ -18,16 +114,718 @@ def format_pci_addr(pci_addr):
                                 func)
 
 
+def read_sysfs(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def read_sysfs_int(path):
+    try:
+        return int(read_sysfs(path))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_cpulist(cpulist):
+    '''Expand a kernel cpulist such as 0-3,8-11 into a list of cpus'''
+    cpus = []
+    for cpu_range in (cpulist or '').split(','):
+        cpu_range = cpu_range.strip()
+        if not cpu_range:
+            continue
+        if '-' in cpu_range:
+            first, last = cpu_range.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(cpu_range))
+    return cpus
+
+
+def cpus_to_mask(cpus):
+    '''Format a list of cpus as a hex cpu mask'''
+    mask = 0
+    for cpu in cpus:
+        mask |= 1 << cpu
+    return '{:x}'.format(mask)
+
+
+def cpus_to_sysfs_mask(cpus):
+    '''Format a list of cpus as a cpumask in comma separated 32 bit words,
+    as read and written by sysfs'''
+    mask = int(cpus_to_mask(cpus), 16)
+    words = ['{:08x}'.format(mask & 0xffffffff)]
+    mask >>= 32
+    while mask:
+        words.append('{:08x}'.format(mask & 0xffffffff))
+        mask >>= 32
+    return ','.join(reversed(words))
+
+
+def write_cpumask(path, cpus):
+    '''Write cpus to a sysfs cpumask file unless it already holds them'''
+    current = read_sysfs(path)
+    if current is None:
+        return False
+    mask = cpus_to_sysfs_mask(cpus)
+    if int(current.replace(',', ''), 16) == int(mask.replace(',', ''), 16):
+        return False
+    with open(path, 'w') as f:
+        f.write(mask)
+    return True
+
+
+def parse_ethtool_channels(output):
+    '''Maximum and current combined channels from ethtool -l output'''
+    combined = []
+    for line in output.split('\n'):
+        if line.startswith('Combined:'):
+            value = line.split(':', 1)[1].strip()
+            combined.append(int(value) if value.isdigit() else 0)
+    while len(combined) < 2:
+        combined.append(0)
+    return combined[0], combined[1]
+
+
+def parse_ethtool_rss(output):
+    '''RSS indirection table from ethtool -x output'''
+    table = []
+    for line in output.split('\n'):
+        index, sep, rings = line.partition(':')
+        if sep and index.strip().isdigit():
+            table.extend(int(ring) for ring in rings.split())
+    return table
+
+
+def parse_ethtool_features(output):
+    '''Map of feature to (enabled, fixed) from ethtool -k output'''
+    features = {}
+    for line in output.split('\n')[1:]:
+        name, sep, value = line.strip().partition(': ')
+        if not sep:
+            continue
+        value = value.split()
+        features[name] = (value[0] == 'on', '[fixed]' in value)
+    return features
+
+
+@cached
+def get_kernel_name():
+    return subprocess.check_output(['uname', '-r']).strip()
+
+
+@cached
+def get_pci_aliases(alias_file):
+    '''Map of upper cased pci:v<vendor>d<device> prefix to kernel module
+
+    Parsed once per modules.alias file instead of once per device.'''
+    aliases = {}
+    prefix_len = len('pci:v00000000d00000000')
+    with open(alias_file, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and fields[1].startswith('pci:v'):
+                aliases[fields[1][:prefix_len].upper()] = fields[2]
+    return aliases
+
+
+def get_modules_alias_file():
+    return os.path.join(MODULES_ROOT, get_kernel_name(), 'modules.alias')
+
+
+def probe_map(func, items, workers=1):
+    '''Apply func to each item, in up to workers threads
+
+    Returns a list of (result, error) pairs in the order of items. An
+    exception from one item is logged and returned as its error rather
+    than aborting the others.'''
+    def _probe(item):
+        try:
+            return func(item), None
+        except Exception as e:
+            log('Probing {} failed: {}'.format(item, e), level=ERROR)
+            return None, e
+    if workers > 1 and len(items) > 1:
+        pool = ThreadPool(min(workers, len(items)))
+        try:
+            return pool.map(_probe, items)
+        finally:
+            pool.close()
+            pool.join()
+    return [_probe(item) for item in items]
+
+
+def normalize_mac(mac):
+    return mac.lower().replace('-', ':')
+
+
+def _load_mac_network_map_file(path):
+    '''Read mapping entries from a YAML or JSON file
+
+    The file holds either a list of entries or a dict of mac to an entry
+    or list of entries, where each entry is a dict of net, vlan and
+    physnet.'''
+    try:
+        with open(path, 'r') as f:
+            data = yaml.safe_load(f)
+    except (IOError, yaml.YAMLError) as e:
+        raise MacNetworkMapError('Unable to read {}: {}'.format(path, e))
+    if isinstance(data, dict):
+        entries = []
+        for mac, confs in data.items():
+            for conf in confs if isinstance(confs, list) else [confs]:
+                entry = dict(conf or {})
+                entry['mac'] = mac
+                entries.append(entry)
+        return entries
+    if isinstance(data, list):
+        return data
+    raise MacNetworkMapError('{} does not hold a list or dict of '
+                             'entries'.format(path))
+
+
+def _parse_mac_network_map_str(mac_map):
+    entries = []
+    for line in mac_map.split():
+        entry = {}
+        for field in line.split(';'):
+            if not field:
+                continue
+            if '=' not in field:
+                raise MacNetworkMapError(
+                    'Malformed field "{}" in "{}"'.format(field, line))
+            key, value = field.split('=', 1)
+            entry[key] = value
+        entries.append(entry)
+    return entries
+
+
+def parse_mac_network_map(mac_map):
+    '''Parse and validate a mac-network-map config value
+
+    mac_map is either a space separated list of mac=<mac>;net=<net>
+    [;vlan=<vlan>][;physnet=<physnet>] entries, or the path of a YAML or
+    JSON file holding the entries. Returns a dict of normalized mac to a
+    list of {'net', 'vlan', 'physnet'} dicts. Results are memoized on the
+    config value, and on the mtime for files.'''
+    if not mac_map:
+        return {}
+    mac_map = mac_map.strip()
+    is_file = mac_map.startswith('/') or mac_map.startswith('file://')
+    if is_file:
+        path = mac_map[len('file://'):] if mac_map.startswith('file://') \
+            else mac_map
+        try:
+            cache_key = (mac_map, os.stat(path).st_mtime)
+        except OSError:
+            raise MacNetworkMapError('{} does not exist'.format(path))
+    else:
+        cache_key = mac_map
+    if cache_key in _mac_network_map_cache:
+        return _mac_network_map_cache[cache_key]
+
+    if is_file:
+        entries = _load_mac_network_map_file(path)
+    else:
+        entries = _parse_mac_network_map_str(mac_map)
+    mac_net_config = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            raise MacNetworkMapError('Invalid entry {}'.format(entry))
+        unknown = set(entry) - set(MAC_NETWORK_MAP_KEYS)
+        if unknown:
+            raise MacNetworkMapError('Unknown keys {} in {}'.format(
+                ', '.join(sorted(unknown)), entry))
+        mac = str(entry.get('mac') or '')
+        if not MAC_RE.match(mac):
+            raise MacNetworkMapError('Invalid mac in {}'.format(entry))
+        if not entry.get('net'):
+            raise MacNetworkMapError('No net in {}'.format(entry))
+        vlan = entry.get('vlan')
+        if vlan is not None:
+            # Files can give a vlan of any YAML type, not just a string
+            try:
+                valid = not isinstance(vlan, (bool, float)) and \
+                    1 <= int(vlan) <= 4094
+            except (TypeError, ValueError):
+                valid = False
+            if not valid:
+                raise MacNetworkMapError('Invalid vlan in {}'.format(entry))
+            vlan = int(vlan)
+        conf = {
+            'net': str(entry['net']),
+            'vlan': vlan,
+            'physnet': entry.get('physnet'),
+        }
+        confs = mac_net_config.setdefault(normalize_mac(mac), [])
+        if conf in confs:
+            log('Ignoring duplicate mac-network-map entry {}'.format(entry))
+            continue
+        for existing in confs:
+            if existing['net'] == conf['net']:
+                raise MacNetworkMapError(
+                    'Conflicting entries for {} on {}'.format(mac,
+                                                              conf['net']))
+            if vlan is not None and existing['vlan'] == vlan:
+                raise MacNetworkMapError(
+                    'vlan {} on {} mapped to both {} and {}'.format(
+                        vlan, mac, existing['net'], conf['net']))
+        confs.append(conf)
+    _mac_network_map_cache[cache_key] = mac_net_config
+    return mac_net_config
+
+
+def get_sysnet_pci_addresses_by_mac():
+    '''Map of mac to pci address for every kernel bound PCI netdev
+
+    Only reads each netdev's address and device link, so it is much
+    cheaper than probing the devices.'''
+    index = {}
+    for sdir in glob.glob(sysfs_path(SYSNET_DIR, '*')):
+        sym_link = sdir + '/device'
+        if not os.path.islink(sym_link):
+            continue
+        path = os.path.realpath(sym_link).split('/')
+        pci_address = path[-2] if 'virtio' in path[-1] else path[-1]
+        mac = read_sysfs(sdir + '/address')
+        if mac:
+            index[normalize_mac(mac)] = pci_address
+    return index
+
+
+def get_addresses_in_network(network):
+    '''Map of interface to local address for every interface on network'''
+    addresses = {}
+    if not network:
+        return addresses
+    network = netaddr.IPNetwork(network)
+    family = netifaces.AF_INET if network.version == 4 \
+        else netifaces.AF_INET6
+    for iface in netifaces.interfaces():
+        for addr in netifaces.ifaddresses(iface).get(family, []):
+            if addr['addr'].startswith('fe80'):
+                continue
+            ip = addr['addr'].split('%')[0]
+            if netaddr.IPAddress(ip) in network:
+                addresses[iface] = ip
+                break
+    return addresses
+
+
+def get_inventory_key():
+    '''Cheap fingerprint of the host's PCI and netdev layout
+
+    Covers the kernel version, the mtimes of the sysfs directories, the
+    PCI device listing with each device's bound driver, and the netdev
+    listing. Any hotplug, driver (un)bind or kernel upgrade changes it,
+    as does a change to the set of attributes recorded per device.'''
+    digest = hashlib.sha1()
+    digest.update(','.join(PCINetDevice.SERIALIZED).encode('utf-8'))
+    digest.update(os.uname()[2].encode('utf-8'))
+    for sdir in (PCI_DEVICES_DIR, PCI_DRIVERS_DIR, SYSNET_DIR):
+        try:
+            digest.update(
+                repr(os.stat(sysfs_path(sdir)).st_mtime).encode('utf-8'))
+        except OSError:
+            pass
+    for pci_addr in sorted(os.listdir(sysfs_path(PCI_DEVICES_DIR))):
+        driver_link = sysfs_path(PCI_DEVICES_DIR, pci_addr, 'driver')
+        try:
+            driver = os.readlink(driver_link)
+        except OSError:
+            driver = ''
+        digest.update('{}={}\n'.format(pci_addr, driver).encode('utf-8'))
+    for netdev in sorted(os.listdir(sysfs_path(SYSNET_DIR))):
+        digest.update('{}\n'.format(netdev).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def retry_until_deadline(timeout, base_delay=0, exc_type=Exception):
+    """If the decorated function raises exception exc_type, retry it with a
+    linearly increasing delay until timeout seconds have elapsed, then
+    re-raise the last exception. No sleep extends past the deadline.
+    """
+    def _retry_until_deadline_inner_1(f):
+        def _retry_until_deadline_inner_2(*args, **kwargs):
+            deadline = time.time() + timeout
+            multiplier = 1
+            while True:
+                try:
+                    return f(*args, **kwargs)
+                except exc_type:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise
+                delay = min(base_delay * multiplier, remaining)
+                multiplier += 1
+                log("Retrying '%s' for up to %ds (delay=%s)" %
+                    (f.__name__, remaining, delay), level=INFO)
+                if delay:
+                    time.sleep(delay)
+
+        return _retry_until_deadline_inner_2
+
+    return _retry_until_deadline_inner_1
+
+
+@retry_until_deadline(VPE_CLI_TIMEOUT, base_delay=10,
+                      exc_type=subprocess.CalledProcessError)
+def get_vpe_cli_out():
+    echo_cmd = [
+        'echo', '-e', 'show interfaces-state interface phys-address\nexit']
+    cli_cmd = [VPE_CLI, '-N', '-C', '-u', 'system']
+    echo = subprocess.Popen(echo_cmd, stdout=subprocess.PIPE)
+    cli_output = subprocess.check_output(cli_cmd, stdin=echo.stdout)
+    echo.wait()
+    log('confd_cli: ' + cli_output)
+    if 'local0' not in cli_output:
+        log('local0 missing from confd_cli output, assuming things went '
+            'wrong')
+        raise subprocess.CalledProcessError(1, cli_cmd, cli_output)
+    return cli_output
+
+
+def extract_pci_addr_from_vpe_interface(nic):
+    ''' Convert a str from nic postfix format to padded format
+
+    eg 6/1/2 -> 0000:06:01.2'''
+    log('Extracting pci address from {}'.format(nic))
+    addr = re.sub(r'^.*Ethernet', '', nic, re.IGNORECASE)
+    bus, slot, func = addr.split('/')
+    domain = '0000'
+    pci_addr = format_pci_addr(
+        '{}:{}:{}.{}'.format(domain, bus, slot, func))
+    log('pci address for {} is {}'.format(nic, pci_addr))
+    return pci_addr
+
+
+def get_vpe_interfaces_and_macs():
+    cli_output = get_vpe_cli_out()
+    vpe_devs = []
+    for line in cli_output.split('\n'):
+        if re.search(r'([0-9A-F]{2}[:-]){5}([0-9A-F]{2})', line, re.I):
+            interface, mac = line.split()
+            pci_addr = extract_pci_addr_from_vpe_interface(interface)
+            vpe_devs.append({
+                'interface': interface,
+                'macAddress': mac,
+                'pci_address': pci_addr,
+            })
+    return vpe_devs
+
+
+class VPEInterfaceTable(object):
+    '''Interfaces and macs reported by the VPE CLI
+
+    The CLI is queried at most once until the table is invalidated, so all
+    igb_uio bound devices in an inventory pass share a single session. A
+    failed query is remembered too, rather than retried by each device.'''
+
+    def __init__(self):
+        self._interfaces = None
+        self._error = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._error is not None:
+                raise self._error
+            if self._interfaces is None:
+                try:
+                    self._interfaces = get_vpe_interfaces_and_macs()
+                except Exception as e:
+                    self._error = e
+                    raise
+            return self._interfaces
+
+    def invalidate(self):
+        self._interfaces = None
+        self._error = None
+
+
 class PCINetDevice(object):
 
-    def __init__(self, pci_address):
+    # Hosts with SR-IOV enabled can carry thousands of these, so avoid a
+    # per-instance __dict__
+    __slots__ = ['pci_address', 'vpe_table', 'loaded_kmod', 'modalias_kmod',
+                 'interface_name', 'mac_address', 'state', 'sriov_totalvfs',
+                 'sriov_numvfs', 'physfn', 'virtfns', 'vf_index',
+                 'vf_admin_mac', 'vf_vlan', 'numa_node', 'local_cpulist',
+                 'speed', 'duplex', 'pcie_link_width', 'pcie_link_speed',
+                 'rx_queues', 'tx_queues', 'offloads']
+
+    # Attributes persisted in the unitdata inventory
+    SERIALIZED = ['pci_address', 'loaded_kmod', 'modalias_kmod',
+                  'interface_name', 'mac_address', 'state', 'sriov_totalvfs',
+                  'sriov_numvfs', 'physfn', 'virtfns', 'vf_index',
+                  'vf_admin_mac', 'vf_vlan', 'numa_node', 'local_cpulist',
+                  'speed', 'duplex', 'pcie_link_width', 'pcie_link_speed',
+                  'rx_queues', 'tx_queues', 'offloads']
+
+    def __init__(self, pci_address, vpe_table=None, attributes=None):
         self.pci_address = pci_address
-        self.update_attributes()
+        self.vpe_table = vpe_table or VPEInterfaceTable()
+        if attributes:
+            for attr in self.SERIALIZED[1:]:
+                setattr(self, attr, attributes.get(attr))
+        else:
+            self.update_attributes()
+
+    def to_dict(self):
+        return {attr: getattr(self, attr) for attr in self.SERIALIZED}
 
     def update_attributes(self):
         self.update_loaded_kmod()
         self.update_modalias_kmod()
         self.update_interface_info()
+        self.update_sriov_info()
+        self.update_placement_info()
+        # Costs a fork per device, so only probed on demand
+        self.offloads = None
+
+    def update_offload_info(self):
+        '''Record the offload features of the netdev, see
+        parse_ethtool_features()'''
+        if not self.interface_name or \
+                self.state in ('vpebound', 'unbound'):
+            self.offloads = None
+            return
+        try:
+            features = subprocess.check_output(
+                ['ethtool', '-k', self.interface_name])
+        except (OSError, subprocess.CalledProcessError) as e:
+            log('Unable to read offloads of {}: {}'.format(
+                self.interface_name, e))
+            self.offloads = None
+            return
+        self.offloads = parse_ethtool_features(features)
+
+    def set_offloads(self, profile):
+        '''Enable or disable the features of an OFFLOAD_PROFILES profile
+
+        Features the NIC lacks or has fixed are left alone. Returns the
+        features which did not end up as the profile asks, including those
+        ethtool failed to change.'''
+        if self.offloads is None:
+            self.update_offload_info()
+        if self.offloads is None:
+            return []
+        args = []
+        for feature, enable in sorted(OFFLOAD_PROFILES[profile].items()):
+            current = self.offloads.get(feature)
+            if current and current[0] != enable and not current[1]:
+                args.extend([feature, 'on' if enable else 'off'])
+        if args:
+            log('Setting offloads on {}: {}'.format(self.interface_name,
+                                                    ' '.join(args)))
+            try:
+                subprocess.check_call(['ethtool', '-K', self.interface_name] +
+                                      args)
+            except (OSError, subprocess.CalledProcessError) as e:
+                # Drivers may reject some features and apply the rest
+                log('Unable to set offloads on {}: {}'.format(
+                    self.interface_name, e), level=ERROR)
+            self.update_offload_info()
+        requested = args[::2]
+        offloads = self.offloads or {}
+        return sorted(feature for feature, enable
+                      in OFFLOAD_PROFILES[profile].items()
+                      if feature in offloads and
+                      offloads[feature][0] != enable or
+                      feature in requested and feature not in offloads)
+
+    def update_placement_info(self):
+        '''Record NUMA locality, PCIe link and netdev link/queue details'''
+        devdir = sysfs_path(PCI_DEVICES_DIR, self.pci_address)
+        numa_node = read_sysfs_int(os.path.join(devdir, 'numa_node'))
+        # -1 means the platform does not report locality
+        self.numa_node = numa_node \
+            if numa_node is not None and numa_node >= 0 else None
+        self.local_cpulist = read_sysfs(os.path.join(devdir,
+                                                     'local_cpulist'))
+        self.pcie_link_width = read_sysfs_int(
+            os.path.join(devdir, 'current_link_width'))
+        link_speed = read_sysfs(os.path.join(devdir, 'current_link_speed'))
+        try:
+            self.pcie_link_speed = float(link_speed.split()[0])
+        except (AttributeError, IndexError, ValueError):
+            self.pcie_link_speed = None
+        self.update_link_info()
+
+    def update_link_info(self):
+        self.speed = None
+        self.duplex = None
+        self.rx_queues = None
+        self.tx_queues = None
+        if not self.interface_name or self.state == 'vpebound':
+            return
+        sysdir = sysfs_path(SYSNET_DIR, self.interface_name)
+        speed = read_sysfs_int(os.path.join(sysdir, 'speed'))
+        # Links that are down report -1 or fail the read
+        self.speed = speed if speed is not None and speed > 0 else None
+        self.duplex = read_sysfs(os.path.join(sysdir, 'duplex'))
+        queues = os.listdir(os.path.join(sysdir, 'queues')) \
+            if os.path.isdir(os.path.join(sysdir, 'queues')) else []
+        self.rx_queues = len([q for q in queues if q.startswith('rx-')])
+        self.tx_queues = len([q for q in queues if q.startswith('tx-')])
+
+    def local_cpus(self):
+        return parse_cpulist(self.local_cpulist)
+
+    def pcie_bandwidth(self):
+        '''Negotiated PCIe bandwidth in GT/s across all lanes'''
+        if self.pcie_link_width and self.pcie_link_speed:
+            return self.pcie_link_width * self.pcie_link_speed
+        return 0
+
+    def update_sriov_info(self):
+        '''Record the SR-IOV PF/VF relationships from sysfs'''
+        devdir = sysfs_path(PCI_DEVICES_DIR, self.pci_address)
+        self.sriov_totalvfs = read_sysfs_int(
+            os.path.join(devdir, 'sriov_totalvfs'))
+        self.sriov_numvfs = read_sysfs_int(
+            os.path.join(devdir, 'sriov_numvfs'))
+        virtfns = {}
+        for link in glob.glob(os.path.join(devdir, 'virtfn*')):
+            index = int(os.path.basename(link)[len('virtfn'):])
+            virtfns[index] = os.path.basename(os.path.realpath(link))
+        self.virtfns = [virtfns[i] for i in sorted(virtfns)]
+        physfn = os.path.join(devdir, 'physfn')
+        if os.path.islink(physfn):
+            self.physfn = os.path.basename(os.path.realpath(physfn))
+        else:
+            self.physfn = None
+        self.vf_index = None
+        self.vf_admin_mac = None
+        self.vf_vlan = None
+
+    def is_sriov_pf(self):
+        return bool(self.sriov_totalvfs)
+
+    def set_sriov_numvfs(self, numvfs):
+        '''Set the number of VFs on this PF
+
+        Any change of a non-zero count destroys the existing VFs.'''
+        numvfs = min(numvfs, self.sriov_totalvfs or 0)
+        numvfs_file = sysfs_path(PCI_DEVICES_DIR, self.pci_address,
+                                 'sriov_numvfs')
+        # The inventory may be cached, so go by the current count
+        self.sriov_numvfs = read_sysfs_int(numvfs_file)
+        if numvfs == self.sriov_numvfs:
+            return False
+        log('Setting {} VFs on {}'.format(numvfs, self.pci_address))
+        # The kernel refuses to change a non-zero VF count directly
+        if self.sriov_numvfs:
+            with open(numvfs_file, 'w') as f:
+                f.write('0')
+        with open(numvfs_file, 'w') as f:
+            f.write(str(numvfs))
+        self.update_sriov_info()
+        return True
+
+    def set_channels(self, channels):
+        '''Set the combined channel count, capped at the NIC maximum
+
+        Returns None if the driver does not support it.'''
+        try:
+            maximum, current = parse_ethtool_channels(
+                subprocess.check_output(
+                    ['ethtool', '-l', self.interface_name]))
+            channels = min(channels, maximum) if maximum else channels
+            if channels == current:
+                return False
+            log('Setting {} channels on {}'.format(channels,
+                                                   self.interface_name))
+            subprocess.check_call(['ethtool', '-L', self.interface_name,
+                                   'combined', str(channels)])
+        except (OSError, subprocess.CalledProcessError) as e:
+            log('Unable to set channels on {}: {}'.format(
+                self.interface_name, e), level=ERROR)
+            return None
+        self.update_link_info()
+        return True
+
+    def set_rss_queues(self, queues):
+        '''Spread the RSS indirection table evenly over the first queues,
+        capped at the current combined channel count
+
+        Returns None if the driver does not support it.'''
+        try:
+            _, current = parse_ethtool_channels(subprocess.check_output(
+                ['ethtool', '-l', self.interface_name]))
+            queues = min(queues, current) if current else queues
+            table = parse_ethtool_rss(subprocess.check_output(
+                ['ethtool', '-x', self.interface_name]))
+            if not table or table == [i % queues for i in range(len(table))]:
+                return False
+            log('Spreading RSS on {} over {} queues'.format(
+                self.interface_name, queues))
+            subprocess.check_call(['ethtool', '-X', self.interface_name,
+                                   'equal', str(queues)])
+        except (OSError, subprocess.CalledProcessError) as e:
+            log('Unable to set RSS queues on {}: {}'.format(
+                self.interface_name, e), level=ERROR)
+            return None
+        return True
+
+    def set_queue_cpus(self):
+        '''Steer packet processing of each queue to the NIC's local cpus
+
+        Every rx queue gets all local cpus in rps_cpus, and tx queues are
+        spread over them one cpu each in xps_cpus.'''
+        cpus = self.local_cpus()
+        if not cpus:
+            return False
+        queues_dir = sysfs_path(SYSNET_DIR, self.interface_name, 'queues')
+        changed = False
+        for rx in range(self.rx_queues or 0):
+            changed |= write_cpumask(os.path.join(
+                queues_dir, 'rx-{}'.format(rx), 'rps_cpus'), cpus)
+        for tx in range(self.tx_queues or 0):
+            changed |= write_cpumask(os.path.join(
+                queues_dir, 'tx-{}'.format(tx), 'xps_cpus'),
+                [cpus[tx % len(cpus)]])
+        return changed
+
+    def tune_queues(self, channels=0, rss_queues=0, queue_cpus=False):
+        '''Apply channel, RSS and queue cpu tuning, returning lists of what
+        changed and of what the driver does not support'''
+        if not self.interface_name or \
+                self.state in ('vpebound', 'unbound'):
+            return [], []
+        changed, failed = [], []
+        for name, value, setter in [
+                ('channels', channels, self.set_channels),
+                ('rss', rss_queues, self.set_rss_queues)]:
+            if not value:
+                continue
+            result = setter(value)
+            if result is None:
+                failed.append(name)
+            elif result:
+                changed.append(name)
+        if queue_cpus and self.set_queue_cpus():
+            changed.append('queue cpus')
+        return changed, failed
+
+    def get_vf_config(self):
+        '''Administrative MAC and VLAN of each VF, as seen by this PF
+
+        These are only exposed over netlink, so parse ip link output.'''
+        if not self.interface_name or not self.sriov_numvfs:
+            return {}
+        ip_output = subprocess.check_output(
+            ['ip', 'link', 'show', self.interface_name])
+        vf_config = {}
+        for match in VF_LINK_RE.finditer(ip_output):
+            index, mac, vlan = match.groups()
+            vf_config[int(index)] = {
+                'mac': None if mac == NULL_MAC else mac,
+                'vlan': int(vlan) if vlan else None,
+            }
+        return vf_config
 
     def update_loaded_kmod(self):
         cmd = ['lspci', '-ks', self.pci_address]
@@ -45,13 +843,8 @@ class PCINetDevice(object):
         vendor_device = lspci_output[2]
         vendor, device = vendor_device.split(':')
         pci_string = 'pci:v{}d{}'.format(vendor.zfill(8), device.zfill(8))
-        kernel_name = self.get_kernel_name()
-        alias_files = '/lib/modules/{}/modules.alias'.format(kernel_name)
-        kmod = None
-        with open(alias_files, 'r') as f:
-            for line in f.readlines():
-                if pci_string in line:
-                    kmod = line.split()[-1]
+        kmod = get_pci_aliases(get_modules_alias_file()).get(
+            pci_string.upper())
         log('module.alias kmod for {} is {}'.format(self.pci_address, kmod))
         self.modalias_kmod = kmod
 
@@ -67,33 +860,35 @@ class PCINetDevice(object):
             self.state = 'unbound'
 
     def get_kernel_name(self):
-        return subprocess.check_output(['uname', '-r']).strip()
+        return get_kernel_name()
 
     def pci_rescan(self):
-        rescan_file = '/sys/bus/pci/rescan'
+        rescan_file = sysfs_path('bus/pci/rescan')
         with open(rescan_file, 'w') as f:
             f.write('1')
 
     def bind(self, kmod):
-        bind_file = '/sys/bus/pci/drivers/{}/bind'.format(kmod)
+        bind_file = sysfs_path(PCI_DRIVERS_DIR, kmod, 'bind')
         log('Binding {} to {}'.format(self.pci_address, bind_file))
         with open(bind_file, 'w') as f:
             f.write(self.pci_address)
         self.pci_rescan()
+        self.vpe_table.invalidate()
         self.update_attributes()
 
     def unbind(self):
         if not self.loaded_kmod:
             return
-        unbind_file = '/sys/bus/pci/drivers/{}/unbind'.format(self.loaded_kmod)
+        unbind_file = sysfs_path(PCI_DRIVERS_DIR, self.loaded_kmod, 'unbind')
         log('Unbinding {} from {}'.format(self.pci_address, unbind_file))
         with open(unbind_file, 'w') as f:
             f.write(self.pci_address)
         self.pci_rescan()
+        self.vpe_table.invalidate()
         self.update_attributes()
 
     def update_interface_info_vpe(self):
-        vpe_devices = self.get_vpe_interfaces_and_macs()
+        vpe_devices = self.vpe_table.get()
         device_info = {}
         for interface in vpe_devices:
             if self.pci_address == interface['pci_address']:
@@ -108,77 +903,20 @@ class PCINetDevice(object):
             self.mac_address = None
             self.state = None
 
-    @retry_on_exception(5, base_delay=10,
-                        exc_type=subprocess.CalledProcessError)
-    def get_vpe_cli_out(self):
-        echo_cmd = [
-            'echo', '-e', 'show interfaces-state interface phys-address\nexit']
-        cli_cmd = ['/opt/cisco/vpe/bin/confd_cli', '-N', '-C', '-u', 'system']
-        echo = subprocess.Popen(echo_cmd, stdout=subprocess.PIPE)
-        cli_output = subprocess.check_output(cli_cmd, stdin=echo.stdout)
-        echo.wait()
-        echo.terminate
-        log('confd_cli: ' + cli_output)
-        return cli_output
-
-    def get_vpe_interfaces_and_macs(self):
-        cli_output = self.get_vpe_cli_out()
-        vpe_devs = []
-        if 'local0' not in cli_output:
-            log('local0 missing from confd_cli output, assuming things went '
-                'wrong')
-            raise subprocess.CalledProcessError
-        for line in cli_output.split('\n'):
-            if re.search(r'([0-9A-F]{2}[:-]){5}([0-9A-F]{2})', line, re.I):
-                interface, mac = line.split()
-                pci_addr = self.extract_pci_addr_from_vpe_interface(interface)
-                vpe_devs.append({
-                    'interface': interface,
-                    'macAddress': mac,
-                    'pci_address': pci_addr,
-                })
-        return vpe_devs
-
-    def extract_pci_addr_from_vpe_interface(self, nic):
-        ''' Convert a str from nic postfix format to padded format
-
-        eg 6/1/2 -> 0000:06:01.2'''
-        log('Extracting pci address from {}'.format(nic))
-        # addr = re.sub(r'^\D*', '', nic, re.IGNORECASE)
-        addr = re.sub(r'^.*Ethernet', '', nic, re.IGNORECASE)
-        bus, slot, func = addr.split('/')
-        domain = '0000'
-        pci_addr = format_pci_addr(
-            '{}:{}:{}.{}'.format(domain, bus, slot, func))
-        log('pci address for {} is {}'.format(nic, pci_addr))
-        return pci_addr
-
     def update_interface_info_eth(self):
-        net_devices = self.get_sysnet_interfaces_and_macs()
-        for interface in net_devices:
-            if self.pci_address == interface['pci_address']:
-                self.interface_name = interface['interface']
-                self.mac_address = interface['macAddress']
-                self.state = interface['state']
-
-    def get_sysnet_interfaces_and_macs(self):
-        net_devs = []
-        for sdir in glob.glob('/sys/class/net/*'):
-            sym_link = sdir + "/device"
-            if os.path.islink(sym_link):
-                fq_path = os.path.realpath(sym_link)
-                path = fq_path.split('/')
-                if 'virtio' in path[-1]:
-                    pci_address = path[-2]
-                else:
-                    pci_address = path[-1]
-                net_devs.append({
-                    'interface': self.get_sysnet_interface(sdir),
-                    'macAddress': self.get_sysnet_mac(sdir),
-                    'pci_address': pci_address,
-                    'state': self.get_sysnet_device_state(sdir),
-                })
-        return net_devs
+        self.interface_name = None
+        self.mac_address = None
+        self.state = None
+        # Look below the device rather than scanning every netdev on the
+        # host; virtio netdevs hang off a virtio device
+        devdir = sysfs_path(PCI_DEVICES_DIR, self.pci_address)
+        sysdirs = sorted(glob.glob(os.path.join(devdir, 'net', '*')) +
+                         glob.glob(os.path.join(devdir, 'virtio*', 'net',
+                                                '*')))
+        if sysdirs:
+            self.interface_name = self.get_sysnet_interface(sysdirs[0])
+            self.mac_address = self.get_sysnet_mac(sysdirs[0])
+            self.state = self.get_sysnet_device_state(sysdirs[0])
 
     def get_sysnet_mac(self, sysdir):
         mac_addr_file = sysdir + '/address'
@@ -199,12 +937,220 @@ class PCINetDevice(object):
     def get_sysnet_interface(self, sysdir):
         return sysdir.split('/')[-1]
 
+    def refresh_state(self):
+        '''Re-read the operstate of a cached kernel bound interface'''
+        if self.interface_name and self.state not in ('vpebound', 'unbound'):
+            sysdir = sysfs_path(SYSNET_DIR, self.interface_name)
+            if os.path.exists(sysdir):
+                self.state = read_sysfs(os.path.join(sysdir, 'operstate'))
+                self.update_link_info()
+
 
 class PCINetDevices(object):
 
-    def __init__(self):
-        pci_addresses = self.get_pci_ethernet_addresses()
-        self.pci_devices = [PCINetDevice(dev) for dev in pci_addresses]
+    def __init__(self, devices=None, pci_addresses=None, workers=None):
+        self.vpe_table = VPEInterfaceTable()
+        # Restricts probing to these devices rather than all on the host
+        self.pci_addresses = pci_addresses
+        self.workers = workers or config('pci-probe-workers') or \
+            PROBE_WORKERS
+        # pci address to exception for devices that could not be probed
+        self.probe_errors = {}
+        if devices is None:
+            self.rescan()
+        else:
+            self.pci_devices = [
+                PCINetDevice(dev['pci_address'], vpe_table=self.vpe_table,
+                             attributes=dev)
+                for dev in devices]
+            self.reindex()
+
+    def rescan(self):
+        self.vpe_table.invalidate()
+        pci_addresses = self.pci_addresses or \
+            self.get_pci_ethernet_addresses()
+        # Warm the shared caches before any threads race to fill them
+        try:
+            get_pci_aliases(get_modules_alias_file())
+        except IOError:
+            # Reported as a probe error by each device
+            pass
+        self.probe_errors = {}
+        results = probe_map(
+            lambda dev: PCINetDevice(dev, vpe_table=self.vpe_table),
+            pci_addresses, self.workers)
+        self.pci_devices = []
+        for pci_address, (pcidev, error) in zip(pci_addresses, results):
+            if error:
+                self.probe_errors[pci_address] = error
+            else:
+                self.pci_devices.append(pcidev)
+        self.reindex()
+        self.update_sriov_topology()
+
+    def run_on_devices(self, func, devices):
+        '''Run func on each device concurrently, recording any failures'''
+        results = probe_map(func, devices, self.workers)
+        for pcidev, (_, error) in zip(devices, results):
+            if error:
+                self.probe_errors[pcidev.pci_address] = error
+
+    def update_sriov_topology(self):
+        '''Annotate VFs with their index and PF assigned MAC/VLAN'''
+        pfs = self.get_physical_functions()
+        results = probe_map(lambda pf: pf.get_vf_config(), pfs, self.workers)
+        for pf, (vf_config, _) in zip(pfs, results):
+            vf_config = vf_config or {}
+            for index, vf_addr in enumerate(pf.virtfns):
+                vf = self.get_device_from_pci_address(vf_addr)
+                if not vf:
+                    continue
+                vf.vf_index = index
+                vf.vf_admin_mac = vf_config.get(index, {}).get('mac')
+                vf.vf_vlan = vf_config.get(index, {}).get('vlan')
+
+    def get_physical_functions(self):
+        return [pcidev for pcidev in self.pci_devices
+                if pcidev.is_sriov_pf()]
+
+    def get_virtual_functions(self, pf):
+        vfs = []
+        for vf_addr in pf.virtfns:
+            vf = self.get_device_from_pci_address(vf_addr)
+            if vf:
+                vfs.append(vf)
+        return vfs
+
+    def configure_sriov(self, numvfs_config):
+        '''Apply the sriov-numvfs config to the physical functions
+
+        numvfs_config is either "auto", to enable every VF a PF supports,
+        or a space separated list of <interface>:<numvfs>. Raises
+        SriovConfigError for malformed entries.
+
+        Changing a count recreates every VF of the PF, so PFs with VFs in
+        use are left alone, and "auto" also skips PFs which are up.'''
+        if not numvfs_config:
+            return False
+        requested = parse_sriov_numvfs(numvfs_config)
+        changed = False
+        for pf in self.get_physical_functions():
+            if requested is None:
+                numvfs = pf.sriov_totalvfs
+                if pf.state == 'up':
+                    log('Not changing the VFs of {} as it is up'.format(
+                        pf.interface_name))
+                    continue
+            elif pf.interface_name in requested:
+                numvfs = requested[pf.interface_name]
+            else:
+                continue
+            busy = [vf.pci_address for vf in self.get_virtual_functions(pf)
+                    if vf.state == 'up' or
+                    vf.loaded_kmod in VF_PASSTHROUGH_DRIVERS]
+            if busy and min(numvfs, pf.sriov_totalvfs) != pf.sriov_numvfs:
+                log('Not changing the VFs of {} as {} are in use'.format(
+                    pf.interface_name, ', '.join(busy)))
+                continue
+            changed |= pf.set_sriov_numvfs(numvfs)
+        if changed:
+            # VFs appear and disappear as new PCI functions
+            self.rescan()
+            self.save()
+        return changed
+
+    def rank_devices(self, devices, numa_node=None):
+        '''Order devices for data plane use
+
+        Devices local to numa_node come first, then faster links, then
+        wider/faster PCIe links.'''
+        def placement_key(pcidev):
+            return (numa_node is not None and pcidev.numa_node != numa_node,
+                    -(pcidev.speed or 0),
+                    -pcidev.pcie_bandwidth())
+        return sorted(devices, key=placement_key)
+
+    def get_device_from_interface(self, interface):
+        for pcidev in self.pci_devices:
+            if pcidev.interface_name == interface:
+                return pcidev
+
+    def get_preferred_interface(self, interfaces, numa_node=None):
+        '''Pick the best placed of the named interfaces'''
+        devices = [self.get_device_from_interface(i) for i in interfaces]
+        devices = [pcidev for pcidev in devices if pcidev]
+        if devices:
+            return self.rank_devices(devices, numa_node)[0].interface_name
+        return sorted(interfaces)[0] if interfaces else None
+
+    def get_sriov_topology(self):
+        topology = {}
+        for pf in self.get_physical_functions():
+            topology[pf.pci_address] = {
+                'interface': pf.interface_name,
+                'totalvfs': pf.sriov_totalvfs,
+                'numvfs': pf.sriov_numvfs,
+                'vfs': [{
+                    'pci_address': vf.pci_address,
+                    'interface': vf.interface_name,
+                    'mac': vf.mac_address or vf.vf_admin_mac,
+                    'vlan': vf.vf_vlan,
+                } for vf in self.get_virtual_functions(pf)],
+            }
+        return topology
+
+    def reindex(self):
+        '''Rebuild the mac and pci address lookup tables'''
+        self.devices_by_mac = {}
+        self.devices_by_pci_address = {}
+        for pcidev in self.pci_devices:
+            self.devices_by_pci_address[pcidev.pci_address] = pcidev
+            if pcidev.mac_address:
+                self.devices_by_mac.setdefault(
+                    normalize_mac(pcidev.mac_address), pcidev)
+
+    @classmethod
+    def load(cls, macs=None, workers=None):
+        '''Return the inventory persisted in unitdata if still valid
+
+        The inventory is only rescanned when the hardware or driver
+        bindings have changed since it was last saved. If macs is given
+        and all of them belong to kernel bound netdevs, only those devices
+        are probed and the partial inventory is not persisted; otherwise
+        the whole host is scanned so unbound and VPE bound devices are
+        found too.'''
+        key = get_inventory_key()
+        cached = kv().get(INVENTORY_KEY)
+        if cached and cached.get('key') == key:
+            log('Using cached PCI inventory')
+            net_devices = cls(devices=cached['devices'], workers=workers)
+            for pcidev in net_devices.pci_devices:
+                pcidev.refresh_state()
+            return net_devices
+        if macs:
+            index = get_sysnet_pci_addresses_by_mac()
+            missing = [mac for mac in macs
+                       if normalize_mac(mac) not in index]
+            if not missing:
+                log('Probing only requested devices')
+                return cls(pci_addresses=sorted(
+                    set(index[normalize_mac(mac)] for mac in macs)),
+                    workers=workers)
+            log('{} not bound to a netdev, scanning all '
+                'devices'.format(', '.join(missing)))
+        log('PCI inventory changed, rescanning')
+        net_devices = cls(workers=workers)
+        net_devices.save(key)
+        return net_devices
+
+    def save(self, key=None):
+        if self.pci_addresses or self.probe_errors:
+            # Partial inventories must not satisfy later full lookups
+            return
+        kv().set(INVENTORY_KEY, {
+            'key': key or get_inventory_key(),
+            'devices': [pcidev.to_dict() for pcidev in self.pci_devices],
+        })
 
     def get_pci_ethernet_addresses(self):
         cmd = ['lspci', '-m', '-D']
@@ -218,8 +1164,11 @@ class PCINetDevices(object):
         return pci_addresses
 
     def update_devices(self):
-        for pcidev in self.pci_devices:
-            pcidev.update_attributes()
+        self.vpe_table.invalidate()
+        self.run_on_devices(lambda pcidev: pcidev.update_attributes(),
+                            self.pci_devices)
+        self.reindex()
+        self.update_sriov_topology()
 
     def get_macs(self):
         macs = []
@@ -229,28 +1178,48 @@ class PCINetDevices(object):
         return macs
 
     def get_device_from_mac(self, mac):
-        for pcidev in self.pci_devices:
-            if pcidev.mac_address == mac:
-                return pcidev
+        return self.devices_by_mac.get(normalize_mac(mac))
 
     def get_device_from_pci_address(self, pci_addr):
-        for pcidev in self.pci_devices:
-            if pcidev.pci_address == pci_addr:
-                return pcidev
+        return self.devices_by_pci_address.get(pci_addr)
 
     def rebind_orphans(self):
         self.unbind_orphans()
         self.bind_orphans()
+        self.save()
 
     def unbind_orphans(self):
-        for orphan in self.get_orphans():
-            orphan.unbind()
+        self.run_on_devices(lambda orphan: orphan.unbind(),
+                            self.get_orphans())
         self.update_devices()
 
     def bind_orphans(self):
-        for orphan in self.get_orphans():
-            orphan.bind(orphan.modalias_kmod)
+        self.run_on_devices(lambda orphan: orphan.bind(orphan.modalias_kmod),
+                            self.get_orphans())
         self.update_devices()
+        self.retune_queues()
+
+    def tune_queues(self, interface, **tuning):
+        '''Apply PCINetDevice.tune_queues() to interface
+
+        The tuning is remembered by mac, so it is applied again when the
+        device is rebound. Returns what changed and what failed, or None if
+        interface is not a PCI network device.'''
+        pcidev = self.get_device_from_interface(interface)
+        if not pcidev:
+            return None
+        changed = pcidev.tune_queues(**tuning)
+        tunings = kv().get(QUEUE_TUNING_KEY) or {}
+        tunings[normalize_mac(pcidev.mac_address)] = tuning
+        kv().set(QUEUE_TUNING_KEY, tunings)
+        return changed
+
+    def retune_queues(self):
+        '''Re-apply remembered queue tuning, e.g. after a rebind'''
+        for mac, tuning in (kv().get(QUEUE_TUNING_KEY) or {}).items():
+            pcidev = self.get_device_from_mac(mac)
+            if pcidev:
+                pcidev.tune_queues(**tuning)
 
     def get_orphans(self):
         orphans = []
@@ -263,21 +1232,26 @@ class PCINetDevices(object):
 
 class PCIInfo(dict):
 
-    def __init__(self):
-        ''' Generate pci info '''
+    def __init__(self, lazy=True):
+        ''' Generate pci info
+
+        In lazy mode only the devices named in mac-network-map are probed,
+        when they can be found without a full scan, so local_macs may not
+        list every mac on the host.'''
         if not self.is_ready():
             log('PCIInfo not ready')
             return
         self.user_requested_config = self.get_user_requested_config()
-        net_devices = PCINetDevices()
+        net_devices = PCINetDevices.load(
+            macs=list(self.user_requested_config) if lazy else None)
         self['local_macs'] = net_devices.get_macs()
         pci_addresses = []
         self['local_config'] = {}
         for mac in self.user_requested_config.keys():
             log('Checking if {} is on this host'.format(mac))
-            if mac in self['local_macs']:
+            device = net_devices.get_device_from_mac(mac)
+            if device:
                 log('{} is on this host'.format(mac))
-                device = net_devices.get_device_from_mac(mac)
                 log('{} is {} and is currently {}'.format(mac,
                     device.pci_address, device.interface_name))
                 if device.state == 'up':
@@ -289,8 +1263,42 @@ class PCIInfo(dict):
                     for conf in self.user_requested_config[mac]:
                         self['local_config'][mac].append({
                             'net': conf.get('net'),
+                            'vlan': conf.get('vlan'),
+                            'physnet': conf.get('physnet'),
                             'interface': device.interface_name,
                         })
+        self['sriov'] = net_devices.get_sriov_topology()
+        # Every mapped NIC, up or bound to a userspace driver too. Those
+        # lose their netdev and mac, so are found by the pci address
+        # recorded while they still had one.
+        mapped = kv().get(MAPPED_DEVICES_KEY) or {}
+        self['devices'] = {}
+        for mac in sorted(self.user_requested_config):
+            pcidev = net_devices.get_device_from_mac(mac)
+            if pcidev is None and mac in mapped:
+                pcidev = net_devices.get_device_from_pci_address(
+                    mapped[mac])
+            if pcidev is None:
+                continue
+            mapped[mac] = pcidev.pci_address
+            if pcidev.offloads is None:
+                pcidev.update_offload_info()
+            self['devices'][mac] = {
+                'pci_address': pcidev.pci_address,
+                'interface': pcidev.interface_name,
+                'numa_node': pcidev.numa_node,
+                'local_cpulist': pcidev.local_cpulist,
+                'speed': pcidev.speed,
+                'duplex': pcidev.duplex,
+                'pcie_link_width': pcidev.pcie_link_width,
+                'pcie_link_speed': pcidev.pcie_link_speed,
+                'rx_queues': pcidev.rx_queues,
+                'tx_queues': pcidev.tx_queues,
+                'offloads': sorted(feature for feature, (enabled, fixed)
+                                   in (pcidev.offloads or {}).items()
+                                   if enabled or not fixed),
+            }
+        kv().set(MAPPED_DEVICES_KEY, mapped)
         if pci_addresses:
             self['pci_devs'] = 'dev ' + ' dev '.join(pci_addresses)
         else:
@@ -302,26 +1310,10 @@ class PCIInfo(dict):
         return True
 
     def get_user_requested_config(self):
-        ''' Parse the user requested config str
-        mac=<mac>;net=<net>;vlan=<vlan> and return a dict'''
-        mac_net_config = {}
-        mac_map = config('mac-network-map')
-        if mac_map:
-            for line in mac_map.split():
-                entries = line.split(';')
-                tmp_dict = {}
-                for entry in entries:
-                    if '=' in entry:
-                        key, value = entry.split('=')
-                        tmp_dict[key] = value
-                keys = tmp_dict.keys()
-                if 'mac' in keys:
-                    if tmp_dict['mac'] in mac_net_config:
-                        mac_net_config[tmp_dict['mac']].append({
-                            'net': tmp_dict.get('net'),
-                        })
-                    else:
-                        mac_net_config[tmp_dict['mac']] = [{
-                            'net': tmp_dict.get('net'),
-                        }]
-        return mac_net_config
+        ''' Parse the mac-network-map config option
+
+        Either inline mac=<mac>;net=<net>[;vlan=<vlan>][;physnet=<physnet>]
+        entries, or a /path or file:// URL of a YAML or JSON file of
+        entries. Returns a dict of mac to a list of entries, see
+        parse_mac_network_map().'''
+        return parse_mac_network_map(config('mac-network-map'))
@@ -0,0 +1,164 @@
+'''DPDK datapath settings for Open vSwitch
+
+The EAL and PMD thread placement is derived per NUMA node from the NICs
+found by PCIDev, so packet processing stays local to the data NICs.
+'''
+import glob
+import grp
+import os
+import subprocess
+
+import lib.PCIDev as PCIDev
+
+from charmhelpers.core import host
+
+PACKAGES = ['openvswitch-switch-dpdk']
+VSWITCHD_ALTERNATIVE = \
+    '/usr/lib/openvswitch-switch-dpdk/ovs-vswitchd-dpdk'
+NODE_DIR = 'devices/system/node'
+# vhost-user sockets must live below the Open vSwitch run directory
+OVS_RUNDIR = '/var/run/openvswitch'
+# Group QEMU runs as, which creates the sockets of client mode ports
+VHOST_USER_GROUP = 'libvirt-qemu'
+# other_config keys read by ovs-vswitchd only when DPDK is initialised
+EAL_KEYS = ('dpdk-init', 'dpdk-lcore-mask', 'dpdk-socket-mem',
+            'vhost-sock-dir')
+# other_config keys balancing the PMD threads and sizing their flow caches
+PMD_KEYS = ('pmd-auto-lb', 'emc-insert-inv-prob', 'smc-enable')
+CONFIG_KEYS = EAL_KEYS + ('pmd-cpu-mask',) + PMD_KEYS
+
+
+def get_numa_nodes():
+    '''Map each NUMA node to the list of its cpus'''
+    nodes = {}
+    for path in glob.glob(PCIDev.sysfs_path(NODE_DIR, 'node[0-9]*')):
+        node = int(os.path.basename(path)[len('node'):])
+        nodes[node] = PCIDev.parse_cpulist(
+            PCIDev.read_sysfs(os.path.join(path, 'cpulist')))
+    return nodes or {0: []}
+
+
+def get_device_nodes(devices, numa_nodes=None):
+    '''Sorted NUMA nodes hosting devices, the placement dicts of
+    PCIInfo['devices']; the first node when none of them is known'''
+    numa_nodes = numa_nodes or get_numa_nodes()
+    nodes = set(max(device.get('numa_node') or 0, 0)
+                for device in devices)
+    return sorted(nodes & set(numa_nodes)) or [min(numa_nodes)]
+
+
+def _device_node(device, nodes):
+    node = max(device.get('numa_node') or 0, 0)
+    return node if node in nodes else min(nodes)
+
+
+def get_pmd_cpus(devices, pmd_cores, numa_nodes=None):
+    '''Map each NUMA node hosting devices to the cpus of its pmd_cores PMD
+    threads, leaving out the non-PMD lcore'''
+    numa_nodes = numa_nodes or get_numa_nodes()
+    device_nodes = get_device_nodes(devices, numa_nodes)
+    lcores = numa_nodes[device_nodes[0]][:1]
+    return dict((node, [cpu for cpu in numa_nodes[node]
+                        if cpu not in lcores][:pmd_cores])
+                for node in device_nodes)
+
+
+def get_vhost_sock_dir(socket_dir):
+    '''vhost-sock-dir setting for the absolute path socket_dir, which
+    ovs-vswitchd only accepts at or below OVS_RUNDIR'''
+    path = os.path.relpath(os.path.normpath(socket_dir), OVS_RUNDIR)
+    if not os.path.isabs(socket_dir) or path.split(os.sep)[0] == '..':
+        raise ValueError('vhost-user socket directory {} is not below '
+                         '{}'.format(socket_dir, OVS_RUNDIR))
+    return path
+
+
+def make_socket_dir(socket_dir):
+    '''Create socket_dir writable by QEMU when its group exists'''
+    try:
+        grp.getgrnam(VHOST_USER_GROUP)
+    except KeyError:
+        group = 'root'
+    else:
+        group = VHOST_USER_GROUP
+    host.mkdir(socket_dir, group=group, perms=0o775)
+
+
+def get_dpdk_config(devices, socket_memory, pmd_cores,
+                    vhost_socket_dir=OVS_RUNDIR):
+    '''other_config settings enabling the DPDK datapath
+
+    Each NUMA node hosting one of devices gets socket_memory MB of
+    hugepage memory and pmd_cores PMD threads; the non-PMD lcore runs on
+    the first cpu of the first such node. vhost-user sockets are created
+    in vhost_socket_dir.'''
+    numa_nodes = get_numa_nodes()
+    device_nodes = get_device_nodes(devices, numa_nodes)
+    lcores = numa_nodes[device_nodes[0]][:1]
+    pmd_cpus = sum(get_pmd_cpus(devices, pmd_cores, numa_nodes).values(), [])
+    socket_mem = [socket_memory if node in device_nodes else 0
+                  for node in range(max(numa_nodes) + 1)]
+    return {
+        'dpdk-init': 'true',
+        'dpdk-lcore-mask': '0x{}'.format(PCIDev.cpus_to_mask(lcores)),
+        'pmd-cpu-mask': '0x{}'.format(PCIDev.cpus_to_mask(sorted(pmd_cpus))),
+        'dpdk-socket-mem': ','.join(str(mem) for mem in socket_mem),
+        'vhost-sock-dir': get_vhost_sock_dir(vhost_socket_dir),
+    }
+
+
+def get_pmd_config(pmd_cpus, auto_lb=True, emc_insert_inv_prob=100,
+                   smc_enable=False, pinned=False):
+    '''other_config settings for PMD_KEYS
+
+    Auto load balancing only moves unpinned rx queues between PMD threads,
+    so it is enabled with more than one PMD cpu and unpinned queues.'''
+    balance = (auto_lb and not pinned and
+               len(sum(pmd_cpus.values(), [])) > 1)
+    return {
+        'pmd-auto-lb': str(bool(balance)).lower(),
+        'emc-insert-inv-prob': str(emc_insert_inv_prob),
+        'smc-enable': str(bool(smc_enable)).lower(),
+    }
+
+
+def get_port_config(devices, pmd_cpus, n_rxq=0, pinned=False):
+    '''Interface settings of a DPDK port for each device, by mac
+
+    devices maps macs to PCIInfo['devices'] entries and pmd_cpus is from
+    get_pmd_cpus(). Ports poll n_rxq rx queues, by default one per PMD
+    cpu of their NUMA node. Pinned queues are spread round robin over
+    those cpus, continuing across the ports of a node.'''
+    settings = {}
+    pinned_queues = dict((node, 0) for node in pmd_cpus)
+    for mac in sorted(devices):
+        device = devices[mac]
+        node = _device_node(device, pmd_cpus)
+        cpus = pmd_cpus[node]
+        queues = n_rxq or max(len(cpus), 1)
+        affinity = None
+        if pinned and cpus:
+            affinity = ','.join(
+                '{}:{}'.format(queue,
+                               cpus[(pinned_queues[node] + queue) %
+                                    len(cpus)])
+                for queue in range(queues))
+            pinned_queues[node] += queues
+        settings[mac] = {
+            'type': 'dpdk',
+            'options': {'dpdk-devargs': device['pci_address'],
+                        'n_rxq': queues},
+            # None removes a previous pinning
+            'other_config': {'pmd-rxq-affinity': affinity},
+        }
+    return settings
+
+
+def select_vswitchd(enable):
+    '''Point the ovs-vswitchd alternative at the DPDK build, or back'''
+    if enable:
+        cmd = ['update-alternatives', '--set', 'ovs-vswitchd',
+               VSWITCHD_ALTERNATIVE]
+    else:
+        cmd = ['update-alternatives', '--auto', 'ovs-vswitchd']
+    subprocess.check_call(cmd)
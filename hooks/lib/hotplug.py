@@ -0,0 +1,346 @@
+'''NIC hotplug watcher
+
+Listens for kernel uevents (PCI and net subsystems) and rtnetlink link
+events, keeps an incremental inventory of PCI driver bindings and network
+interfaces, and records a change generation on disk. Hooks compare the
+generation against the one they last acted on instead of rescanning the
+host on every dispatch.
+
+Run as a daemon with:
+
+    python hotplug.py [state_file]
+'''
+import errno
+import fcntl
+import json
+import os
+import re
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+
+STATE_FILE = '/var/lib/openvswitch-odl/hotplug.json'
+PID_FILE = '/var/run/openvswitch-odl-hotplug.pid'
+SYSFS_NET = '/sys/class/net'
+
+NETLINK_ROUTE = 0
+NETLINK_KOBJECT_UEVENT = 15
+# Kernel (as opposed to udev) uevent multicast group
+UEVENT_KERNEL_GROUP = 1
+RTMGRP_LINK = 1
+
+NLMSG_HDR = struct.Struct('=LHHLL')
+IFINFOMSG = struct.Struct('=BxHiII')
+RTATTR = struct.Struct('=HH')
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFLA_OPERSTATE = 16
+OPERSTATES = ['unknown', 'notpresent', 'down', 'lowerlayerdown',
+              'testing', 'dormant', 'up']
+
+RECV_SIZE = 65536
+PCI_ADDR_RE = re.compile(r'[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-7]', re.I)
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def parse_uevent(data):
+    '''Parse a kernel uevent datagram into a dict of its properties
+
+    Returns None for messages that are not kernel uevents, such as those
+    re-broadcast by udev.'''
+    fields = data.split(b'\0')
+    if not fields or b'@' not in fields[0]:
+        return None
+    event = {}
+    for field in fields[1:]:
+        if b'=' in field:
+            key, value = field.split(b'=', 1)
+            event[key.decode('utf-8')] = value.decode('utf-8')
+    if 'ACTION' not in event:
+        return None
+    return event
+
+
+def parse_rtnl(data):
+    '''Parse an rtnetlink datagram into a list of link events'''
+    events = []
+    offset = 0
+    while offset + NLMSG_HDR.size <= len(data):
+        msg_len, msg_type, _, _, _ = NLMSG_HDR.unpack_from(data, offset)
+        if msg_len < NLMSG_HDR.size or msg_type == NLMSG_DONE:
+            break
+        if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+            body = offset + NLMSG_HDR.size
+            _, _, ifindex, _, _ = IFINFOMSG.unpack_from(data, body)
+            link = {
+                'event': 'newlink' if msg_type == RTM_NEWLINK else 'dellink',
+                'ifindex': ifindex,
+            }
+            attr = body + IFINFOMSG.size
+            while attr + RTATTR.size <= offset + msg_len:
+                rta_len, rta_type = RTATTR.unpack_from(data, attr)
+                if rta_len < RTATTR.size:
+                    break
+                value = data[attr + RTATTR.size:attr + rta_len]
+                if rta_type == IFLA_IFNAME:
+                    link['ifname'] = value.rstrip(b'\0').decode('utf-8')
+                elif rta_type == IFLA_ADDRESS:
+                    link['mac'] = ':'.join(
+                        '{:02x}'.format(b) for b in bytearray(value))
+                elif rta_type == IFLA_OPERSTATE:
+                    state = bytearray(value)[0]
+                    link['state'] = (OPERSTATES[state]
+                                     if state < len(OPERSTATES)
+                                     else 'unknown')
+                attr += _align(rta_len)
+            events.append(link)
+        offset += _align(msg_len)
+    return events
+
+
+def pci_address_from_devpath(devpath):
+    '''Return the PCI address closest to the device in a sysfs devpath'''
+    matches = PCI_ADDR_RE.findall(devpath)
+    if matches:
+        return matches[-1].lower()
+
+
+def pci_netdev_address(ifname, sysfs_net=SYSFS_NET):
+    '''PCI address of the function behind a netdev, or None for virtual
+    devices such as taps, veths and vhost-user ports'''
+    device = os.path.join(sysfs_net, ifname, 'device')
+    if os.path.islink(device):
+        return pci_address_from_devpath(os.path.realpath(device))
+
+
+def read_state(state_file=STATE_FILE):
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def current_generation(state_file=STATE_FILE, pid_file=PID_FILE):
+    '''Generation recorded by a running watcher, or None if there is none
+
+    A stopped watcher leaves only its generation behind, without an
+    inventory, so a new one carries on counting from it.'''
+    if not watcher_running(pid_file):
+        return None
+    state = read_state(state_file)
+    if state and 'inventory' in state:
+        return state.get('generation')
+
+
+def watcher_running(pid_file=PID_FILE):
+    try:
+        with open(pid_file, 'r') as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+    except (IOError, OSError, ValueError):
+        return False
+    return True
+
+
+def start_watcher(state_file=STATE_FILE):
+    '''Start the watcher as a detached daemon unless one is running'''
+    if watcher_running():
+        return False
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'hotplug.py')
+    devnull = open(os.devnull, 'r+')
+    subprocess.Popen([sys.executable, script, state_file],
+                     stdin=devnull, stdout=devnull, stderr=devnull,
+                     close_fds=True, preexec_fn=os.setsid)
+    return True
+
+
+def stop_watcher(pid_file=PID_FILE, state_file=STATE_FILE):
+    if not watcher_running(pid_file):
+        return False
+    with open(pid_file, 'r') as f:
+        os.kill(int(f.read().strip()), signal.SIGTERM)
+    os.unlink(pid_file)
+    # Events are no longer tracked, so the inventory goes stale
+    state = read_state(state_file)
+    if state:
+        with open(state_file, 'w') as f:
+            json.dump({'generation': state.get('generation', 0)}, f)
+    return True
+
+
+class HotplugWatcher(object):
+
+    def __init__(self, uevent_sock=None, rtnl_sock=None,
+                 state_file=STATE_FILE, sysfs_net=SYSFS_NET):
+        self.state_file = state_file
+        self.sysfs_net = sysfs_net
+        self.uevent_sock = uevent_sock
+        self.rtnl_sock = rtnl_sock
+        state = read_state(state_file) or {}
+        self.inventory = state.get('inventory', {'pci': {}, 'net': {}})
+        # Events may have been missed while no watcher was running
+        self.generation = state.get('generation', 0) + 1
+        self.save()
+
+    def open_sockets(self):
+        if self.uevent_sock is None:
+            self.uevent_sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            self.uevent_sock.bind((0, UEVENT_KERNEL_GROUP))
+        if self.rtnl_sock is None:
+            self.rtnl_sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            self.rtnl_sock.bind((0, RTMGRP_LINK))
+
+    def _update(self, section, key, values):
+        '''Merge values into an inventory entry, reporting any change'''
+        changed = key not in self.inventory[section]
+        entry = self.inventory[section].setdefault(key, {})
+        for name, value in values.items():
+            if entry.get(name) != value:
+                entry[name] = value
+                changed = True
+        return changed
+
+    def _remove(self, section, key):
+        return self.inventory[section].pop(key, None) is not None
+
+    def handle_uevent(self, data):
+        event = parse_uevent(data)
+        if not event:
+            return False
+        action = event['ACTION']
+        subsystem = event.get('SUBSYSTEM')
+        if subsystem == 'pci' and event.get('PCI_SLOT_NAME'):
+            slot = event['PCI_SLOT_NAME'].lower()
+            if action == 'remove':
+                return self._remove('pci', slot)
+            if action == 'unbind':
+                return self._update('pci', slot, {'driver': None})
+            if action in ('add', 'bind') or event.get('DRIVER'):
+                return self._update('pci', slot,
+                                    {'driver': event.get('DRIVER')})
+        elif subsystem == 'net' and event.get('INTERFACE'):
+            ifname = event['INTERFACE']
+            if not pci_address_from_devpath(event.get('DEVPATH', '')) and \
+                    ifname not in self.inventory['net']:
+                # Virtual devices come and go with every VM
+                return False
+            if action == 'remove':
+                return self._remove('net', ifname)
+            if action == 'move' and event.get('DEVPATH_OLD'):
+                old = event['DEVPATH_OLD'].rstrip('/').split('/')[-1]
+                self.inventory['net'][ifname] = \
+                    self.inventory['net'].pop(old, {})
+            values = {
+                'pci_address': pci_address_from_devpath(
+                    event.get('DEVPATH', '')),
+            }
+            if action == 'move':
+                self._update('net', ifname, values)
+                return True
+            return self._update('net', ifname, values)
+        return False
+
+    def handle_rtnl(self, data):
+        changed = False
+        for link in parse_rtnl(data):
+            ifname = link.get('ifname')
+            if not ifname:
+                continue
+            if link['event'] == 'dellink':
+                changed |= self._remove('net', ifname)
+            elif ifname in self.inventory['net'] or \
+                    pci_netdev_address(ifname, self.sysfs_net):
+                values = dict((k, link[k]) for k in ('mac', 'state')
+                              if k in link)
+                changed |= self._update('net', ifname, values)
+        return changed
+
+    def save(self):
+        '''Atomically write the inventory and generation to disk'''
+        state_dir = os.path.dirname(self.state_file)
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'generation': self.generation,
+                       'inventory': self.inventory}, f, sort_keys=True)
+        os.rename(tmp_file, self.state_file)
+
+    def poll(self, timeout=None):
+        '''Process pending events; returns True if the generation moved'''
+        handlers = {}
+        if self.uevent_sock is not None:
+            handlers[self.uevent_sock] = self.handle_uevent
+        if self.rtnl_sock is not None:
+            handlers[self.rtnl_sock] = self.handle_rtnl
+        try:
+            readable, _, _ = select.select(list(handlers), [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        changed = False
+        for sock in readable:
+            try:
+                data = sock.recv(RECV_SIZE)
+            except socket.error as e:
+                if e.args[0] != errno.ENOBUFS:
+                    raise
+                # The socket overflowed and events were dropped
+                changed = True
+                continue
+            if data:
+                changed |= handlers[sock](data)
+        if changed:
+            self.generation += 1
+            self.save()
+        return changed
+
+    def run(self):
+        self.open_sockets()
+        while True:
+            self.poll()
+
+
+def lock_pid_file(pid_file=PID_FILE):
+    '''Lock and write the pid file, returning it to hold for the life of
+    the watcher, or None if another watcher holds it'''
+    f = open(pid_file, 'a+')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        f.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()))
+    f.flush()
+    return f
+
+
+def main(args):
+    state_file = args[1] if len(args) > 1 else STATE_FILE
+    # Hooks racing to start the watcher leave only one running
+    pid_file = lock_pid_file()
+    if pid_file is None:
+        return
+    HotplugWatcher(state_file=state_file).run()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,114 @@
+'''Hugepage reservation per NUMA node and the hugetlbfs mount using it'''
+import os
+
+import lib.PCIDev as PCIDev
+
+from charmhelpers.core import host
+from charmhelpers.core.hookenv import log
+
+HUGEPAGES_MOUNT = '/mnt/huge'
+# fstab entries are matched on device, so use one of our own
+HUGEPAGES_DEVICE = 'hugetlbfs-ovs'
+PROC_MOUNTS = '/proc/mounts'
+NODE_DIR = 'devices/system/node'
+SIZE_UNITS = {'K': 1, 'M': 1024, 'G': 1024 * 1024}
+
+
+class HugepagesError(ValueError):
+    ''' Raised for invalid hugepages and hugepage-size values '''
+    pass
+
+
+def parse_size(size):
+    '''Hugepage size such as 2M or 1G in kB'''
+    size = str(size or '').strip().upper()
+    unit = SIZE_UNITS.get(size[-1:])
+    try:
+        return int(size[:-1]) * unit if unit else int(size)
+    except ValueError:
+        raise HugepagesError('Invalid hugepage size {}'.format(size))
+
+
+def format_size(size_kb):
+    for suffix in ('G', 'M'):
+        if size_kb % SIZE_UNITS[suffix] == 0:
+            return '{}{}'.format(size_kb // SIZE_UNITS[suffix], suffix)
+    return '{}K'.format(size_kb)
+
+
+def _parse_count(value):
+    try:
+        count = int(value)
+    except ValueError:
+        count = -1
+    if count < 0:
+        raise HugepagesError('Invalid hugepage count {}'.format(value))
+    return count
+
+
+def parse_counts(hugepages, nodes):
+    '''Pages wanted on each of nodes
+
+    hugepages is either a single count for every node or a space
+    separated list of <node>:<count>, nodes absent from it get none.'''
+    hugepages = str(hugepages).strip()
+    if ':' not in hugepages:
+        return dict((node, _parse_count(hugepages)) for node in nodes)
+    counts = dict((node, 0) for node in nodes)
+    for entry in hugepages.split():
+        node, _, count = entry.partition(':')
+        if not node.isdigit() or int(node) not in counts:
+            raise HugepagesError('No NUMA node {}'.format(node))
+        counts[int(node)] = _parse_count(count)
+    return counts
+
+
+def node_hugepages_path(node, size_kb, name):
+    return PCIDev.sysfs_path(NODE_DIR, 'node{}'.format(node), 'hugepages',
+                             'hugepages-{}kB'.format(size_kb), name)
+
+
+def allocate(counts, size_kb):
+    '''Size the hugepage pool of each NUMA node
+
+    Returns the pages the kernel actually holds per node, which may be
+    fewer than asked for when memory is fragmented.'''
+    allocated = {}
+    for node, count in sorted(counts.items()):
+        path = node_hugepages_path(node, size_kb, 'nr_hugepages')
+        if not os.path.exists(path):
+            raise HugepagesError('{} hugepages are not supported'.format(
+                format_size(size_kb)))
+        if PCIDev.read_sysfs_int(path) != count:
+            log('Setting {} {} hugepages on NUMA node {}'.format(
+                count, format_size(size_kb), node))
+            with open(path, 'w') as f:
+                f.write(str(count))
+        allocated[node] = PCIDev.read_sysfs_int(path)
+    return allocated
+
+
+def get_mount_options(mountpoint):
+    '''Options of the filesystem mounted at mountpoint, or None'''
+    with open(PROC_MOUNTS) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 3 and fields[1] == mountpoint:
+                return fields[3].split(',')
+    return None
+
+
+def mount_hugetlbfs(size_kb, mountpoint=HUGEPAGES_MOUNT):
+    '''Mount hugetlbfs for size_kb pages at mountpoint, also in fstab'''
+    options = 'pagesize={}'.format(format_size(size_kb))
+    current = get_mount_options(mountpoint)
+    if current is not None:
+        if options in current:
+            return True
+        if not host.umount(mountpoint, persist=True):
+            return False
+    else:
+        host.fstab_remove(mountpoint)
+    host.mkdir(mountpoint, perms=0o755)
+    return bool(host.mount(HUGEPAGES_DEVICE, mountpoint, options=options,
+                           persist=True, filesystem='hugetlbfs'))
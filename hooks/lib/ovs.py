@@ -1,25 +1,710 @@
+import json
 import subprocess
+import time
 
-from charmhelpers.core.hookenv import cached
+import lib.ovsdb as ovsdb
 
+from charmhelpers.core.host import service_restart
+from charmhelpers.core.unitdata import kv
 
-def set_manager(connection_url):
-    '''Configure the OVSDB manager for the switch'''
-    subprocess.check_call(['ovs-vsctl', 'set-manager', connection_url])
+STATE_COLUMNS = ('other_config', 'external_ids')
+MANAGER_COLUMNS = ('target', 'is_connected', 'status')
+MANAGER_STATS_KEY = 'ovs.manager-connection'
+# ovs-vswitchd only refreshes the connection status every few seconds
+RECONNECT_SLACK = 10
+# other_config keys tuning the upcall handler and revalidator threads
+TUNING_KEYS = ('n-handler-threads', 'n-revalidator-threads', 'flow-limit',
+               'max-idle', 'max-revalidator')
+# Manager and Controller columns pacing probes and reconnects
+CONNECTION_COLUMNS = ('inactivity_probe', 'max_backoff')
+# Tables read by get_state() to check what commands would change
+TOPOLOGY_TABLES = ('Bridge', 'Port', 'Interface')
+COMMAND_TABLES = {
+    'add-br': TOPOLOGY_TABLES,
+    'add-bond': TOPOLOGY_TABLES,
+    'del-port': TOPOLOGY_TABLES,
+    'set-controllers': ('Controller',),
+}
+# Column identifying the records of tables without a name column
+RECORD_COLUMNS = {'Manager': 'target', 'Controller': '_uuid'}
+
+
+class Transaction(object):
+    '''A batch of Open vSwitch database changes
+
+    Operations are collected and committed together as one atomic
+    transaction, natively over the ovsdb-server socket when it is
+    reachable and with a single ovs-vsctl invocation otherwise. Changes
+    already present in the database are dropped before committing, so a
+    steady state costs a single read.'''
+
+    def __init__(self):
+        self.operations = []
+
+    def __len__(self):
+        return len(self.operations)
+
+    def set_config(self, key, value, table='other_config'):
+        '''Set a key value pair in a column of the Open_vSwitch table'''
+        self.operations.append(('set', 'Open_vSwitch', '.', table, key,
+                                value))
+        return self
+
+    def remove_config(self, key, table='other_config'):
+        '''Remove a key from a column of the Open_vSwitch table'''
+        self.operations.append(('remove', 'Open_vSwitch', '.', table, key))
+        return self
+
+    def set_manager(self, *connection_urls, **settings):
+        '''Replace the OVSDB managers for the switch, setting Manager
+        columns such as inactivity_probe; columns set to None are
+        cleared'''
+        self.operations.append(('set-manager',) + connection_urls)
+        if settings:
+            for url in connection_urls:
+                self.operations.append(('set-columns', 'Manager', url,
+                                        settings))
+        return self
+
+    def set_controllers(self, **settings):
+        '''Set Controller columns of every bridge controller, columns set
+        to None being cleared'''
+        self.operations.append(('set-controllers', settings))
+        return self
+
+    def del_manager(self):
+        '''Remove all OVSDB managers'''
+        self.operations.append(('del-manager',))
+        return self
+
+    def del_controller(self, *bridges):
+        '''Remove the OpenFlow controllers of bridges'''
+        for bridge in bridges:
+            self.operations.append(('del-controller', bridge))
+        return self
+
+    def add_bridge(self, bridge, settings=None):
+        '''Create a bridge unless it exists, with Bridge columns settings
+        such as datapath_type'''
+        self.operations.append(('add-br', bridge, settings or {}))
+        return self
+
+    def add_bond(self, bridge, port, interfaces, settings=None,
+                 interface_settings=None):
+        '''Create or update a bond port of interfaces on bridge
+
+        settings are Port columns such as bond_mode, lacp and other_config,
+        and interface_settings a dict of interface to its Interface
+        columns, e.g. the type and options of DPDK ports. Map keys set to
+        None are removed.'''
+        self.operations.append(('add-bond', bridge, port, tuple(interfaces),
+                                settings or {}, interface_settings or {}))
+        return self
+
+    def del_port(self, bridge, port):
+        '''Remove a port and its interfaces from bridge if it exists'''
+        self.operations.append(('del-port', bridge, port, None))
+        return self
+
+    def vsctl_args(self):
+        args = ['ovs-vsctl']
+        for operation in self.operations:
+            command = operation[0]
+            if command == 'set':
+                _, table, record, column, key, value = operation
+                command_args = ['set', table, record,
+                                '{}:{}={}'.format(column, key, value)]
+            elif command == 'add-br':
+                _, bridge, settings = operation
+                command_args = ['--may-exist', 'add-br', bridge]
+                if settings:
+                    command_args += (['--', 'set', 'Bridge', bridge] +
+                                     _vsctl_columns(settings))
+            elif command == 'add-bond':
+                _, bridge, port, interfaces, settings, if_settings = operation
+                command_args = (['add-bond', bridge, port] + list(interfaces) +
+                                _vsctl_columns(settings))
+                for interface in interfaces:
+                    columns = _vsctl_columns(if_settings.get(interface, {}))
+                    if columns:
+                        command_args += (['--', 'set', 'Interface',
+                                          interface] + columns)
+            elif command == 'set-columns':
+                _, table, record, settings = operation
+                commands = []
+                columns = _vsctl_columns(settings)
+                if columns:
+                    commands.append(['set', table, record] + columns)
+                for column, value in sorted(settings.items()):
+                    if isinstance(value, dict):
+                        commands.extend(
+                            ['remove', table, record, column, key]
+                            for key in sorted(value) if value[key] is None)
+                    elif value is None:
+                        commands.append(['clear', table, record, column])
+                command_args = commands[0]
+                for extra in commands[1:]:
+                    command_args += ['--'] + extra
+            elif command == 'del-port':
+                command_args = ['--if-exists', 'del-port', operation[1],
+                                operation[2]]
+            else:
+                command_args = list(operation)
+            args.extend(['--'] + command_args)
+        return args
+
+    def ovsdb_operations(self):
+        '''The batch as RFC 7047 transact operations'''
+        operations = []
+        for n, operation in enumerate(self.operations):
+            command = operation[0]
+            if command == 'set':
+                _, table, record, column, key, value = operation
+                # '.' addresses the singleton Open_vSwitch record, so
+                # the mutation applies to every row of the table
+                operations.append({
+                    'op': 'mutate', 'table': table, 'where': [],
+                    'mutations': [
+                        [column, 'delete', ['set', [key]]],
+                        [column, 'insert', ['map', [[key, str(value)]]]],
+                    ]})
+            elif command == 'remove':
+                _, table, record, column, key = operation
+                operations.append({
+                    'op': 'mutate', 'table': table, 'where': [],
+                    'mutations': [[column, 'delete', ['set', [key]]]]})
+            elif command == 'set-manager':
+                names = []
+                for i, target in enumerate(operation[1:]):
+                    names.append(['named-uuid', 'manager{}'.format(i)])
+                    operations.append({
+                        'op': 'insert', 'table': 'Manager',
+                        'uuid-name': 'manager{}'.format(i),
+                        'row': {'target': target}})
+                # Managers no longer referenced are garbage collected
+                operations.append({
+                    'op': 'update', 'table': 'Open_vSwitch', 'where': [],
+                    'row': {'manager_options': ['set', names]}})
+            elif command == 'del-manager':
+                operations.append({
+                    'op': 'update', 'table': 'Open_vSwitch', 'where': [],
+                    'row': {'manager_options': ['set', []]}})
+            elif command == 'del-controller':
+                operations.append({
+                    'op': 'update', 'table': 'Bridge',
+                    'where': [['name', '==', operation[1]]],
+                    'row': {'controller': ['set', []]}})
+            elif command == 'add-br':
+                # Like ovs-vsctl, with an internal port named after the
+                # bridge
+                _, bridge, settings = operation
+                row = _ovsdb_row(settings)
+                row.update({'name': bridge,
+                            'ports': ['named-uuid', 'port{}'.format(n)]})
+                operations.extend([
+                    {'op': 'insert', 'table': 'Interface',
+                     'uuid-name': 'iface{}_0'.format(n),
+                     'row': {'name': bridge, 'type': 'internal'}},
+                    {'op': 'insert', 'table': 'Port',
+                     'uuid-name': 'port{}'.format(n),
+                     'row': {'name': bridge, 'interfaces': [
+                         'named-uuid', 'iface{}_0'.format(n)]}},
+                    {'op': 'insert', 'table': 'Bridge',
+                     'uuid-name': 'bridge{}'.format(n), 'row': row},
+                    {'op': 'mutate', 'table': 'Open_vSwitch', 'where': [],
+                     'mutations': [['bridges', 'insert', [
+                         'set', [['named-uuid', 'bridge{}'.format(n)]]]]]},
+                ])
+            elif command == 'add-bond':
+                _, bridge, port, interfaces, settings, if_settings = operation
+                names = []
+                for i, interface in enumerate(interfaces):
+                    name = 'iface{}_{}'.format(n, i)
+                    names.append(['named-uuid', name])
+                    row = _ovsdb_row(if_settings.get(interface, {}))
+                    row['name'] = interface
+                    operations.append({'op': 'insert', 'table': 'Interface',
+                                       'uuid-name': name, 'row': row})
+                row = _ovsdb_row(settings)
+                row.update({'name': port, 'interfaces': ['set', names]})
+                operations.extend([
+                    {'op': 'insert', 'table': 'Port',
+                     'uuid-name': 'port{}'.format(n), 'row': row},
+                    {'op': 'mutate', 'table': 'Bridge',
+                     'where': [['name', '==', bridge]],
+                     'mutations': [['ports', 'insert', [
+                         'set', [['named-uuid', 'port{}'.format(n)]]]]]},
+                ])
+            elif command == 'set-columns':
+                _, table, record, settings = operation
+                column = RECORD_COLUMNS.get(table, 'name')
+                if column == '_uuid':
+                    where = [[column, '==', ['uuid', record]]]
+                else:
+                    where = [[column, '==', record]]
+                row, mutations = {}, []
+                for column, value in sorted(settings.items()):
+                    if isinstance(value, dict):
+                        # Only the given keys, as ovs-vsctl set does
+                        mutations.append(
+                            [column, 'delete', ['set', sorted(value)]])
+                        value = _ovsdb_row({column: value})[column]
+                        if value[1]:
+                            mutations.append([column, 'insert', value])
+                    else:
+                        row[column] = _ovsdb_atom(value)
+                if row:
+                    operations.append({'op': 'update', 'table': table,
+                                       'where': where, 'row': row})
+                if mutations:
+                    operations.append({'op': 'mutate', 'table': table,
+                                       'where': where,
+                                       'mutations': mutations})
+            elif command == 'del-port':
+                # The port and its interfaces are garbage collected
+                _, bridge, port, port_uuid = operation
+                operations.append({
+                    'op': 'mutate', 'table': 'Bridge',
+                    'where': [['name', '==', bridge]],
+                    'mutations': [['ports', 'delete',
+                                   ['set', [['uuid', port_uuid]]]]]})
+        return operations
+
+    def pending(self, state):
+        '''The operations which would change state, see get_state()'''
+        operations = []
+        for operation in self.operations:
+            command = operation[0]
+            if command == 'set':
+                _, table, record, column, key, value = operation
+                if state.get(column, {}).get(key) == str(value):
+                    continue
+            elif command == 'remove':
+                _, table, record, column, key = operation
+                if key not in state.get(column, {key: None}):
+                    continue
+            elif command == 'set-manager':
+                if sorted(state['managers']) == sorted(operation[1:]):
+                    continue
+                # The managers are recreated, dropping their settings
+                state = dict(state, manager_settings={})
+            elif command == 'set-columns' and operation[1] == 'Manager':
+                _, table, target, settings = operation
+                current = state['manager_settings'].get(target)
+                if current is None:
+                    settings = dict((column, value)
+                                    for column, value in settings.items()
+                                    if value is not None)
+                else:
+                    settings = _changed(current, settings)
+                if settings:
+                    operations.append(('set-columns', table, target,
+                                       settings))
+                continue
+            elif command == 'set-controllers':
+                for row_uuid, row in sorted(state['controllers'].items()):
+                    changed = _changed(row, operation[1])
+                    if changed:
+                        operations.append(('set-columns', 'Controller',
+                                           row_uuid, changed))
+                continue
+            elif command == 'add-br':
+                _, bridge, settings = operation
+                if bridge in state['bridges']:
+                    changed = _changed(state['bridges'][bridge], settings)
+                    if changed:
+                        operations.append(('set-columns', 'Bridge', bridge,
+                                           changed))
+                    continue
+            elif command == 'add-bond':
+                operations.extend(_pending_bond(operation, state))
+                continue
+            elif command == 'del-port':
+                current = state['ports'].get(operation[2])
+                if current is None:
+                    continue
+                # The native transaction needs the uuid of the port
+                operations.append(('del-port', current.get('bridge'),
+                                   operation[2], current['_uuid']))
+                continue
+            operations.append(operation)
+        return operations
+
+    def commit(self, check=True):
+        '''Apply the batch, skipping the read if check is False
+
+        Returns the operations which were applied.'''
+        if not self.operations:
+            return []
+        client = ovsdb.get_client()
+        if check:
+            tables = set()
+            for operation in self.operations:
+                tables.update(COMMAND_TABLES.get(operation[0], ()))
+            self.operations = self.pending(get_state(client, tables))
+        if not self.operations:
+            return []
+        if client is not None:
+            client.transact(self.ovsdb_operations())
+        else:
+            subprocess.check_call(self.vsctl_args())
+        applied, self.operations = self.operations, []
+        return applied
+
+
+def _vsctl_columns(settings):
+    '''ovs-vsctl column[:key]=value arguments for a dict of columns
+
+    Columns and map keys set to None are left out, to be cleared.'''
+    args = []
+    for column, value in sorted(settings.items()):
+        if isinstance(value, dict):
+            args.extend('{}:{}={}'.format(column, key, value[key])
+                        for key in sorted(value) if value[key] is not None)
+        elif value is not None:
+            args.append('{}={}'.format(column, value))
+    return args
+
+
+def _ovsdb_atom(value):
+    '''OVSDB value of an atomic column, None being the empty set'''
+    if value is None:
+        return ['set', []]
+    if isinstance(value, int):
+        return value
+    return str(value)
+
+
+def _ovsdb_row(settings):
+    '''OVSDB row for a dict of columns, with map values as strings'''
+    row = {}
+    for column, value in settings.items():
+        if isinstance(value, dict):
+            row[column] = ovsdb.py_to_ovs(dict((key, str(val))
+                                               for key, val in value.items()
+                                               if val is not None))
+        else:
+            row[column] = _ovsdb_atom(value)
+    return row
+
+
+def _changed(current, settings):
+    '''The settings which differ from the columns in current'''
+    changed = {}
+    for column, value in settings.items():
+        if isinstance(value, dict):
+            keys = current.get(column) or {}
+            value = dict((key, val) for key, val in value.items()
+                         if keys.get(key) != (None if val is None
+                                              else str(val)))
+            if value:
+                changed[column] = value
+        elif value is None:
+            if current.get(column) not in (None, []):
+                changed[column] = value
+        elif (current.get(column) in (None, []) or
+                str(current[column]) != str(value)):
+            changed[column] = value
+    return changed
+
+
+def _pending_bond(operation, state):
+    '''The operations bringing a bond in line with an add-bond operation
+
+    Changing the members, or moving the bond to another bridge, recreates
+    the port while the port and interface settings are updated in
+    place.'''
+    _, bridge, port, interfaces, settings, if_settings = operation
+    current = state['ports'].get(port)
+    if current is None:
+        return [operation]
+    if (current.get('bridge') != bridge or
+            sorted(current['interfaces']) != sorted(interfaces)):
+        return [('del-port', current.get('bridge'), port, current['_uuid']),
+                operation]
+    operations = []
+    changed = _changed(current, settings)
+    if changed:
+        operations.append(('set-columns', 'Port', port, changed))
+    for interface in interfaces:
+        changed = _changed(state['interfaces'][interface],
+                           if_settings.get(interface, {}))
+        if changed:
+            operations.append(('set-columns', 'Interface', interface,
+                               changed))
+    return operations
 
 
-@cached
-def _get_ovstbl():
-    ovstbl = subprocess.check_output(['ovs-vsctl', 'get',
-                                      'Open_vSwitch', '.',
-                                      '_uuid']).strip()
-    return ovstbl
+def _as_list(value):
+    '''ovs_to_py() value of a set column, which is an atom for one value'''
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def parse_vsctl_json(output):
+    '''Split the output of ovs-vsctl --format=json into tables of rows'''
+    decoder = json.JSONDecoder()
+    tables = []
+    output = output.strip()
+    while output:
+        table, end = decoder.raw_decode(output)
+        tables.append([dict(zip(table['headings'], row))
+                       for row in table['data']])
+        output = output[end:].strip()
+    return tables
+
+
+def get_state(client=None, tables=()):
+    '''Read the switch configuration managed by this charm in one query
+
+    Returns a dict with the other_config and external_ids maps of the
+    Open_vSwitch record, the list of manager targets and the
+    CONNECTION_COLUMNS of each manager by target under
+    'manager_settings'. With TOPOLOGY_TABLES in tables, the rows of every
+    bridge, port and interface are included by name under 'bridges',
+    'ports' and 'interfaces', with references replaced by names and each
+    port naming its 'bridge'. With Controller, the controllers are
+    included by uuid under 'controllers'.'''
+    tables = [table for table in TOPOLOGY_TABLES + ('Controller',)
+              if table in tables]
+    manager_columns = ('target',) + CONNECTION_COLUMNS
+    if client is not None:
+        operations = [
+            {'op': 'select', 'table': 'Open_vSwitch', 'where': [],
+             'columns': list(STATE_COLUMNS)},
+            {'op': 'select', 'table': 'Manager', 'where': [],
+             'columns': list(manager_columns)},
+        ]
+        operations.extend({'op': 'select', 'table': table, 'where': []}
+                          for table in tables)
+        results = [result['rows'] for result in client.transact(operations)]
+    else:
+        args = ['ovs-vsctl', '--format=json',
+                '--columns={}'.format(','.join(STATE_COLUMNS)),
+                'list', 'Open_vSwitch',
+                '--', '--columns={}'.format(','.join(manager_columns)),
+                'list', 'Manager']
+        for table in tables:
+            args.extend(['--', 'list', table])
+        results = parse_vsctl_json(subprocess.check_output(args))
+    switch, managers = results[:2]
+    state = dict((column, ovsdb.ovs_to_py(switch[0][column]) if switch
+                  else {})
+                 for column in STATE_COLUMNS)
+    state['managers'] = [ovsdb.ovs_to_py(row['target']) for row in managers]
+    state['manager_settings'] = dict(
+        (ovsdb.ovs_to_py(row['target']),
+         dict((column, ovsdb.ovs_to_py(row.get(column, ['set', []])))
+              for column in CONNECTION_COLUMNS))
+        for row in managers)
+    rows = dict((table, [dict((column, ovsdb.ovs_to_py(value))
+                              for column, value in row.items())
+                         for row in table_rows])
+                for table, table_rows in zip(tables, results[2:]))
+    if 'Bridge' in rows:
+        bridges, ports, interfaces = [rows[table]
+                                      for table in TOPOLOGY_TABLES]
+        names = dict((row['_uuid'], row['name'])
+                     for row in ports + interfaces)
+        for row in ports:
+            row['interfaces'] = [names[ref]
+                                 for ref in _as_list(row['interfaces'])]
+        state['ports'] = dict((row['name'], row) for row in ports)
+        state['interfaces'] = dict((row['name'], row) for row in interfaces)
+        for row in bridges:
+            row['ports'] = [names[ref] for ref in _as_list(row['ports'])]
+            for port in row['ports']:
+                state['ports'][port]['bridge'] = row['name']
+        state['bridges'] = dict((row['name'], row) for row in bridges)
+    if 'Controller' in rows:
+        state['controllers'] = dict((row['_uuid'], row)
+                                    for row in rows['Controller'])
+    return state
+
+
+def get_controllers(client=None):
+    '''Read the manager targets and bridge controllers in one query
+
+    Returns the list of manager targets and a dict of bridge name to its
+    controller targets.'''
+    if client is not None:
+        results = client.transact([
+            {'op': 'select', 'table': 'Bridge', 'where': [],
+             'columns': ['name', 'controller']},
+            {'op': 'select', 'table': 'Controller', 'where': [],
+             'columns': ['_uuid', 'target']},
+            {'op': 'select', 'table': 'Manager', 'where': [],
+             'columns': ['target']},
+        ])
+        bridges, controllers, managers = [result['rows']
+                                          for result in results]
+    else:
+        bridges, controllers, managers = parse_vsctl_json(
+            subprocess.check_output([
+                'ovs-vsctl', '--format=json',
+                '--columns=name,controller', 'list', 'Bridge',
+                '--', '--columns=_uuid,target', 'list', 'Controller',
+                '--', '--columns=target', 'list', 'Manager']))
+    targets = dict((ovsdb.ovs_to_py(row['_uuid']),
+                    ovsdb.ovs_to_py(row['target'])) for row in controllers)
+    bridge_controllers = {}
+    for row in bridges:
+        refs = ovsdb.ovs_to_py(row['controller'])
+        if not isinstance(refs, list):
+            refs = [refs]
+        bridge_controllers[row['name']] = sorted(targets[ref]
+                                                 for ref in refs)
+    return ([ovsdb.ovs_to_py(row['target']) for row in managers],
+            bridge_controllers)
+
+
+def remove_controllers():
+    '''Remove the manager and all bridge controllers in one transaction
+
+    Returns a dict describing what was removed, with the manager targets
+    under 'managers' and the controller targets of each bridge under
+    'controllers'.'''
+    client = ovsdb.get_client()
+    managers, bridge_controllers = get_controllers(client)
+    removed = dict((bridge, targets)
+                   for bridge, targets in bridge_controllers.items()
+                   if targets)
+    txn = Transaction()
+    if managers:
+        txn.del_manager()
+    txn.del_controller(*sorted(removed))
+    txn.commit(check=False)
+    return {'managers': managers, 'controllers': removed}
+
+
+def _manager(row):
+    return {'target': ovsdb.ovs_to_py(row['target']),
+            'is_connected': row['is_connected'] is True,
+            'status': ovsdb.ovs_to_py(row['status'])}
+
+
+def get_managers(client=None):
+    '''Read the target, connection flag and status map of each manager'''
+    if client is not None:
+        rows = client.list('Manager', columns=MANAGER_COLUMNS)
+    else:
+        rows, = parse_vsctl_json(subprocess.check_output([
+            'ovs-vsctl', '--format=json',
+            '--columns={}'.format(','.join(MANAGER_COLUMNS)),
+            'list', 'Manager']))
+    return [_manager(row) for row in rows]
+
+
+def all_connected(managers):
+    return bool(managers) and all(m['is_connected'] for m in managers)
+
+
+def wait_for_managers(timeout, interval=1):
+    '''Wait up to timeout seconds for every manager to connect
+
+    Uses an OVSDB monitor on the Manager table when ovsdb-server is
+    reachable and polls with ovs-vsctl otherwise. Returns the managers as
+    from get_managers() and the seconds waited for them to connect, which
+    is 0 if they already were and None if the deadline passed.'''
+    start = time.time()
+    deadline = start + timeout
+    client = ovsdb.get_client()
+    if client is not None:
+        initial = client.monitor({'Manager': MANAGER_COLUMNS}, 'managers')
+        rows = dict((row_uuid, change['new'])
+                    for row_uuid, change in initial.get('Manager', {}).items())
+        managers = [_manager(row) for row in rows.values()]
+        connected = all_connected(managers)
+        try:
+            while not all_connected(managers):
+                update = client.wait_for_update(deadline - time.time())
+                if update is None:
+                    break
+                for row_uuid, change in update[1].get('Manager', {}).items():
+                    if 'new' in change:
+                        rows[row_uuid] = change['new']
+                    else:
+                        rows.pop(row_uuid, None)
+                managers = [_manager(row) for row in rows.values()]
+        finally:
+            client.monitor_cancel('managers')
+    else:
+        managers = get_managers()
+        connected = all_connected(managers)
+        while not all_connected(managers) and time.time() < deadline:
+            time.sleep(interval)
+            managers = get_managers()
+    if connected:
+        return managers, 0
+    if all_connected(managers):
+        return managers, time.time() - start
+    return managers, None
+
+
+def update_manager_stats(managers, waited):
+    '''Record the outcome of wait_for_managers() in the unit database
+
+    Keeps the time the last new manager took to connect and counts
+    reconnects, seen as a connection younger than the one recorded by a
+    previous hook.'''
+    db = kv()
+    stats = db.get(MANAGER_STATS_KEY) or {
+        'targets': [], 'connected': False, 'connected-since': None,
+        'time-to-connect': None, 'reconnects': 0}
+    targets = sorted(m['target'] for m in managers)
+    stats['connected'] = waited is not None
+    if waited is not None:
+        age = min(int(m['status'].get('sec_since_connect', 0))
+                  for m in managers)
+        since = time.time() - age
+        if targets != stats['targets']:
+            stats['time-to-connect'] = round(waited, 1)
+        elif since - (stats['connected-since'] or since) > RECONNECT_SLACK:
+            stats['reconnects'] += 1
+        stats['connected-since'] = since
+        stats['targets'] = targets
+    db.set(MANAGER_STATS_KEY, stats)
+    return stats
+
+
+def manager_metrics(stats):
+    '''add-metric arguments for the stats from update_manager_stats()'''
+    metrics = ['manager-connected={}'.format(int(stats['connected'])),
+               'manager-reconnects={}'.format(stats['reconnects'])]
+    if stats['time-to-connect'] is not None:
+        metrics.append('manager-connect-time={}'.format(
+            stats['time-to-connect']))
+    return metrics
+
+
+def default_tuning(cores):
+    '''Defaults for TUNING_KEYS on a host with cores cpus
+
+    Threads are split like ovs-vswitchd does itself, and the flow limit
+    grows with the revalidators available to keep the datapath flows in
+    check.'''
+    revalidators = cores // 4 + 1
+    return {
+        'n-handler-threads': max(cores - revalidators, 1),
+        'n-revalidator-threads': revalidators,
+        'flow-limit': max(200000, 50000 * revalidators),
+        'max-idle': 10000,
+        'max-revalidator': 500,
+    }
+
+
+def restart():
+    '''Restart Open vSwitch, dropping the shared ovsdb-server connection'''
+    ovsdb.reset_client()
+    service_restart('openvswitch-switch')
+
+
+def set_manager(connection_url):
+    '''Configure the OVSDB manager for the switch'''
+    Transaction().set_manager(connection_url).commit()
 
 
 def set_config(key, value, table='other_config'):
     '''Set key value pairs in the other_config table'''
-    subprocess.check_call(
-        ['ovs-vsctl', 'set',
-         'Open_vSwitch', _get_ovstbl(),
-         '{}:{}={}'.format(table, key, value)]
-    )
+    Transaction().set_config(key, value, table=table).commit()
@@ -0,0 +1,204 @@
+'''Minimal OVSDB (RFC 7047) JSON-RPC client
+
+Talks to the local ovsdb-server over its unix socket, so database reads
+and writes do not need to fork ovs-vsctl. Hooks share one connection, see
+get_client().
+'''
+import errno
+import json
+import os
+import select
+import socket
+import time
+
+from charmhelpers.core.hookenv import log
+
+OVSDB_SOCKET = '/var/run/openvswitch/db.sock'
+DATABASE = 'Open_vSwitch'
+RECV_SIZE = 65536
+
+_client = None
+
+
+class OVSDBError(Exception):
+    ''' Errors returned by ovsdb-server, or failures to talk to it '''
+    pass
+
+
+class OVSDBClient(object):
+
+    def __init__(self, path=OVSDB_SOCKET, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        self.next_id = 0
+        self.buffer = ''
+        self.decoder = json.JSONDecoder()
+        # Notifications received for monitors, oldest first
+        self.updates = []
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(path)
+        except socket.error as e:
+            self.sock.close()
+            raise OVSDBError('Unable to connect to {}: {}'.format(path, e))
+
+    def close(self):
+        self.sock.close()
+
+    def _send(self, message):
+        self.sock.sendall(json.dumps(message).encode('utf-8'))
+
+    def _read_message(self, timeout):
+        '''Return the next complete JSON message, or None on timeout'''
+        deadline = time.time() + timeout
+        while True:
+            data = self.buffer.lstrip()
+            if data:
+                try:
+                    message, end = self.decoder.raw_decode(data)
+                except ValueError:
+                    pass
+                else:
+                    self.buffer = data[end:]
+                    return message
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            readable, _, _ = select.select([self.sock], [], [], remaining)
+            if not readable:
+                return None
+            chunk = self.sock.recv(RECV_SIZE)
+            if not chunk:
+                raise OVSDBError('Connection to {} closed'.format(self.path))
+            self.buffer += chunk.decode('utf-8')
+
+    def _dispatch(self, message):
+        '''Handle server initiated messages, returning replies'''
+        method = message.get('method')
+        if method == 'echo':
+            self._send({'id': message['id'], 'result': message['params'],
+                        'error': None})
+        elif method == 'update':
+            self.updates.append(message['params'])
+        elif method is None:
+            return message
+
+    def call(self, method, *params):
+        request_id = self.next_id
+        self.next_id += 1
+        self._send({'method': method, 'params': list(params),
+                    'id': request_id})
+        while True:
+            message = self._read_message(self.timeout)
+            if message is None:
+                raise OVSDBError('Timed out waiting for {}'.format(method))
+            reply = self._dispatch(message)
+            if reply is not None and reply.get('id') == request_id:
+                if reply.get('error'):
+                    raise OVSDBError('{} failed: {}'.format(
+                        method, reply['error']))
+                return reply['result']
+
+    def list_dbs(self):
+        return self.call('list_dbs')
+
+    def transact(self, operations, database=DATABASE):
+        '''Run operations in one transaction, returning their results'''
+        results = self.call('transact', database, *operations)
+        for operation, result in zip(operations, results):
+            if result and result.get('error'):
+                raise OVSDBError('{} on {} failed: {} {}'.format(
+                    operation['op'], operation.get('table'),
+                    result['error'], result.get('details', '')))
+        if len(results) > len(operations) and results[-1]:
+            # The commit itself failed, e.g. a constraint violation
+            raise OVSDBError('Transaction failed: {}'.format(results[-1]))
+        return results
+
+    def list(self, table, columns=None, where=None, database=DATABASE):
+        '''Return the rows of table, like ovs-vsctl list'''
+        operation = {'op': 'select', 'table': table, 'where': where or []}
+        if columns:
+            operation['columns'] = list(columns)
+        return self.transact([operation], database)[0]['rows']
+
+    def monitor(self, tables, monitor_id=None, database=DATABASE):
+        '''Monitor columns of tables, given as a dict of table to columns
+
+        Returns the initial contents; later changes are collected by
+        wait_for_update().'''
+        requests = dict((table, {'columns': list(columns)})
+                        for table, columns in tables.items())
+        return self.call('monitor', database, monitor_id, requests)
+
+    def monitor_cancel(self, monitor_id):
+        self.call('monitor_cancel', monitor_id)
+        self.updates = [update for update in self.updates
+                        if update[0] != monitor_id]
+
+    def wait_for_update(self, timeout):
+        '''Return the next monitor update, or None after timeout'''
+        deadline = time.time() + timeout
+        while not self.updates:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            message = self._read_message(remaining)
+            if message is not None:
+                self._dispatch(message)
+        return self.updates.pop(0)
+
+
+def get_client(path=None):
+    '''Connection shared for the duration of the hook
+
+    Returns None if ovsdb-server is not reachable, in which case callers
+    fall back to ovs-vsctl.'''
+    global _client
+    if _client is None:
+        path = path or OVSDB_SOCKET
+        if not os.path.exists(path):
+            return None
+        try:
+            _client = OVSDBClient(path)
+        except OVSDBError as e:
+            log('Falling back to ovs-vsctl: {}'.format(e))
+            return None
+    return _client
+
+
+def reset_client():
+    global _client
+    if _client is not None:
+        try:
+            _client.close()
+        except socket.error as e:
+            if e.errno != errno.EBADF:
+                raise
+    _client = None
+
+
+def py_to_ovs(value):
+    '''Convert python maps and lists into OVSDB JSON notation'''
+    if isinstance(value, dict):
+        return ['map', [[k, py_to_ovs(v)] for k, v in sorted(value.items())]]
+    if isinstance(value, (list, tuple, set)):
+        return ['set', [py_to_ovs(v) for v in value]]
+    return value
+
+
+def ovs_to_py(value):
+    '''Convert OVSDB JSON notation into python dicts and lists
+
+    Sets are always returned as lists, including single atoms, and uuids
+    as their string form.'''
+    if isinstance(value, list) and len(value) == 2:
+        kind, data = value
+        if kind == 'map':
+            return dict((ovs_to_py(k), ovs_to_py(v)) for k, v in data)
+        if kind == 'set':
+            return [ovs_to_py(v) for v in data]
+        if kind in ('uuid', 'named-uuid'):
+            return data
+    return value
@@ -1,16 +1,25 @@
-import subprocess
+import multiprocessing
+import os
 
 from socket import gethostname
 
+import netaddr
+
 import lib.ODL as ODL
 import lib.PCIDev as PCIDev
+import lib.dpdk as dpdk
+import lib.hugepages as hugepages
+import lib.hotplug as hotplug
 import lib.ovs as ovs
 
 from charmhelpers.contrib.network.ip import get_address_in_network
+from charmhelpers.contrib.network.ip import get_iface_from_addr
 from charmhelpers.core.hookenv import config
 from charmhelpers.core.hookenv import log
 from charmhelpers.core.hookenv import status_set
 from charmhelpers.core.hookenv import unit_private_ip
+from charmhelpers.core.host import get_nic_mtu
+from charmhelpers.core.host import set_nic_mtu
 from charmhelpers.core.reactive import hook
 from charmhelpers.core.reactive import when
 from charmhelpers.core.reactive import when_not
@@ -22,6 +31,299 @@ from charmhelpers.fetch import filter_installed_packages
 
 # Packages to install/remove
 PACKAGES = ['openvswitch-switch']
+# Seconds to wait for Open vSwitch to connect to the ODL OVSDB manager
+MANAGER_CONNECT_TIMEOUT = 30
+# Bounds accepted for the mtu option
+MIN_MTU = 1280
+MAX_MTU = 9216
+# VXLAN encapsulation overhead by IP version of the data network
+VXLAN_OVERHEAD = {4: 50, 6: 70}
+# Values accepted for the bond-mode, bond-lacp and bond-lacp-time options
+BOND_MODES = ('balance-tcp', 'balance-slb', 'active-backup')
+LACP_MODES = ('active', 'passive', 'off')
+LACP_TIMES = ('fast', 'slow')
+# Open vSwitch side of vhost-user connections, by the QEMU side
+VHOST_USER_MODES = {'client': 'server', 'server': 'client'}
+# Prefix neutron gives the names of vhost-user ports and their sockets
+VHOST_USER_PREFIX = 'vhu'
+
+
+def get_data_interface():
+    '''Interface and local address on the os-data-network
+
+    Where several NICs have an address on the network, the fastest link is
+    preferred. The interface is None if the address is not configured on
+    one.'''
+    network = config('os-data-network')
+    candidates = PCIDev.get_addresses_in_network(network)
+    if len(candidates) > 1:
+        net_devices = PCIDev.PCINetDevices.load()
+        interface = net_devices.get_preferred_interface(list(candidates))
+        log('Using {} on {} for the data network'.format(
+            candidates[interface], interface))
+        return interface, candidates[interface]
+    address = get_address_in_network(network, unit_private_ip())
+    try:
+        return get_iface_from_addr(address), address
+    except Exception:
+        # charmhelpers raises a bare Exception for unconfigured addresses
+        return None, address
+
+
+def get_local_ip():
+    '''Local address on the os-data-network'''
+    return get_data_interface()[1]
+
+
+def set_dpdk_config(txn, pci_info):
+    '''Add the DPDK datapath settings to txn, or their removal
+
+    The settings are left as they are when a NUMA node hosting a data NIC
+    would get no PMD cpus, as a pmd-cpu-mask of 0x0 stops them polling.'''
+    db = kv()
+    if config('enable-dpdk'):
+        devices = pci_info.get('devices', {}).values()
+        pmd_cores = config('dpdk-pmd-cores')
+        if (pmd_cores or 0) < 1:
+            db.set('dpdk-pmd', {'error': 'dpdk-pmd-cores {} is not 1 or '
+                                         'more'.format(pmd_cores)})
+            return
+        pmd_cpus = dpdk.get_pmd_cpus(devices, pmd_cores)
+        empty = sorted(node for node, cpus in pmd_cpus.items() if not cpus)
+        if empty:
+            db.set('dpdk-pmd', {
+                'error': 'no cpus left for PMD threads on NUMA node '
+                         '{}'.format(', '.join(map(str, empty)))})
+            return
+        db.unset('dpdk-pmd')
+        vhost_user = db.get('vhost-user') or {}
+        settings = dpdk.get_dpdk_config(
+            devices, config('dpdk-socket-memory'), pmd_cores,
+            vhost_user.get('socket-dir', dpdk.OVS_RUNDIR))
+        settings.update(dpdk.get_pmd_config(
+            pmd_cpus,
+            auto_lb=config('dpdk-pmd-auto-lb'),
+            emc_insert_inv_prob=config('dpdk-emc-insert-inv-prob'),
+            smc_enable=config('dpdk-smc-enable'),
+            pinned=config('dpdk-pin-rx-queues')))
+        for key in dpdk.CONFIG_KEYS:
+            txn.set_config(key, settings[key])
+    else:
+        db.unset('dpdk-pmd')
+        for key in dpdk.CONFIG_KEYS:
+            txn.remove_config(key)
+
+
+def set_bond_config(txn, pci_info):
+    '''Add the data-bond of the mapped NICs to txn, recording its members
+
+    DPDK members are named after their mac, which stays stable once the
+    NIC is bound to a userspace driver, and get their rx queue settings
+    from the PMD cpus of their NUMA node.'''
+    db = kv()
+    bond = config('data-bond')
+    # The bond last added, removed once renamed or no longer wanted
+    applied = db.get('bond-port')
+    if not bond:
+        db.unset('bond')
+        if applied:
+            txn.del_port(applied['bridge'], applied['name'])
+            db.unset('bond-port')
+        return
+    mode, lacp = config('bond-mode'), config('bond-lacp')
+    lacp_time = config('bond-lacp-time')
+    for option, value, allowed in (('bond-mode', mode, BOND_MODES),
+                                   ('bond-lacp', lacp, LACP_MODES),
+                                   ('bond-lacp-time', lacp_time, LACP_TIMES)):
+        if value not in allowed:
+            db.set('bond', {'error': 'invalid {} {}, not one of {}'.format(
+                option, value, ', '.join(allowed))})
+            return
+    enable_dpdk = config('enable-dpdk')
+    devices = pci_info.get('devices', {})
+    if enable_dpdk:
+        port_config = dpdk.get_port_config(
+            devices,
+            dpdk.get_pmd_cpus(devices.values(), config('dpdk-pmd-cores')),
+            n_rxq=config('dpdk-rx-queues'),
+            pinned=config('dpdk-pin-rx-queues'))
+    interfaces, interface_settings, macs = [], {}, []
+    for mac in sorted(devices):
+        if enable_dpdk:
+            interface = 'dpdk-{}'.format(mac.replace(':', ''))
+            interface_settings[interface] = port_config[mac]
+        else:
+            interface = devices[mac]['interface']
+        if interface:
+            interfaces.append(interface)
+            macs.append(mac)
+    if len(interfaces) < 2:
+        db.set('bond', {'error': 'data-bond {} needs 2 or more NICs from '
+                                 'mac-network-map, found {}'.format(
+                                     bond, len(interfaces))})
+        return
+    bridge = config('data-bond-bridge')
+    if applied and applied['name'] != bond:
+        # Frees the members before they join the new bond
+        txn.del_port(applied['bridge'], applied['name'])
+    txn.add_bridge(bridge, {'datapath_type': 'netdev' if enable_dpdk
+                            else 'system'})
+    txn.add_bond(bridge, bond, interfaces, {
+        'bond_mode': mode,
+        'lacp': lacp,
+        'other_config': {
+            'bond-rebalance-interval': config('bond-rebalance-interval'),
+            'lacp-time': lacp_time,
+        },
+    }, interface_settings)
+    db.set('bond', {'name': bond, 'bridge': bridge, 'mode': mode,
+                    'lacp': lacp, 'interfaces': interfaces, 'macs': macs})
+    db.set('bond-port', {'name': bond, 'bridge': bridge})
+
+
+def set_tuning_config(txn):
+    '''Add the handler and revalidator tuning to txn, options left at 0
+    taking defaults computed from the core count'''
+    defaults = ovs.default_tuning(multiprocessing.cpu_count())
+    for key in ovs.TUNING_KEYS:
+        txn.set_config(key, config(key) or defaults[key])
+
+
+def _blocked(message):
+    '''Set a blocked status of message, capitalised'''
+    status_set('blocked', message[0].upper() + message[1:])
+
+
+def _kv_status(key, describe=None):
+    '''Status of the state a configure step recorded in kv under key
+
+    Returns None when nothing is recorded, False and the error if one was
+    recorded, otherwise whatever describe(state) returns: whether the
+    state is usable and a summary of it, or None.'''
+    state = kv().get(key)
+    if not state:
+        return None
+    if state.get('error'):
+        return False, state['error']
+    return describe(state) if describe else None
+
+
+def bond_status():
+    '''Status of the bond added by set_bond_config'''
+    return _kv_status('bond', lambda state: (
+        True, '{} of {} ({}, lacp {})'.format(
+            state['name'], ', '.join(state['interfaces']), state['mode'],
+            state['lacp'])))
+
+
+def _describe_hugepages(state):
+    short = ['node {} {}/{}'.format(node, allocated, requested)
+             for node, requested, allocated in state['nodes']
+             if allocated < requested]
+    if short:
+        return False, 'only {} {} hugepages allocated'.format(
+            ', '.join(short), state['size'])
+    if not state['mounted']:
+        return False, 'hugetlbfs not mounted at {}'.format(
+            hugepages.HUGEPAGES_MOUNT)
+    return True, '{} {} hugepages'.format(
+        sum(requested for _, requested, _ in state['nodes']), state['size'])
+
+
+def hugepages_status():
+    '''Status of the hugepage reservation made by configure_hugepages'''
+    return _kv_status('hugepages', _describe_hugepages)
+
+
+def dpdk_pmd_status():
+    '''Status of PMD cpus set_dpdk_config could not place'''
+    return _kv_status('dpdk-pmd')
+
+
+def mtu_status():
+    '''Status of the data interface MTU recorded by configure_mtu'''
+    return _kv_status('mtu', lambda state: (
+        True, 'mtu {} on {}'.format(state['mtu'], state['interface'])))
+
+
+def sriov_status():
+    '''Status of an invalid sriov-numvfs rejected by configure_sriov'''
+    return _kv_status('sriov')
+
+
+def _describe_nic_queues(state):
+    if state['failed']:
+        return True, '{} not supported by {}'.format(
+            ', '.join(state['failed']), state['interface'])
+
+
+def nic_queues_status():
+    '''Status of queue tuning configure_nic_queues could not apply'''
+    return _kv_status('nic-queues', _describe_nic_queues)
+
+
+def _describe_offloads(state):
+    message = '{} offloads on {}'.format(state['profile'],
+                                         state['interface'])
+    if state['unapplied']:
+        message += ' except {}'.format(', '.join(state['unapplied']))
+    return True, message
+
+
+def offloads_status():
+    '''Status of the offload profile applied by configure_offloads'''
+    return _kv_status('offloads', _describe_offloads)
+
+
+def vhost_user_status():
+    '''Status of the vhost-user socket layout set by configure_vhost_user'''
+    return _kv_status('vhost-user', lambda state: (
+        True, 'vhost-user {} mode in {}'.format(state['mode'],
+                                                state['socket-dir'])))
+
+
+# Checked in order for the workload status, the first not ready blocking
+STATUS_CHECKS = (hugepages_status, dpdk_pmd_status, mtu_status,
+                 sriov_status, nic_queues_status, offloads_status,
+                 bond_status, vhost_user_status)
+
+
+def get_vhost_user_details():
+    '''vhost-user binding details for nova, in the form of the vif_details
+    of neutron vhostuser ports, and the flavor extra specs guests need
+
+    vhost-user guests must have their memory in shared hugepages, of the
+    size reserved by configure_hugepages where the charm manages them.'''
+    state = kv().get('vhost-user')
+    if not state or state.get('error'):
+        return None
+    socket_dir = state['socket-dir']
+    page_size = 'large'
+    pages = kv().get('hugepages')
+    if pages and not pages.get('error'):
+        page_size = str(hugepages.parse_size(pages['size']))
+    return {
+        'vif_type': 'vhostuser',
+        'vif_details': {
+            'vhostuser_socket_dir': socket_dir,
+            'vhostuser_socket': os.path.join(
+                socket_dir, VHOST_USER_PREFIX + '$PORT_ID'),
+            'vhostuser_mode': VHOST_USER_MODES[state['mode']],
+            'vhostuser_ovs_plug': True,
+            'has_datapath_type_netdev': True,
+            'port_prefix': VHOST_USER_PREFIX,
+        },
+        'flavor_extra_specs': {'hw:mem_page_size': page_size},
+    }
+
+
+def get_tenant_mtu():
+    '''MTU left to tenant networks once tunnel headers are added'''
+    state = kv().get('mtu')
+    if not state or state.get('error'):
+        return None
+    version = netaddr.IPAddress(state['address']).version
+    return state['mtu'] - VXLAN_OVERHEAD[version]
 
 
 @when('ovsdb-manager.access.available')
@@ -32,15 +334,59 @@ def configure_openvswitch(odl_ovsdb):
     if db.get('installed') and odl_ovsdb.connection_string():
         log("Configuring OpenvSwitch with ODL OVSDB controller: %s" %
             odl_ovsdb.connection_string())
-        local_ip = get_address_in_network(config('os-data-network'),
-                                          unit_private_ip())
-        ovs.set_config('local_ip', local_ip)
-        ovs.set_config('controller-ips', odl_ovsdb.private_address(),
+        local_ip = get_local_ip()
+        txn = ovs.Transaction()
+        txn.set_config('local_ip', local_ip)
+        txn.set_config('controller-ips', odl_ovsdb.private_address(),
                        table='external_ids')
-        ovs.set_config('host-id', gethostname(),
+        txn.set_config('host-id', gethostname(),
                        table='external_ids')
-        ovs.set_manager(odl_ovsdb.connection_string())
-        status_set('active', 'Open vSwitch configured and ready')
+        txn.set_manager(odl_ovsdb.connection_string(),
+                        **odl_ovsdb.connection_options(
+                            inactivity_probe=config(
+                                'manager-inactivity-probe'),
+                            max_backoff=config('manager-max-backoff')))
+        txn.set_controllers(
+            inactivity_probe=config('controller-inactivity-probe') or None,
+            max_backoff=config('controller-max-backoff') or None)
+        set_tuning_config(txn)
+        pci_info = {}
+        if config('enable-dpdk') or config('data-bond'):
+            try:
+                pci_info = PCIDev.PCIInfo()
+            except PCIDev.MacNetworkMapError as e:
+                _blocked('Invalid mac-network-map: {}'.format(e))
+                return
+        set_dpdk_config(txn, pci_info)
+        set_bond_config(txn, pci_info)
+        applied = txn.commit()
+        if any(operation[0] in ('set', 'remove') and
+               operation[4] in dpdk.EAL_KEYS for operation in applied):
+            log('DPDK EAL options changed, restarting Open vSwitch')
+            ovs.restart()
+        managers, waited = ovs.wait_for_managers(MANAGER_CONNECT_TIMEOUT)
+        stats = ovs.update_manager_stats(managers, waited)
+        if not stats['connected']:
+            status_set('waiting',
+                       'Open vSwitch configured, not connected to the ODL '
+                       'OVSDB manager after {}s'.format(
+                           MANAGER_CONNECT_TIMEOUT))
+            return
+        details = ['{} reconnects'.format(stats['reconnects'])]
+        if stats['time-to-connect'] is not None:
+            details.insert(0, 'connected in {}s'.format(
+                stats['time-to-connect']))
+        for check in STATUS_CHECKS:
+            result = check()
+            if result is None:
+                continue
+            ready, message = result
+            if not ready:
+                _blocked('Open vSwitch configured, {}'.format(message))
+                return
+            details.append(message)
+        status_set('active', 'Open vSwitch configured and ready '
+                   '({})'.format(', '.join(details)))
 
 
 @when_not('ovsdb-manager.access.available')
@@ -48,19 +394,18 @@ def unconfigure_openvswitch(odl_ovsdb=None):
     db = kv()
     if db.get('installed'):
         log("Unconfiguring OpenvSwitch")
-        subprocess.check_call(['ovs-vsctl', 'del-manager'])
-        bridges = subprocess.check_output(['ovs-vsctl',
-                                           'list-br']).split()
-        for bridge in bridges:
-            subprocess.check_call(['ovs-vsctl',
-                                   'del-controller', bridge])
+        removed = ovs.remove_controllers()
+        log('Removed managers {} and the controllers of {} bridges: '
+            '{}'.format(', '.join(removed['managers']) or 'none',
+                        len(removed['controllers']),
+                        ', '.join(sorted(removed['controllers']))))
         status_set('waiting',
                    'Open vSwitch not configured with an ODL OVSDB controller')
 
 
 @when_not('ovsdb-manager.connected')
 def no_ovsdb_manager(odl_ovsdb=None):
-    status_set('blocked', 'Not related to an OpenDayLight OVSDB controller')
+    _blocked('Not related to an OpenDayLight OVSDB controller')
 
 
 @when('neutron-plugin.connected')
@@ -83,7 +428,9 @@ def configure_neutron_plugin(neutron_plugin):
                     }
                 }
             }
-        })
+        },
+        mtu=get_tenant_mtu(),
+        vhost_user=get_vhost_user_details())
 
 
 @hook('install')
@@ -95,11 +442,195 @@ def install_packages():
         db.set('installed', True)
 
 
+@hook('{config-changed,start}')
+def configure_hotplug_watcher():
+    if config('nic-hotplug-watcher'):
+        if hotplug.start_watcher():
+            log('Started NIC hotplug watcher')
+    elif hotplug.stop_watcher():
+        log('Stopped NIC hotplug watcher')
+
+
+@hook('{config-changed,start}')
+def configure_sriov():
+    db = kv()
+    numvfs = config('sriov-numvfs')
+    if not numvfs:
+        db.unset('sriov')
+        return
+    try:
+        PCIDev.parse_sriov_numvfs(numvfs)
+    except PCIDev.SriovConfigError as e:
+        db.set('sriov', {'error': 'invalid sriov-numvfs {}: {}'.format(
+            numvfs, e)})
+        _blocked('Invalid sriov-numvfs {}'.format(numvfs))
+        return
+    db.unset('sriov')
+    net_devices = PCIDev.PCINetDevices.load()
+    if net_devices.configure_sriov(numvfs):
+        log('Updated SR-IOV VF counts')
+
+
+@hook('{config-changed,start}')
+def configure_mtu():
+    '''Apply the mtu option to the data interface, recording the MTU'''
+    db = kv()
+    mtu = config('mtu')
+    if mtu and not MIN_MTU <= mtu <= MAX_MTU:
+        db.set('mtu', {'error': 'mtu {} is not between {} and {}'.format(
+            mtu, MIN_MTU, MAX_MTU)})
+        _blocked('Invalid mtu {}'.format(mtu))
+        return
+    interface, address = get_data_interface()
+    if interface is None:
+        if mtu:
+            db.set('mtu', {'error': 'no interface found for {}'.format(
+                address)})
+            _blocked('No interface found for {}'.format(address))
+        else:
+            db.unset('mtu')
+        return
+    if mtu and get_nic_mtu(interface) != str(mtu):
+        log('Setting mtu {} on {}'.format(mtu, interface))
+        set_nic_mtu(interface, str(mtu))
+    current = int(get_nic_mtu(interface) or 0)
+    state = {'interface': interface, 'address': address, 'mtu': current}
+    if mtu and current != mtu:
+        state['error'] = 'data interface {} has mtu {}, not {}'.format(
+            interface, current, mtu)
+        _blocked(state['error'])
+    db.set('mtu', state)
+
+
+@hook('{config-changed,start}')
+def configure_nic_queues():
+    tuning = {
+        'channels': config('nic-channels'),
+        'rss_queues': config('nic-rss-queues'),
+        'queue_cpus': config('nic-queue-affinity'),
+    }
+    db = kv()
+    if not any(tuning.values()):
+        db.unset('nic-queues')
+        return
+    interface = get_data_interface()[0]
+    if interface is None:
+        db.unset('nic-queues')
+        return
+    net_devices = PCIDev.PCINetDevices.load()
+    result = net_devices.tune_queues(interface, **tuning)
+    if result is None:
+        log('{} is not a PCI network device, not tuning its '
+            'queues'.format(interface))
+        db.unset('nic-queues')
+        return
+    changed, failed = result
+    if changed:
+        log('Tuned {} of {}'.format(', '.join(changed), interface))
+    db.set('nic-queues', {'interface': interface, 'failed': failed})
+
+
+@hook('{config-changed,start}')
+def configure_offloads():
+    db = kv()
+    profile = config('offload-profile')
+    if not profile:
+        db.unset('offloads')
+        return
+    if profile not in PCIDev.OFFLOAD_PROFILES:
+        db.set('offloads', {'error': 'unknown offload-profile {}'.format(
+            profile)})
+        _blocked('Unknown offload-profile {}'.format(profile))
+        return
+    interface = get_data_interface()[0]
+    if interface is None:
+        db.unset('offloads')
+        return
+    net_devices = PCIDev.PCINetDevices.load()
+    pcidev = net_devices.get_device_from_interface(interface)
+    if pcidev is None:
+        log('{} is not a PCI network device, not setting '
+            'offloads'.format(interface))
+        db.unset('offloads')
+        return
+    unapplied = pcidev.set_offloads(profile)
+    if unapplied:
+        log('{} could not be set on {}'.format(', '.join(unapplied),
+                                               interface))
+    db.set('offloads', {'profile': profile, 'interface': interface,
+                        'unapplied': unapplied})
+
+
+@hook('{config-changed,start}')
+def configure_hugepages():
+    db = kv()
+    if not config('hugepages'):
+        db.unset('hugepages')
+        return
+    try:
+        size = hugepages.parse_size(config('hugepage-size'))
+        counts = hugepages.parse_counts(config('hugepages'),
+                                        dpdk.get_numa_nodes())
+        allocated = hugepages.allocate(counts, size)
+    except hugepages.HugepagesError as e:
+        db.set('hugepages', {
+            'error': 'invalid hugepages configuration: {}'.format(e)})
+    else:
+        db.set('hugepages', {
+            'size': hugepages.format_size(size),
+            'nodes': [(node, counts[node], allocated[node])
+                      for node in sorted(counts)],
+            'mounted': hugepages.mount_hugetlbfs(size),
+        })
+    ready, message = hugepages_status()
+    if not ready:
+        _blocked(message)
+
+
+@hook('{config-changed,start}')
+def configure_vhost_user():
+    '''Create the vhost-user socket directory, recording the layout'''
+    db = kv()
+    if not config('enable-dpdk'):
+        db.unset('vhost-user')
+        return
+    socket_dir = config('vhost-user-socket-dir')
+    mode = config('vhost-user-mode')
+    try:
+        if mode not in VHOST_USER_MODES:
+            raise ValueError('unknown vhost-user-mode {}'.format(mode))
+        dpdk.get_vhost_sock_dir(socket_dir)
+    except ValueError as e:
+        db.set('vhost-user', {'error': str(e)})
+        _blocked(str(e))
+        return
+    dpdk.make_socket_dir(socket_dir)
+    db.set('vhost-user', {'socket-dir': socket_dir, 'mode': mode})
+
+
+@hook('config-changed')
+def configure_dpdk_packages():
+    db = kv()
+    enable = bool(config('enable-dpdk'))
+    if not db.get('installed') or enable == bool(db.get('dpdk')):
+        return
+    if enable:
+        status_set('maintenance', 'Installing DPDK packages')
+        apt_install(filter_installed_packages(dpdk.PACKAGES))
+    dpdk.select_vswitchd(enable)
+    ovs.restart()
+    db.set('dpdk', enable)
+
+
 @hook('stop')
 def uninstall_packages():
     db = kv()
+    hotplug.stop_watcher()
     if db.get('installed'):
         status_set('maintenance', 'Purging packages')
+        if db.get('dpdk'):
+            apt_purge(dpdk.PACKAGES)
+            db.unset('dpdk')
         apt_purge(PACKAGES)
         db.unset('installed')
 
@@ -113,8 +644,7 @@ def odl_node_registration(controller=None):
         if odl.is_device_registered(device_name):
             log('{} is already registered in odl'.format(device_name))
         else:
-            local_ip = get_address_in_network(config('os-data-network'),
-                                              unit_private_ip())
+            local_ip = get_local_ip()
             log('Registering {} ({}) in odl'.format(
                 device_name, local_ip))
             odl.odl_register_node(device_name, local_ip)
@@ -124,21 +654,50 @@ def odl_node_registration(controller=None):
 def odl_register_macs(controller=None):
     """ Register local interfaces and their networks with ODL """
     if controller and controller.connection():
+        db = kv()
+        registration = {
+            'generation': hotplug.current_generation(),
+            'mac-network-map': config('mac-network-map'),
+            'controller': controller.connection()['host'],
+            'data-bond': config('data-bond'),
+        }
+        if (registration['generation'] is not None and
+                db.get('odl-mac-registration') == registration):
+            log('No NIC changes since last registration with odl')
+            return
         log('Looking for macs to register with networks in odl')
         odl = ODL.ODLConfig(**controller.connection())
         device_name = gethostname()
-        requested_config = PCIDev.PCIInfo()['local_config']
+        try:
+            requested_config = PCIDev.PCIInfo()['local_config']
+        except PCIDev.MacNetworkMapError as e:
+            _blocked('Invalid mac-network-map: {}'.format(e))
+            return
+        registered = odl.get_registered_interfaces(device_name,
+                                                   device_type='ovs')
+        requested = []
         for mac in requested_config.keys():
             for requested_net in requested_config[mac]:
-                net = requested_net['net']
-                interface = requested_net['interface']
-                if not odl.is_net_device_registered(net, device_name,
-                                                    interface, mac,
-                                                    device_type='ovs'):
-                    log('Registering {} and {} on '
-                        '{}'.format(net, interface, mac))
-                    odl.odl_register_macs(device_name, net, interface, mac,
-                                          device_type='ovs')
-                else:
-                    log('{} already registered for {} on '
-                        '{}'.format(net, interface, device_name))
+                requested.append((requested_net['net'],
+                                  requested_net['interface'], mac))
+        bond = db.get('bond') or {}
+        if bond.get('macs'):
+            # The members carry traffic for the bond port, which is
+            # registered in their place under the mac of the first
+            requested = [entry for entry in requested
+                         if entry[2] not in bond['macs']]
+            mac_map = PCIDev.parse_mac_network_map(config('mac-network-map'))
+            for net in sorted(set(conf['net'] for mac in bond['macs']
+                                  for conf in mac_map.get(mac, []))):
+                requested.append((net, bond['name'], bond['macs'][0]))
+        pending = {}
+        for net, interface, mac in requested:
+            if (net, interface, mac) in registered:
+                log('{} already registered for {} on '
+                    '{}'.format(net, interface, device_name))
+            else:
+                pending.setdefault(net, []).append((interface, mac))
+        for net, interfaces in pending.items():
+            odl.odl_register_macs_bulk(device_name, net, interfaces,
+                                       device_type='ovs')
+        db.set('odl-mac-registration', registration)
@@ -16,10 +16,14 @@ class NeutronPluginProvides(RelationBase):
     def broken(self):
         self.remove_state('{relation_name}.connected')
 
-    def configure_plugin(self, plugin, config):
+    def configure_plugin(self, plugin, config, mtu=None, vhost_user=None):
         conversation = self.conversation()
         relation_info = {
             'neutron-plugin': plugin,
             'subordinate_configuration': json.dumps(config),
         }
+        if mtu:
+            relation_info['network-device-mtu'] = mtu
+        if vhost_user:
+            relation_info['vhost-user'] = json.dumps(vhost_user)
         conversation.set_remote(**relation_info)
@@ -5,7 +5,8 @@ from charmhelpers.core.reactive import scopes
 
 class OVSDBManagerRequires(RelationBase):
     scope = scopes.GLOBAL
-    auto_accessors = ['protocol', 'private-address', 'host', 'port']
+    auto_accessors = ['protocol', 'private-address', 'host', 'port',
+                      'inactivity-probe', 'max-backoff']
 
     @hook('{requires:ovsdb-manager}-relation-{joined,changed,departed}')
     def changed(self):
@@ -36,3 +37,18 @@ class OVSDBManagerRequires(RelationBase):
             return "{protocol}:{host}:{port}".format(**data)
         else:
             return None
+
+    def connection_options(self, inactivity_probe=None, max_backoff=None):
+        """Open vSwitch connection options
+
+        Returns the Manager columns to set along with the connection
+        string, in milliseconds. The values given take precedence over
+        those presented by the remote ODL controller; options neither
+        sets are None, leaving the Open vSwitch defaults.
+        """
+        options = {
+            'inactivity_probe': inactivity_probe or self.inactivity_probe(),
+            'max_backoff': max_backoff or self.max_backoff(),
+        }
+        return dict((key, int(value) if value else None)
+                    for key, value in options.items())
@@ -0,0 +1,90 @@
+'''Benchmark PCI/netdev discovery against synthetic hosts
+
+Usage, from the charm root:
+
+    python unit_tests/bench_pcidev.py [--workers N] [devices ...]
+
+For each host size, reports the wall time and the subprocesses spawned
+(lspci, uname, ip, confd_cli and juju-log) for a full scan, a load from a
+valid persisted inventory, and a lazy PCIInfo for two mapped MACs.
+'''
+import argparse
+import collections
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+sys.path.insert(0, 'hooks')
+
+from charmhelpers.core import hookenv
+from charmhelpers.core import unitdata
+
+import lib.PCIDev as PCIDev
+from unit_tests.fake_sysfs import make_host
+
+SIZES = [8, 64, 512, 4096]
+# Roughly the number of pci aliases in a stock kernel
+ALIAS_PADDING = 20000
+
+
+def measure(host, func):
+    hookenv.cache.clear()
+    host.reset_calls()
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    return result, elapsed, collections.Counter(host.calls())
+
+
+def format_calls(calls):
+    return ' '.join('{}={}'.format(name, count)
+                    for name, count in sorted(calls.items())) or '-'
+
+
+def bench(devices, workers=1):
+    root = tempfile.mkdtemp()
+    try:
+        host = make_host(root, devices, alias_padding=ALIAS_PADDING)
+        host.activate(PCIDev)
+        unitdata._KV = None
+        options = {'mac-network-map': None, 'pci-probe-workers': workers}
+        PCIDev.config = options.get
+        net_devices, full, full_calls = measure(host, PCIDev.PCINetDevices)
+        net_devices.save()
+        _, cached, cached_calls = measure(host, PCIDev.PCINetDevices.load)
+        macs = [pcidev.mac_address for pcidev in net_devices.pci_devices
+                if pcidev.state == 'down'][:2]
+        options['mac-network-map'] = ' '.join(
+            'mac={};net=physnet1'.format(mac) for mac in macs)
+        unitdata.kv().unset(PCIDev.INVENTORY_KEY)
+        _, lazy, lazy_calls = measure(host, PCIDev.PCIInfo)
+        return [
+            (len(net_devices.pci_devices), 'full', full, full_calls),
+            (len(net_devices.pci_devices), 'cached', cached, cached_calls),
+            (len(net_devices.pci_devices), 'lazy', lazy, lazy_calls),
+        ]
+    finally:
+        shutil.rmtree(root)
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('devices', type=int, nargs='*')
+    args = parser.parse_args(args)
+    sizes = args.devices or SIZES
+    print('{:>8} {:>7} {:>10}  {}'.format('devices', 'mode', 'seconds',
+                                          'subprocesses'))
+    for size in sizes:
+        for devices, mode, elapsed, calls in bench(size, args.workers):
+            print('{:>8} {:>7} {:>10.3f}  {}'.format(
+                devices, mode, elapsed, format_calls(calls)))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,375 @@
+'''An in-memory ovsdb-server speaking enough RFC 7047 for the unit tests
+
+    server = FakeOVSDB(path)
+    server.start()
+    ... point lib.ovsdb at path ...
+    server.stop()
+
+Rows are kept as python values: dicts for maps, lists for sets and
+('uuid', id) tuples for references. Port, Interface, Manager and
+Controller rows which are no longer referenced are garbage collected, and
+the unique indexes of the real schema are enforced.
+'''
+import copy
+import json
+import os
+import socket
+import threading
+import uuid
+
+GC_TABLES = ('Port', 'Interface', 'Manager', 'Controller')
+# Column of each table whose values must be unique
+INDEXES = {'Bridge': 'name', 'Port': 'name', 'Interface': 'name',
+           'Manager': 'target'}
+
+
+def from_json(value, names=None):
+    if isinstance(value, list) and len(value) == 2:
+        kind, data = value
+        if kind == 'map':
+            return dict((from_json(k, names), from_json(v, names))
+                        for k, v in data)
+        if kind == 'set':
+            return [from_json(v, names) for v in data]
+        if kind == 'uuid':
+            return ('uuid', data)
+        if kind == 'named-uuid':
+            return ('uuid', names[data])
+    return value
+
+
+def to_json(value):
+    if isinstance(value, dict):
+        return ['map', [[to_json(k), to_json(v)]
+                        for k, v in sorted(value.items())]]
+    if isinstance(value, list):
+        return ['set', [to_json(v) for v in value]]
+    if isinstance(value, tuple):
+        return list(value)
+    return value
+
+
+def as_set(value):
+    if isinstance(value, list):
+        return value
+    if value is None:
+        return []
+    return [value]
+
+
+class FakeOVSDB(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.tables = dict((table, {}) for table in [
+            'Open_vSwitch', 'Bridge', 'Port', 'Interface', 'Manager',
+            'Controller'])
+        self.root = self.add_row('Open_vSwitch', {
+            'bridges': [], 'manager_options': [], 'other_config': {},
+            'external_ids': {}})
+        # Every request received, as (method, params)
+        self.requests = []
+        self.monitors = []
+        self.connections = []
+        self.sock = None
+
+    # Test helpers
+
+    def add_row(self, table, row):
+        row_uuid = str(uuid.uuid4())
+        self.tables[table][row_uuid] = dict(row)
+        return row_uuid
+
+    def add_bridge(self, name, controllers=()):
+        refs = []
+        for target in controllers:
+            refs.append(('uuid', self.add_row('Controller', {
+                'target': target, 'is_connected': False})))
+        bridge = self.add_row('Bridge', {'name': name, 'controller': refs,
+                                         'ports': []})
+        self.tables['Open_vSwitch'][self.root]['bridges'].append(
+            ('uuid', bridge))
+        return bridge
+
+    def rows(self, table):
+        return list(self.tables[table].values())
+
+    @property
+    def open_vswitch(self):
+        return self.tables['Open_vSwitch'][self.root]
+
+    def transactions(self):
+        return [params for method, params in self.requests
+                if method == 'transact']
+
+    def update_row(self, table, row_uuid, **columns):
+        '''Change a row as ovs-vswitchd would, notifying monitors'''
+        with self.lock:
+            old = dict(self.tables[table][row_uuid])
+            self.tables[table][row_uuid].update(columns)
+            self.notify({table: {row_uuid: old}})
+
+    # Server
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(5)
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.sock.close()
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            conn.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.connections.append(conn)
+            thread = threading.Thread(target=self.serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, conn):
+        decoder = json.JSONDecoder()
+        buf = ''
+        while True:
+            try:
+                data = conn.recv(65536)
+            except socket.error:
+                return
+            if not data:
+                return
+            buf += data.decode('utf-8')
+            while buf.strip():
+                buf = buf.lstrip()
+                try:
+                    message, end = decoder.raw_decode(buf)
+                except ValueError:
+                    break
+                buf = buf[end:]
+                self.handle(conn, message)
+
+    def send(self, conn, message):
+        try:
+            conn.sendall(json.dumps(message).encode('utf-8'))
+        except socket.error:
+            pass
+
+    def handle(self, conn, message):
+        method, params = message['method'], message['params']
+        with self.lock:
+            self.requests.append((method, params))
+            error = None
+            try:
+                if method == 'list_dbs':
+                    result = ['Open_vSwitch']
+                elif method == 'echo':
+                    result = params
+                elif method == 'transact':
+                    result = self.transact(params[1:])
+                elif method == 'monitor':
+                    result = self.monitor(conn, params[1], params[2])
+                elif method == 'monitor_cancel':
+                    self.monitors = [m for m in self.monitors
+                                     if m[:2] != (conn, params[0])]
+                    result = {}
+                else:
+                    result, error = None, 'unknown method'
+            except Exception as e:
+                result, error = None, str(e)
+            self.send(conn, {'id': message['id'], 'result': result,
+                             'error': error})
+
+    def monitor(self, conn, monitor_id, requests):
+        self.monitors.append((conn, monitor_id, requests))
+        initial = {}
+        for table, request in requests.items():
+            columns = request.get('columns')
+            initial[table] = dict(
+                (row_uuid, {'new': self.project(row, columns)})
+                for row_uuid, row in self.tables[table].items())
+        return initial
+
+    def notify(self, old_rows):
+        for conn, monitor_id, requests in self.monitors:
+            updates = {}
+            for table, rows in old_rows.items():
+                if table not in requests:
+                    continue
+                columns = requests[table].get('columns')
+                for row_uuid, old in rows.items():
+                    change = {}
+                    if old is not None:
+                        change['old'] = self.project(old, columns)
+                    new = self.tables[table].get(row_uuid)
+                    if new is not None:
+                        change['new'] = self.project(new, columns)
+                    updates.setdefault(table, {})[row_uuid] = change
+            if updates:
+                self.send(conn, {'method': 'update', 'id': None,
+                                 'params': [monitor_id, updates]})
+
+    def project(self, row, columns):
+        if columns is None:
+            columns = row.keys()
+        return dict((column, to_json(row.get(column, [])))
+                    for column in columns)
+
+    def matches(self, row_uuid, row, where, names):
+        for column, function, value in where:
+            if column == '_uuid':
+                actual = ('uuid', row_uuid)
+            else:
+                actual = row.get(column, [])
+            value = from_json(value, names)
+            if function == '==' and actual != value:
+                return False
+            if function == '!=' and actual == value:
+                return False
+        return True
+
+    def select_rows(self, operation, names):
+        table = self.tables[operation['table']]
+        return [(row_uuid, row) for row_uuid, row in table.items()
+                if self.matches(row_uuid, row, operation.get('where', []),
+                                names)]
+
+    def transact(self, operations):
+        names = {}
+        snapshot = copy.deepcopy(self.tables)
+        results = []
+        for operation in operations:
+            op = operation['op']
+            if op == 'insert':
+                row_uuid = str(uuid.uuid4())
+                if 'uuid-name' in operation:
+                    names[operation['uuid-name']] = row_uuid
+                self.tables[operation['table']][row_uuid] = dict(
+                    (column, from_json(value, names))
+                    for column, value in operation['row'].items())
+                results.append({'uuid': ['uuid', row_uuid]})
+            elif op == 'select':
+                columns = operation.get('columns')
+                rows = []
+                for row_uuid, row in self.select_rows(operation, names):
+                    selected = self.project(row, columns)
+                    if columns is None or '_uuid' in columns:
+                        selected['_uuid'] = ['uuid', row_uuid]
+                    rows.append(selected)
+                results.append({'rows': rows})
+            elif op == 'update':
+                rows = self.select_rows(operation, names)
+                for _, row in rows:
+                    row.update((column, from_json(value, names))
+                               for column, value in operation['row'].items())
+                results.append({'count': len(rows)})
+            elif op == 'mutate':
+                rows = self.select_rows(operation, names)
+                for _, row in rows:
+                    for column, mutator, value in operation['mutations']:
+                        self.mutate(row, column, mutator,
+                                    from_json(value, names))
+                results.append({'count': len(rows)})
+            elif op == 'delete':
+                rows = self.select_rows(operation, names)
+                for row_uuid, _ in rows:
+                    del self.tables[operation['table']][row_uuid]
+                results.append({'count': len(rows)})
+            elif op == 'comment':
+                results.append({})
+            else:
+                self.tables = snapshot
+                results.append({'error': 'not supported',
+                                'details': op})
+                return results
+        self.collect_garbage()
+        violation = self.check_indexes()
+        if violation:
+            self.tables = snapshot
+            results.append({'error': 'constraint violation',
+                            'details': violation})
+            return results
+        changed = {}
+        for table, rows in self.tables.items():
+            for row_uuid in set(rows) | set(snapshot[table]):
+                old = snapshot[table].get(row_uuid)
+                if old != rows.get(row_uuid):
+                    changed.setdefault(table, {})[row_uuid] = old
+        self.notify(changed)
+        return results
+
+    def mutate(self, row, column, mutator, value):
+        # Columns left out of an insert are empty maps or sets
+        if isinstance(value, dict) and not row.get(column):
+            row[column] = {}
+        if column not in row and mutator == 'delete':
+            return
+        current = row.get(column)
+        if isinstance(current, dict):
+            if mutator == 'insert':
+                for key, val in value.items():
+                    current.setdefault(key, val)
+            elif mutator == 'delete':
+                keys = value.keys() if isinstance(value, dict) else \
+                    as_set(value)
+                for key in keys:
+                    if not isinstance(value, dict) or \
+                            current.get(key) == value[key]:
+                        current.pop(key, None)
+        elif mutator == 'insert':
+            row[column] = as_set(current) + [v for v in as_set(value)
+                                             if v not in as_set(current)]
+        elif mutator == 'delete':
+            row[column] = [v for v in as_set(current)
+                           if v not in as_set(value)]
+        elif mutator == '+=':
+            row[column] = current + value
+
+    def check_indexes(self):
+        for table, column in sorted(INDEXES.items()):
+            seen = set()
+            for row in self.tables[table].values():
+                if row.get(column) in seen:
+                    return 'duplicate {} {} {}'.format(table, column,
+                                                       row[column])
+                seen.add(row.get(column))
+
+    def collect_garbage(self):
+        # Until nothing is collected, as a port frees its interfaces
+        collected = True
+        while collected:
+            referenced = set()
+
+            def walk(value):
+                if isinstance(value, tuple):
+                    referenced.add(value[1])
+                elif isinstance(value, list):
+                    for v in value:
+                        walk(v)
+                elif isinstance(value, dict):
+                    for v in value.values():
+                        walk(v)
+            for rows in self.tables.values():
+                for row in rows.values():
+                    walk(row)
+            collected = False
+            for table in GC_TABLES:
+                for row_uuid in list(self.tables[table]):
+                    if row_uuid not in referenced:
+                        del self.tables[table][row_uuid]
+                        collected = True
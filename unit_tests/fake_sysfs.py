@@ -0,0 +1,386 @@
+'''Synthetic host for exercising lib/PCIDev off real hardware
+
+Builds a fake /sys (PCI devices, drivers and netdevs), a modules.alias and
+stub lspci, uname, ip, ethtool, confd_cli and juju-log executables under a
+root directory. Every stub invocation is appended to calls.log so callers can
+count the subprocesses a probe costs.
+'''
+import os
+import shutil
+import stat
+import sys
+
+KERNEL = '4.4.0-21-generic'
+
+DRIVERS = {
+    'ixgbe': ('0x8086', '0x10fb'),
+    'ixgbevf': ('0x8086', '0x10ed'),
+    'i40e': ('0x8086', '0x1572'),
+    'virtio-pci': ('0x1af4', '0x1000'),
+    'igb_uio': ('0x8086', '0x1521'),
+}
+# Driver a device is probed by according to modules.alias
+MODALIAS_DRIVERS = {
+    'igb_uio': 'igb',
+}
+
+LSPCI = r'''#!/bin/sh
+echo "lspci $*" >> "{root}/calls.log"
+SYS="{root}/sys/bus/pci/devices"
+case "$1" in
+  -m)
+    ETH='"Ethernet controller" "Fake" "NIC"'
+    BRIDGE='"Host bridge" "Fake" "Bridge"'
+    grep -H '' "$SYS"/*/class | sed -n \
+      -e "s#^.*/\([^/]*\)/class:0x0200.*#\1 $ETH#p" \
+      -e "s#^.*/\([^/]*\)/class:0x06.*#\1 $BRIDGE#p"
+    ;;
+  -ks)
+    echo "${{2#0000:}} Ethernet controller: Fake NIC"
+    if [ -L "$SYS/$2/driver" ]; then
+      echo "	Kernel driver in use: $(basename "$(readlink "$SYS/$2/driver")")"
+    fi
+    ;;
+  -ns)
+    VENDOR=$(sed 's/^0x//' "$SYS/$2/vendor")
+    DEVICE=$(sed 's/^0x//' "$SYS/$2/device")
+    echo "${{2#0000:}} 0200: $VENDOR:$DEVICE"
+    ;;
+esac
+'''
+
+UNAME = '''#!/bin/sh
+echo "uname $*" >> "{root}/calls.log"
+echo {kernel}
+'''
+
+IP = '''#!/bin/sh
+echo "ip $*" >> "{root}/calls.log"
+if [ -f "{root}/ip/$3" ]; then
+  cat "{root}/ip/$3"
+fi
+'''
+
+CONFD_CLI = '''#!/bin/sh
+echo "confd_cli $*" >> "{root}/calls.log"
+cat > /dev/null
+cat "{root}/confd_cli.out"
+'''
+
+# Keeps per interface channel, RSS and feature state in
+# ethtool/<if>.json and resizes the sysfs queue directories like a driver
+# would. Tunnel checksum segmentation is fixed off, as on older NICs.
+ETHTOOL = '''#!{python}
+import json
+import os
+import shutil
+import sys
+
+ROOT = {root!r}
+with open(os.path.join(ROOT, 'calls.log'), 'a') as log:
+    log.write('ethtool ' + ' '.join(sys.argv[1:]) + '\\n')
+option, ifname = sys.argv[1], sys.argv[2]
+queues = os.path.join(ROOT, 'sys', 'class', 'net', ifname, 'queues')
+state_file = os.path.join(ROOT, 'ethtool', ifname + '.json')
+if os.path.exists(state_file):
+    with open(state_file) as f:
+        state = json.load(f)
+else:
+    combined = len([q for q in os.listdir(queues) if q.startswith('rx-')])
+    state = dict(max_combined=16, combined=combined,
+                 indir=[i % combined for i in range(128)],
+                 features=dict([
+                     ('rx-checksumming', [True, False]),
+                     ('tx-checksumming', [True, False]),
+                     ('scatter-gather', [True, False]),
+                     ('tcp-segmentation-offload', [True, False]),
+                     ('generic-segmentation-offload', [True, False]),
+                     ('generic-receive-offload', [True, False]),
+                     ('large-receive-offload', [True, False]),
+                     ('tx-udp_tnl-segmentation', [False, False]),
+                     ('tx-udp_tnl-csum-segmentation', [False, True]),
+                     ('rx-vlan-filter', [True, True]),
+                 ]))
+if option == '-l':
+    print('Channel parameters for %s:' % ifname)
+    print('Pre-set maximums:')
+    print('Combined:\\t%d' % state['max_combined'])
+    print('Current hardware settings:')
+    print('Combined:\\t%d' % state['combined'])
+elif option == '-L':
+    combined = int(sys.argv[4])
+    if combined > state['max_combined']:
+        sys.exit(1)
+    for queue in os.listdir(queues):
+        shutil.rmtree(os.path.join(queues, queue))
+    for queue in range(combined):
+        for kind, mask in (('rx', 'rps_cpus'), ('tx', 'xps_cpus')):
+            qdir = os.path.join(queues, '%s-%d' % (kind, queue))
+            os.makedirs(qdir)
+            with open(os.path.join(qdir, mask), 'w') as f:
+                f.write('00000000\\n')
+    state['combined'] = combined
+    state['indir'] = [i % combined for i in range(128)]
+elif option == '-x':
+    print('RX flow hash indirection table for %s with %d RX ring(s):' % (
+        ifname, state['combined']))
+    for row in range(0, len(state['indir']), 8):
+        print('%5d: %s' % (row, ' '.join(
+            '%5d' % ring for ring in state['indir'][row:row + 8])))
+elif option == '-X':
+    equal = int(sys.argv[4])
+    state['indir'] = [i % equal for i in range(128)]
+elif option == '-k':
+    print('Features for %s:' % ifname)
+    for name, (enabled, fixed) in sorted(state['features'].items()):
+        print('%s: %s%s' % (name, 'on' if enabled else 'off',
+                            ' [fixed]' if fixed else ''))
+elif option == '-K':
+    args = sys.argv[3:]
+    for name, value in zip(args[::2], args[1::2]):
+        if name not in state['features'] or state['features'][name][1]:
+            sys.exit(1)
+        state['features'][name][0] = value == 'on'
+if not os.path.isdir(os.path.dirname(state_file)):
+    os.makedirs(os.path.dirname(state_file))
+with open(state_file, 'w') as f:
+    json.dump(state, f)
+'''
+
+JUJU_LOG = '''#!/bin/sh
+echo "juju-log" >> "{root}/calls.log"
+'''
+
+
+def pci_address(index):
+    return '0000:{:02x}:{:02x}.{:x}'.format(1 + index // 256,
+                                            (index // 8) % 32, index % 8)
+
+
+def _write(path, content):
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    with open(path, 'w') as f:
+        f.write('{}\n'.format(content))
+
+
+def _symlink(target, link):
+    parent = os.path.dirname(link)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    os.symlink(os.path.relpath(target, parent), link)
+
+
+class FakeHost(object):
+
+    def __init__(self, root, kernel=KERNEL):
+        self.root = root
+        self.kernel = kernel
+        self.sys = os.path.join(root, 'sys')
+        self.bin = os.path.join(root, 'bin')
+        self.pci_root = os.path.join(self.sys, 'devices', 'pci0000:00')
+        self.next_index = 0
+        self.next_netdev = 0
+        self.vpe_interfaces = []
+        self.vf_lines = {}
+        os.makedirs(os.path.join(self.sys, 'bus', 'pci', 'devices'))
+        os.makedirs(os.path.join(self.sys, 'bus', 'pci', 'drivers'))
+        os.makedirs(os.path.join(self.sys, 'class', 'net'))
+        os.makedirs(self.bin)
+        self._add_pci('0000:00:00.0', '0x8086', '0x29c0', '0x060000')
+
+    def _add_pci(self, addr, vendor, device, pci_class='0x020000',
+                 driver=None, numa_node=0, local_cpulist='0-7'):
+        devdir = os.path.join(self.pci_root, addr)
+        _write(os.path.join(devdir, 'vendor'), vendor)
+        _write(os.path.join(devdir, 'device'), device)
+        _write(os.path.join(devdir, 'class'), pci_class)
+        _write(os.path.join(devdir, 'numa_node'), numa_node)
+        _write(os.path.join(devdir, 'local_cpulist'), local_cpulist)
+        _write(os.path.join(devdir, 'current_link_width'), 8)
+        _write(os.path.join(devdir, 'current_link_speed'), '8 GT/s')
+        _symlink(devdir, os.path.join(self.sys, 'bus', 'pci', 'devices',
+                                      addr))
+        if driver:
+            self.bind(addr, driver)
+        return devdir
+
+    def add_numa_node(self, node, cpulist, hugepage_sizes=(2048, 1048576)):
+        nodedir = os.path.join(self.sys, 'devices', 'system', 'node',
+                               'node{}'.format(node))
+        _write(os.path.join(nodedir, 'cpulist'), cpulist)
+        for size in hugepage_sizes:
+            pagedir = os.path.join(nodedir, 'hugepages',
+                                   'hugepages-{}kB'.format(size))
+            for name in ('nr_hugepages', 'free_hugepages'):
+                _write(os.path.join(pagedir, name), 0)
+        return nodedir
+
+    def bind(self, addr, driver):
+        driver_dir = os.path.join(self.sys, 'bus', 'pci', 'drivers', driver)
+        if not os.path.isdir(driver_dir):
+            os.makedirs(driver_dir)
+            for name in ('bind', 'unbind'):
+                open(os.path.join(driver_dir, name), 'w').close()
+        _symlink(driver_dir, os.path.join(self.pci_root, addr, 'driver'))
+
+    def bind_userspace(self, addr, driver='vfio-pci'):
+        '''Rebind a NIC to a userspace driver, dropping its netdev'''
+        devdir = os.path.join(self.pci_root, addr)
+        netdir = os.path.join(devdir, 'net')
+        for ifname in os.listdir(netdir):
+            os.unlink(os.path.join(self.sys, 'class', 'net', ifname))
+        shutil.rmtree(netdir)
+        os.unlink(os.path.join(devdir, 'driver'))
+        self.bind(addr, driver)
+
+    def _add_netdev(self, netdir, mac, state, speed, queues):
+        ifname = 'eth{}'.format(self.next_netdev)
+        self.next_netdev += 1
+        sdir = os.path.join(netdir, ifname)
+        _write(os.path.join(sdir, 'address'), mac)
+        _write(os.path.join(sdir, 'operstate'), state)
+        _write(os.path.join(sdir, 'speed'), speed)
+        _write(os.path.join(sdir, 'duplex'), 'full')
+        for queue in range(queues):
+            _write(os.path.join(sdir, 'queues', 'rx-{}'.format(queue),
+                                'rps_cpus'), '00000000')
+            _write(os.path.join(sdir, 'queues', 'tx-{}'.format(queue),
+                                'xps_cpus'), '00000000')
+        _symlink(os.path.dirname(netdir), os.path.join(sdir, 'device'))
+        _symlink(sdir, os.path.join(self.sys, 'class', 'net', ifname))
+        return ifname
+
+    def _mac(self, index):
+        return '52:54:{:02x}:{:02x}:{:02x}:{:02x}'.format(
+            (index >> 24) & 0xff, (index >> 16) & 0xff, (index >> 8) & 0xff,
+            index & 0xff)
+
+    def add_nic(self, driver='ixgbe', state='down', speed=10000, queues=4,
+                numa_node=0, local_cpulist='0-7', totalvfs=0, numvfs=0,
+                vf_vlan=None):
+        '''Add a NIC and any VFs; returns the PCI address of the NIC'''
+        index = self.next_index
+        self.next_index += 1 + numvfs
+        addr = pci_address(index)
+        vendor, device = DRIVERS[driver]
+        devdir = self._add_pci(addr, vendor, device, driver=driver,
+                               numa_node=numa_node,
+                               local_cpulist=local_cpulist)
+        mac = self._mac(index)
+        if driver == 'igb_uio':
+            _, bus, slot_func = addr.split(':')
+            slot, func = slot_func.split('.')
+            self.vpe_interfaces.append((
+                'GigabitEthernet{:x}/{:x}/{:x}'.format(
+                    int(bus, 16), int(slot, 16), int(func, 16)), mac))
+            return addr
+        if driver == 'virtio-pci':
+            # virtio netdevs hang off a virtio device below the function
+            netdir = os.path.join(devdir, 'virtio{}'.format(index), 'net')
+            self._add_netdev(netdir, mac, state, -1, queues)
+            return addr
+        ifname = self._add_netdev(os.path.join(devdir, 'net'), mac, state,
+                                  speed, queues)
+        if totalvfs:
+            _write(os.path.join(devdir, 'sriov_totalvfs'), totalvfs)
+            _write(os.path.join(devdir, 'sriov_numvfs'), numvfs)
+            lines = []
+            for vf in range(numvfs):
+                vf_addr = pci_address(index + 1 + vf)
+                vf_dir = self._add_pci(
+                    vf_addr, *DRIVERS['ixgbevf'], driver='ixgbevf',
+                    numa_node=numa_node, local_cpulist=local_cpulist)
+                _symlink(vf_dir, os.path.join(devdir, 'virtfn{}'.format(vf)))
+                _symlink(devdir, os.path.join(vf_dir, 'physfn'))
+                vf_mac = self._mac(index + 1 + vf)
+                self._add_netdev(os.path.join(vf_dir, 'net'), vf_mac,
+                                 'down', speed, 1)
+                line = '    vf {} MAC {}'.format(vf, vf_mac)
+                if vf_vlan:
+                    line += ', vlan {}'.format(vf_vlan)
+                lines.append(line + ', spoof checking on, link-state auto')
+            self.vf_lines[ifname] = lines
+        return addr
+
+    def finish(self, alias_padding=0):
+        '''Write modules.alias, stub executables and their data files
+
+        alias_padding adds unrelated alias lines to approach the size of
+        a real modules.alias.'''
+        alias_file = os.path.join(self.root, 'lib', 'modules', self.kernel,
+                                  'modules.alias')
+        lines = []
+        for pad in range(alias_padding):
+            lines.append('alias pci:v0000{:04X}d*sv*sd*bc*sc*i* pad{}'.format(
+                pad % 0xffff, pad))
+        for driver, (vendor, device) in sorted(DRIVERS.items()):
+            lines.append('alias pci:v0000{}d0000{}sv*sd*bc*sc*i* {}'.format(
+                vendor[2:].upper(), device[2:].upper(),
+                MODALIAS_DRIVERS.get(driver, driver.replace('-', '_'))))
+        _write(alias_file, '\n'.join(lines))
+        confd_lines = ['local0               -']
+        confd_lines.extend('{}  {}'.format(name, mac)
+                           for name, mac in self.vpe_interfaces)
+        _write(os.path.join(self.root, 'confd_cli.out'),
+               '\n'.join(confd_lines))
+        for ifname, lines in self.vf_lines.items():
+            _write(os.path.join(self.root, 'ip', ifname), '\n'.join(
+                ['4: {}: <BROADCAST,MULTICAST> mtu 1500'.format(ifname)] +
+                lines))
+        stubs = {
+            'lspci': LSPCI,
+            'uname': UNAME,
+            'ip': IP,
+            'ethtool': ETHTOOL,
+            'confd_cli': CONFD_CLI,
+            'juju-log': JUJU_LOG,
+        }
+        for name, script in stubs.items():
+            path = os.path.join(self.bin, name)
+            with open(path, 'w') as f:
+                f.write(script.format(root=self.root, kernel=self.kernel,
+                                      python=sys.executable))
+            os.chmod(path, stat.S_IRWXU)
+        open(self.calls_log, 'w').close()
+
+    @property
+    def calls_log(self):
+        return os.path.join(self.root, 'calls.log')
+
+    def calls(self):
+        with open(self.calls_log, 'r') as f:
+            return [line.split()[0] for line in f if line.strip()]
+
+    def reset_calls(self):
+        open(self.calls_log, 'w').close()
+
+    def activate(self, pcidev):
+        '''Point the PCIDev module and PATH at this host'''
+        pcidev.SYSFS_ROOT = self.sys
+        pcidev.MODULES_ROOT = os.path.join(self.root, 'lib', 'modules')
+        pcidev.VPE_CLI = os.path.join(self.bin, 'confd_cli')
+        os.environ['PATH'] = '{}:{}'.format(self.bin, os.environ['PATH'])
+        os.environ['UNIT_STATE_DB'] = os.path.join(self.root, 'unit-state.db')
+
+
+def make_host(root, devices, vfs_per_pf=6, virtio=1, vpe=1,
+              alias_padding=0):
+    '''Build a host with roughly the given number of ethernet functions
+
+    One in vfs_per_pf + 1 functions is an SR-IOV PF; the remainder, less
+    the virtio and VPE bound devices, are VFs.'''
+    host = FakeHost(root)
+    pfs = max(1, (devices - virtio - vpe) // (vfs_per_pf + 1))
+    for pf in range(pfs):
+        host.add_nic(numa_node=pf % 2,
+                     local_cpulist='0-7' if pf % 2 == 0 else '8-15',
+                     totalvfs=vfs_per_pf * 2, numvfs=vfs_per_pf,
+                     vf_vlan=100 + pf)
+    for _ in range(virtio):
+        host.add_nic(driver='virtio-pci')
+    for _ in range(vpe):
+        host.add_nic(driver='igb_uio')
+    host.finish(alias_padding=alias_padding)
+    return host
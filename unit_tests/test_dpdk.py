@@ -0,0 +1,107 @@
+import shutil
+import sys
+import tempfile
+
+sys.path.append('hooks')
+import testtools
+
+from mock import patch
+
+import lib.PCIDev as PCIDev
+import lib.dpdk as dpdk
+from unit_tests.fake_sysfs import FakeHost
+
+
+class TestDPDK(testtools.TestCase):
+
+    def setUp(self):
+        super(TestDPDK, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.host = FakeHost(self.root)
+        _p = patch.object(PCIDev, 'SYSFS_ROOT', self.host.sys)
+        _p.start()
+        self.addCleanup(_p.stop)
+        self.host.add_numa_node(0, '0-3,8-11')
+        self.host.add_numa_node(1, '4-7,12-15')
+
+    def test_get_numa_nodes(self):
+        self.assertEqual(dpdk.get_numa_nodes(), {
+            0: [0, 1, 2, 3, 8, 9, 10, 11],
+            1: [4, 5, 6, 7, 12, 13, 14, 15],
+        })
+
+    def test_get_dpdk_config(self):
+        self.assertEqual(dpdk.get_dpdk_config([{'numa_node': 1}], 2048, 2), {
+            'dpdk-init': 'true',
+            'dpdk-lcore-mask': '0x10',
+            'pmd-cpu-mask': '0x60',
+            'dpdk-socket-mem': '0,2048',
+            'vhost-sock-dir': '.',
+        })
+
+    def test_get_dpdk_config_both_nodes(self):
+        devices = [{'numa_node': 0}, {'numa_node': 1}, {'numa_node': -1}]
+        self.assertEqual(dpdk.get_dpdk_config(devices, 1024, 1), {
+            'dpdk-init': 'true',
+            'dpdk-lcore-mask': '0x1',
+            'pmd-cpu-mask': '0x12',
+            'dpdk-socket-mem': '1024,1024',
+            'vhost-sock-dir': '.',
+        })
+
+    def test_get_dpdk_config_no_devices(self):
+        settings = dpdk.get_dpdk_config([], 1024, 1)
+        self.assertEqual(settings['dpdk-socket-mem'], '1024,0')
+        self.assertEqual(settings['pmd-cpu-mask'], '0x2')
+
+    def test_get_pmd_config(self):
+        pmd_cpus = dpdk.get_pmd_cpus([{'numa_node': 1}], 2)
+        self.assertEqual(pmd_cpus, {1: [5, 6]})
+        self.assertEqual(dpdk.get_pmd_config(pmd_cpus), {
+            'pmd-auto-lb': 'true',
+            'emc-insert-inv-prob': '100',
+            'smc-enable': 'false',
+        })
+        settings = dpdk.get_pmd_config(pmd_cpus, emc_insert_inv_prob=0,
+                                       smc_enable=True, pinned=True)
+        self.assertEqual(settings['pmd-auto-lb'], 'false')
+        self.assertEqual(settings['emc-insert-inv-prob'], '0')
+        self.assertEqual(settings['smc-enable'], 'true')
+        self.assertEqual(dpdk.get_pmd_config({0: [1]})['pmd-auto-lb'],
+                         'false')
+
+    def test_get_port_config(self):
+        devices = {
+            '52:54:00:aa:bb:00': {'numa_node': 1,
+                                  'pci_address': '0000:81:00.0'},
+            '52:54:00:aa:bb:01': {'numa_node': 1,
+                                  'pci_address': '0000:81:00.1'},
+            '52:54:00:aa:bb:02': {'numa_node': 0,
+                                  'pci_address': '0000:03:00.0'},
+        }
+        pmd_cpus = dpdk.get_pmd_cpus(devices.values(), 3)
+        self.assertEqual(pmd_cpus, {0: [1, 2, 3], 1: [4, 5, 6]})
+        settings = dpdk.get_port_config(devices, pmd_cpus)
+        self.assertEqual(settings['52:54:00:aa:bb:00'], {
+            'type': 'dpdk',
+            'options': {'dpdk-devargs': '0000:81:00.0', 'n_rxq': 3},
+            'other_config': {'pmd-rxq-affinity': None},
+        })
+        settings = dpdk.get_port_config(devices, pmd_cpus, n_rxq=2,
+                                        pinned=True)
+        # Queues continue round robin over the ports of a node
+        self.assertEqual([settings[mac]['other_config']['pmd-rxq-affinity']
+                          for mac in sorted(devices)],
+                         ['0:4,1:5', '0:6,1:4', '0:1,1:2'])
+
+    def test_get_vhost_sock_dir(self):
+        self.assertEqual(dpdk.get_vhost_sock_dir(
+            '/var/run/openvswitch/vhost-user/'), 'vhost-user')
+        settings = dpdk.get_dpdk_config([], 1024, 1,
+                                        '/var/run/openvswitch/vhu')
+        self.assertEqual(settings['vhost-sock-dir'], 'vhu')
+        for socket_dir in ('/var/lib/vhost', '/var/run/openvswitch/../vhu',
+                           'vhost-user'):
+            self.assertRaises(ValueError, dpdk.get_vhost_sock_dir,
+                              socket_dir)
@@ -0,0 +1,203 @@
+import errno
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+
+sys.path.append('hooks')
+import testtools
+
+import lib.hotplug as hotplug
+
+PCI_ADDR = '0000:03:00.0'
+DEVPATH = '/devices/pci0000:00/0000:00:02.0/{}'.format(PCI_ADDR)
+
+
+def uevent(action, devpath, **props):
+    fields = ['{}@{}'.format(action, devpath),
+              'ACTION={}'.format(action),
+              'DEVPATH={}'.format(devpath)]
+    fields.extend('{}={}'.format(k, v) for k, v in sorted(props.items()))
+    return '\0'.join(fields).encode('utf-8') + b'\0'
+
+
+def rtattr(rta_type, value):
+    length = hotplug.RTATTR.size + len(value)
+    padding = b'\0' * (hotplug._align(length) - length)
+    return hotplug.RTATTR.pack(length, rta_type) + value + padding
+
+
+def rtnl_link(msg_type, ifindex, ifname, mac=None, operstate=None):
+    attrs = rtattr(hotplug.IFLA_IFNAME, ifname.encode('utf-8') + b'\0')
+    if mac:
+        attrs += rtattr(hotplug.IFLA_ADDRESS, bytes(bytearray(
+            int(octet, 16) for octet in mac.split(':'))))
+    if operstate is not None:
+        attrs += rtattr(hotplug.IFLA_OPERSTATE, struct.pack('B', operstate))
+    body = hotplug.IFINFOMSG.pack(0, 1, ifindex, 0, 0) + attrs
+    return hotplug.NLMSG_HDR.pack(
+        hotplug.NLMSG_HDR.size + len(body), msg_type, 0, 0, 0) + body
+
+
+class TestHotplugWatcher(testtools.TestCase):
+
+    def setUp(self):
+        super(TestHotplugWatcher, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.state_file = os.path.join(self.tmpdir, 'hotplug.json')
+        self.pid_file = os.path.join(self.tmpdir, 'hotplug.pid')
+        with open(self.pid_file, 'w') as f:
+            f.write(str(os.getpid()))
+        self.uevent_tx, uevent_rx = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.rtnl_tx, rtnl_rx = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM)
+        for sock in (self.uevent_tx, uevent_rx, self.rtnl_tx, rtnl_rx):
+            self.addCleanup(sock.close)
+        # eth2 is a PCI function, the other netdevs are virtual
+        sysfs_net = os.path.join(self.tmpdir, 'class', 'net')
+        devdir = os.path.join(self.tmpdir, DEVPATH.lstrip('/'))
+        os.makedirs(devdir)
+        os.makedirs(os.path.join(sysfs_net, 'eth2'))
+        os.symlink(devdir, os.path.join(sysfs_net, 'eth2', 'device'))
+        self.watcher = hotplug.HotplugWatcher(
+            uevent_sock=uevent_rx, rtnl_sock=rtnl_rx,
+            state_file=self.state_file, sysfs_net=sysfs_net)
+
+    def generation(self):
+        return hotplug.current_generation(self.state_file, self.pid_file)
+
+    def replay(self, sock, messages):
+        for message in messages:
+            sock.send(message)
+            self.watcher.poll(timeout=0)
+
+    def test_generation_starts_after_previous(self):
+        self.assertEqual(self.generation(), 1)
+        hotplug.HotplugWatcher(state_file=self.state_file)
+        self.assertEqual(self.generation(), 2)
+
+    def test_generation_needs_running_watcher(self):
+        os.unlink(self.pid_file)
+        self.assertEqual(self.generation(), None)
+
+    def test_stop_watcher_invalidates_state(self):
+        daemon = subprocess.Popen(['sleep', '60'])
+        self.addCleanup(daemon.wait)
+        with open(self.pid_file, 'w') as f:
+            f.write(str(daemon.pid))
+        self.assertEqual(self.generation(), 1)
+        self.assertTrue(hotplug.stop_watcher(self.pid_file, self.state_file))
+        self.assertFalse(os.path.exists(self.pid_file))
+        self.assertEqual(hotplug.read_state(self.state_file),
+                         {'generation': 1})
+        # A new watcher carries on from the last generation
+        hotplug.HotplugWatcher(state_file=self.state_file)
+        with open(self.pid_file, 'w') as f:
+            f.write(str(os.getpid()))
+        self.assertEqual(self.generation(), 2)
+
+    def test_overflow_bumps_generation(self):
+        class OverflowedSocket(object):
+            def __init__(self, sock):
+                self.sock = sock
+
+            def fileno(self):
+                return self.sock.fileno()
+
+            def recv(self, size):
+                self.sock.recv(size)
+                raise socket.error(errno.ENOBUFS, 'No buffer space')
+
+        self.watcher.rtnl_sock = OverflowedSocket(self.watcher.rtnl_sock)
+        self.replay(self.rtnl_tx, [b'dropped'])
+        self.assertEqual(self.watcher.generation, 2)
+        self.assertEqual(self.generation(), 2)
+
+    def test_pci_bind_unbind(self):
+        self.replay(self.uevent_tx, [
+            uevent('add', DEVPATH, SUBSYSTEM='pci', PCI_SLOT_NAME=PCI_ADDR),
+            uevent('bind', DEVPATH, SUBSYSTEM='pci', PCI_SLOT_NAME=PCI_ADDR,
+                   DRIVER='ixgbe'),
+        ])
+        self.assertEqual(self.watcher.inventory['pci'][PCI_ADDR],
+                         {'driver': 'ixgbe'})
+        self.assertEqual(self.generation(), 3)
+        self.replay(self.uevent_tx, [
+            uevent('unbind', DEVPATH, SUBSYSTEM='pci',
+                   PCI_SLOT_NAME=PCI_ADDR),
+            uevent('remove', DEVPATH, SUBSYSTEM='pci',
+                   PCI_SLOT_NAME=PCI_ADDR),
+        ])
+        self.assertEqual(self.watcher.inventory['pci'], {})
+        self.assertEqual(self.generation(), 5)
+
+    def test_net_add_and_link_events(self):
+        self.replay(self.uevent_tx, [
+            uevent('add', DEVPATH + '/net/eth2', SUBSYSTEM='net',
+                   INTERFACE='eth2', IFINDEX='4'),
+        ])
+        self.replay(self.rtnl_tx, [
+            rtnl_link(hotplug.RTM_NEWLINK, 4, 'eth2',
+                      mac='52:54:00:aa:bb:cc', operstate=2),
+        ])
+        self.assertEqual(self.watcher.inventory['net']['eth2'], {
+            'pci_address': PCI_ADDR,
+            'mac': '52:54:00:aa:bb:cc',
+            'state': 'down',
+        })
+        self.assertEqual(self.watcher.generation, 3)
+
+    def test_repeated_link_event_keeps_generation(self):
+        message = rtnl_link(hotplug.RTM_NEWLINK, 4, 'eth2',
+                            mac='52:54:00:aa:bb:cc', operstate=6)
+        self.replay(self.rtnl_tx, [message, message])
+        self.assertEqual(self.watcher.generation, 2)
+        self.replay(self.rtnl_tx, [
+            rtnl_link(hotplug.RTM_DELLINK, 4, 'eth2'),
+        ])
+        self.assertNotIn('eth2', self.watcher.inventory['net'])
+        self.assertEqual(self.watcher.generation, 3)
+
+    def test_virtual_netdevs_ignored(self):
+        self.replay(self.uevent_tx, [
+            uevent('add', '/devices/virtual/net/tap0', SUBSYSTEM='net',
+                   INTERFACE='tap0'),
+        ])
+        self.replay(self.rtnl_tx, [
+            rtnl_link(hotplug.RTM_NEWLINK, 9, 'tap0',
+                      mac='fe:16:3e:aa:bb:cc', operstate=6),
+            rtnl_link(hotplug.RTM_DELLINK, 9, 'tap0'),
+            rtnl_link(hotplug.RTM_NEWLINK, 10, 'vhu1234', operstate=6),
+        ])
+        self.assertEqual(self.watcher.inventory['net'], {})
+        self.assertEqual(self.watcher.generation, 1)
+
+    def test_lock_pid_file(self):
+        os.unlink(self.pid_file)
+        first = hotplug.lock_pid_file(self.pid_file)
+        self.addCleanup(first.close)
+        self.assertEqual(hotplug.lock_pid_file(self.pid_file), None)
+        with open(self.pid_file) as f:
+            self.assertEqual(f.read(), str(os.getpid()))
+        first.close()
+        second = hotplug.lock_pid_file(self.pid_file)
+        self.addCleanup(second.close)
+        self.assertIsNotNone(second)
+
+    def test_net_rename(self):
+        self.replay(self.uevent_tx, [
+            uevent('add', DEVPATH + '/net/eth0', SUBSYSTEM='net',
+                   INTERFACE='eth0'),
+            uevent('move', DEVPATH + '/net/ens3', SUBSYSTEM='net',
+                   INTERFACE='ens3', DEVPATH_OLD=DEVPATH + '/net/eth0'),
+        ])
+        self.assertEqual(list(self.watcher.inventory['net']), ['ens3'])
+
+    def test_udev_messages_ignored(self):
+        self.replay(self.uevent_tx, [b'libudev\0\xfe\xed\xca\xfe'])
+        self.assertEqual(self.watcher.generation, 1)
@@ -0,0 +1,84 @@
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.append('hooks')
+import testtools
+
+from mock import patch
+
+import lib.PCIDev as PCIDev
+import lib.hugepages as hugepages
+from unit_tests.fake_sysfs import FakeHost
+
+
+class TestHugepages(testtools.TestCase):
+
+    def setUp(self):
+        super(TestHugepages, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.host = FakeHost(self.root)
+        self.host.add_numa_node(0, '0-3')
+        self.host.add_numa_node(1, '4-7')
+        self.proc_mounts = os.path.join(self.root, 'mounts')
+        with open(self.proc_mounts, 'w') as f:
+            f.write('sysfs /sys sysfs rw,nosuid,nodev,noexec,relatime 0 0\n')
+        for obj, attr, value in [
+                (PCIDev, 'SYSFS_ROOT', self.host.sys),
+                (hugepages, 'PROC_MOUNTS', self.proc_mounts),
+                (hugepages, 'log', lambda msg: None)]:
+            _p = patch.object(obj, attr, value)
+            _p.start()
+            self.addCleanup(_p.stop)
+
+    def nr_hugepages(self, node, size_kb):
+        return PCIDev.read_sysfs_int(
+            hugepages.node_hugepages_path(node, size_kb, 'nr_hugepages'))
+
+    def test_parse_size(self):
+        self.assertEqual(hugepages.parse_size('2M'), 2048)
+        self.assertEqual(hugepages.parse_size('1g'), 1048576)
+        self.assertEqual(hugepages.parse_size('2048'), 2048)
+        self.assertEqual(hugepages.format_size(1048576), '1G')
+        self.assertRaises(hugepages.HugepagesError, hugepages.parse_size,
+                          'huge')
+
+    def test_parse_counts(self):
+        self.assertEqual(hugepages.parse_counts('512', [0, 1]),
+                         {0: 512, 1: 512})
+        self.assertEqual(hugepages.parse_counts('1:256', [0, 1]),
+                         {0: 0, 1: 256})
+        for value in ['2:256', 'x:1', '0:-1', 'lots']:
+            self.assertRaises(hugepages.HugepagesError,
+                              hugepages.parse_counts, value, [0, 1])
+
+    def test_allocate(self):
+        self.assertEqual(hugepages.allocate({0: 512, 1: 256}, 2048),
+                         {0: 512, 1: 256})
+        self.assertEqual(self.nr_hugepages(1, 2048), 256)
+        self.assertEqual(self.nr_hugepages(1, 1048576), 0)
+        self.assertRaises(hugepages.HugepagesError, hugepages.allocate,
+                          {0: 1}, 16384)
+
+    @patch.object(hugepages, 'host')
+    def test_mount_hugetlbfs(self, host):
+        host.mount.return_value = True
+        self.assertTrue(hugepages.mount_hugetlbfs(2048))
+        host.fstab_remove.assert_called_with('/mnt/huge')
+        host.mount.assert_called_with('hugetlbfs-ovs', '/mnt/huge',
+                                      options='pagesize=2M', persist=True,
+                                      filesystem='hugetlbfs')
+        with open(self.proc_mounts, 'a') as f:
+            f.write('hugetlbfs-ovs /mnt/huge hugetlbfs '
+                    'rw,relatime,pagesize=2M 0 0\n')
+        host.reset_mock()
+        self.assertTrue(hugepages.mount_hugetlbfs(2048))
+        self.assertFalse(host.mount.called)
+        # A different page size needs a remount
+        self.assertTrue(hugepages.mount_hugetlbfs(1048576))
+        host.umount.assert_called_with('/mnt/huge', persist=True)
+        host.mount.assert_called_with('hugetlbfs-ovs', '/mnt/huge',
+                                      options='pagesize=1G', persist=True,
+                                      filesystem='hugetlbfs')
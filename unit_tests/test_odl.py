@@ -0,0 +1,36 @@
+import sys
+
+sys.path.append('hooks')
+import testtools
+
+from mock import patch
+
+import lib.ODL as ODL
+
+NET_MAP = {'physicalNetwork': [{
+    'name': 'physnet1',
+    'device': [{
+        'device-name': 'compute-0',
+        'device-type': 'vhostuser',
+        'interface': [{'interface-name': 'eth1',
+                       'macAddress': '52:54:00:AA:BB:CC'}],
+    }],
+}]}
+
+
+class TestODLConfig(testtools.TestCase):
+
+    def setUp(self):
+        super(TestODLConfig, self).setUp()
+        self.odl = ODL.ODLConfig('admin', 'admin', 'odl-controller')
+        _p = patch.object(self.odl, 'get_networks', return_value=NET_MAP)
+        _p.start()
+        self.addCleanup(_p.stop)
+
+    def test_get_registered_interfaces_normalizes_macs(self):
+        self.assertEqual(self.odl.get_registered_interfaces('compute-0'),
+                         set([('physnet1', 'eth1', '52:54:00:aa:bb:cc')]))
+
+    def test_get_macs_networks(self):
+        self.assertEqual(self.odl.get_macs_networks('52:54:00:aa:bb:cc'),
+                         ['physnet1'])
@@ -0,0 +1,470 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append('hooks')
+import testtools
+
+from mock import patch
+
+from charmhelpers.core import unitdata
+
+import lib.ovs as ovs
+import lib.ovsdb as ovsdb
+from unit_tests.fake_ovsdb import FakeOVSDB
+
+
+VSCTL_STATE = (
+    '{"data":[[["map",[["local_ip","10.1.1.1"]]],["map",[]]]],'
+    '"headings":["other_config","external_ids"]}\n'
+    '{"data":[["tcp:odl-controller:6640"]],"headings":["target"]}\n')
+
+VSCTL_TOPOLOGY = (
+    '{"data":[[["uuid","b1"],"br-data",["uuid","p1"],""]],'
+    '"headings":["_uuid","name","ports","datapath_type"]}\n'
+    '{"data":[[["uuid","p1"],"br-data",["uuid","i1"],["set",[]],'
+    '["set",[]],["map",[]]]],"headings":["_uuid","name","interfaces",'
+    '"bond_mode","lacp","other_config"]}\n'
+    '{"data":[[["uuid","i1"],"br-data","internal",["map",[]]]],'
+    '"headings":["_uuid","name","type","options"]}\n')
+
+BOND_SETTINGS = {'bond_mode': 'balance-tcp', 'lacp': 'active',
+                 'other_config': {'bond-rebalance-interval': 10000}}
+
+
+class TestTransaction(testtools.TestCase):
+
+    def setUp(self):
+        super(TestTransaction, self).setUp()
+        _p = patch.object(ovsdb, 'get_client', return_value=None)
+        _p.start()
+        self.addCleanup(_p.stop)
+
+    @patch.object(ovs, 'subprocess')
+    def test_commit_single_invocation(self, subprocess):
+        subprocess.check_output.return_value = VSCTL_STATE.replace(
+            '10.1.1.1', '10.0.0.9').replace('odl-controller', 'odl-old')
+        txn = ovs.Transaction()
+        txn.set_config('local_ip', '10.1.1.1')
+        txn.set_config('host-id', 'ovs-host', table='external_ids')
+        txn.set_manager('tcp:odl-controller:6640')
+        txn.commit()
+        subprocess.check_call.assert_called_once_with([
+            'ovs-vsctl',
+            '--', 'set', 'Open_vSwitch', '.', 'other_config:local_ip=10.1.1.1',
+            '--', 'set', 'Open_vSwitch', '.', 'external_ids:host-id=ovs-host',
+            '--', 'set-manager', 'tcp:odl-controller:6640',
+        ])
+        self.assertEqual(len(txn), 0)
+
+    @patch.object(ovs, 'subprocess')
+    def test_commit_unchanged(self, subprocess):
+        subprocess.check_output.return_value = VSCTL_STATE
+        txn = ovs.Transaction()
+        txn.set_config('local_ip', '10.1.1.1')
+        txn.set_config('host-id', 'ovs-host', table='external_ids')
+        txn.set_manager('tcp:odl-controller:6640')
+        txn.commit()
+        subprocess.check_call.assert_called_once_with([
+            'ovs-vsctl',
+            '--', 'set', 'Open_vSwitch', '.', 'external_ids:host-id=ovs-host',
+        ])
+
+    @patch.object(ovs, 'subprocess')
+    def test_remove_config(self, subprocess):
+        subprocess.check_output.return_value = VSCTL_STATE
+        txn = ovs.Transaction()
+        txn.remove_config('local_ip')
+        txn.remove_config('dpdk-init')
+        self.assertEqual(txn.commit(), [
+            ('remove', 'Open_vSwitch', '.', 'other_config', 'local_ip')])
+        subprocess.check_call.assert_called_once_with([
+            'ovs-vsctl',
+            '--', 'remove', 'Open_vSwitch', '.', 'other_config', 'local_ip',
+        ])
+
+    @patch.object(ovs, 'subprocess')
+    def test_add_bond(self, subprocess):
+        subprocess.check_output.return_value = VSCTL_STATE + VSCTL_TOPOLOGY
+        txn = ovs.Transaction()
+        txn.add_bridge('br-data', {'datapath_type': 'netdev'})
+        txn.add_bond('br-data', 'bond0', ['dpdk-0', 'dpdk-1'],
+                     BOND_SETTINGS, {
+                         'dpdk-0': {'type': 'dpdk', 'options': {
+                             'dpdk-devargs': '0000:03:00.0'}}})
+        txn.commit()
+        self.assertEqual(subprocess.check_output.call_args[0][0][-9:], [
+            '--', 'list', 'Bridge', '--', 'list', 'Port',
+            '--', 'list', 'Interface'])
+        subprocess.check_call.assert_called_once_with([
+            'ovs-vsctl',
+            '--', 'set', 'Bridge', 'br-data', 'datapath_type=netdev',
+            '--', 'add-bond', 'br-data', 'bond0', 'dpdk-0', 'dpdk-1',
+            'bond_mode=balance-tcp', 'lacp=active',
+            'other_config:bond-rebalance-interval=10000',
+            '--', 'set', 'Interface', 'dpdk-0',
+            'options:dpdk-devargs=0000:03:00.0', 'type=dpdk',
+        ])
+
+    @patch.object(ovs, 'subprocess')
+    def test_set_columns(self, subprocess):
+        txn = ovs.Transaction()
+        txn.operations.append(('set-columns', 'Interface', 'dpdk-0', {
+            'options': {'n_rxq': 2},
+            'other_config': {'pmd-rxq-affinity': None}}))
+        txn.commit(check=False)
+        subprocess.check_call.assert_called_once_with([
+            'ovs-vsctl',
+            '--', 'set', 'Interface', 'dpdk-0', 'options:n_rxq=2',
+            '--', 'remove', 'Interface', 'dpdk-0', 'other_config',
+            'pmd-rxq-affinity',
+        ])
+
+    @patch.object(ovs, 'subprocess')
+    def test_set_manager_settings(self, subprocess):
+        subprocess.check_output.return_value = VSCTL_STATE.replace(
+            '"target"]', '"target","inactivity_probe","max_backoff"]').replace(
+            '"tcp:odl-controller:6640"]', '"tcp:odl-controller:6640",'
+            '["set",[]],8000]')
+        txn = ovs.Transaction()
+        txn.set_manager('tcp:odl-controller:6640', inactivity_probe=30000,
+                        max_backoff=None)
+        txn.commit()
+        subprocess.check_call.assert_called_once_with([
+            'ovs-vsctl',
+            '--', 'set', 'Manager', 'tcp:odl-controller:6640',
+            'inactivity_probe=30000',
+            '--', 'clear', 'Manager', 'tcp:odl-controller:6640',
+            'max_backoff',
+        ])
+
+    @patch.object(ovs, 'subprocess')
+    def test_commit_empty(self, subprocess):
+        ovs.Transaction().commit()
+        self.assertFalse(subprocess.check_call.called)
+        self.assertFalse(subprocess.check_output.called)
+
+
+class TestOVSDB(testtools.TestCase):
+
+    def setUp(self):
+        super(TestOVSDB, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'db.sock')
+        self.server = FakeOVSDB(self.path)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        _p = patch.object(ovsdb, 'OVSDB_SOCKET', self.path)
+        _p.start()
+        self.addCleanup(_p.stop)
+        _p = patch.object(ovsdb, 'log')
+        _p.start()
+        self.addCleanup(_p.stop)
+        ovsdb.reset_client()
+        self.addCleanup(ovsdb.reset_client)
+        self.kv = unitdata.Storage(os.path.join(self.root, 'unit-state.db'))
+        _p = patch.object(ovs, 'kv', lambda: self.kv)
+        _p.start()
+        self.addCleanup(_p.stop)
+
+    def test_list_dbs(self):
+        client = ovsdb.OVSDBClient(self.path)
+        self.addCleanup(client.close)
+        self.assertEqual(client.list_dbs(), ['Open_vSwitch'])
+
+    def test_list(self):
+        self.server.add_bridge('br-int', controllers=['tcp:10.0.0.1:6653'])
+        client = ovsdb.OVSDBClient(self.path)
+        self.addCleanup(client.close)
+        rows = client.list('Bridge', columns=['name', 'controller'])
+        self.assertEqual([row['name'] for row in rows], ['br-int'])
+        self.assertEqual(len(ovsdb.ovs_to_py(rows[0]['controller'])), 1)
+
+    def test_transact_error(self):
+        client = ovsdb.OVSDBClient(self.path)
+        self.addCleanup(client.close)
+        self.assertRaises(ovsdb.OVSDBError, client.transact,
+                          [{'op': 'wait', 'table': 'Bridge'}])
+
+    def test_monitor(self):
+        bridge = self.server.add_bridge('br-int')
+        client = ovsdb.OVSDBClient(self.path)
+        self.addCleanup(client.close)
+        initial = client.monitor({'Bridge': ['name']})
+        self.assertEqual(initial['Bridge'][bridge]['new'], {'name': 'br-int'})
+        self.assertIsNone(client.wait_for_update(0.05))
+        self.server.update_row('Bridge', bridge, name='br-ex')
+        monitor_id, update = client.wait_for_update(5)
+        self.assertEqual(update['Bridge'][bridge]['new'], {'name': 'br-ex'})
+
+    @patch.object(ovs, 'subprocess')
+    def test_commit_native(self, subprocess):
+        self.server.open_vswitch['other_config']['local_ip'] = '10.0.0.9'
+        txn = ovs.Transaction()
+        txn.set_config('local_ip', '10.1.1.1')
+        txn.set_config('host-id', 'ovs-host', table='external_ids')
+        txn.set_manager('tcp:odl-controller:6640')
+        txn.commit()
+        self.assertFalse(subprocess.check_call.called)
+        # One read and one write
+        self.assertEqual(len(self.server.transactions()), 2)
+        self.assertEqual(self.server.open_vswitch['other_config'],
+                         {'local_ip': '10.1.1.1'})
+        self.assertEqual(self.server.open_vswitch['external_ids'],
+                         {'host-id': 'ovs-host'})
+        ovs.Transaction().remove_config('host-id',
+                                        table='external_ids').commit()
+        self.assertEqual(self.server.open_vswitch['external_ids'], {})
+        self.assertEqual([row['target']
+                          for row in self.server.rows('Manager')],
+                         ['tcp:odl-controller:6640'])
+        # Replacing the manager drops the old row
+        ovs.set_manager('tcp:odl-controller2:6640')
+        self.assertEqual([row['target']
+                          for row in self.server.rows('Manager')],
+                         ['tcp:odl-controller2:6640'])
+        # The connection is shared between transactions
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_commit_steady_state(self):
+        for _ in range(2):
+            txn = ovs.Transaction()
+            txn.set_config('local_ip', '10.1.1.1')
+            txn.set_manager('tcp:odl-controller:6640')
+            txn.commit()
+        # The second commit only reads
+        transactions = self.server.transactions()
+        self.assertEqual(len(transactions), 3)
+        self.assertEqual(set(op['op'] for op in transactions[-1][1:]),
+                         set(['select']))
+
+    @patch.object(ovs, 'subprocess')
+    def test_commit_fallback(self, subprocess):
+        subprocess.check_output.return_value = VSCTL_STATE.replace(
+            '10.1.1.1', '10.0.0.9')
+        self.server.stop()
+        ovs.set_config('local_ip', '10.1.1.1')
+        subprocess.check_call.assert_called_once_with([
+            'ovs-vsctl', '--', 'set', 'Open_vSwitch', '.',
+            'other_config:local_ip=10.1.1.1'])
+
+    def test_add_bond_native(self):
+        def bond():
+            port, = [row for row in self.server.rows('Port')
+                     if row['name'] == 'bond0']
+            members = sorted(self.server.tables['Interface'][ref[1]]['name']
+                             for ref in port['interfaces'])
+            return port, members
+
+        txn = ovs.Transaction()
+        txn.add_bridge('br-data')
+        txn.add_bond('br-data', 'bond0', ['eth1', 'eth2'], BOND_SETTINGS)
+        txn.commit()
+        bridge, = self.server.rows('Bridge')
+        self.assertEqual(bridge['name'], 'br-data')
+        self.assertEqual(len(bridge['ports']), 2)
+        port, members = bond()
+        self.assertEqual(members, ['eth1', 'eth2'])
+        self.assertEqual(port['bond_mode'], 'balance-tcp')
+        self.assertEqual(port['other_config'],
+                         {'bond-rebalance-interval': '10000'})
+        # Nothing to do in the steady state
+        del self.server.requests[:]
+        txn.add_bridge('br-data')
+        txn.add_bond('br-data', 'bond0', ['eth2', 'eth1'], BOND_SETTINGS)
+        self.assertEqual(txn.commit(), [])
+        self.assertEqual(len(self.server.transactions()), 1)
+        # Settings are updated in place
+        port_uuid = [row_uuid for row_uuid, row
+                     in self.server.tables['Port'].items()
+                     if row['name'] == 'bond0']
+        settings = dict(BOND_SETTINGS, lacp='passive')
+        txn.add_bond('br-data', 'bond0', ['eth1', 'eth2'], settings)
+        self.assertEqual(txn.commit(), [
+            ('set-columns', 'Port', 'bond0', {'lacp': 'passive'})])
+        self.assertEqual(bond()[0]['lacp'], 'passive')
+        self.assertEqual(port_uuid, [row_uuid for row_uuid, row
+                                     in self.server.tables['Port'].items()
+                                     if row['name'] == 'bond0'])
+        # Interface settings too, removing map keys set to None
+        txn.add_bond('br-data', 'bond0', ['eth1', 'eth2'], settings, {
+            'eth1': {'other_config': {'pmd-rxq-affinity': '0:3'}}})
+        txn.commit()
+        txn.add_bond('br-data', 'bond0', ['eth1', 'eth2'], settings, {
+            'eth1': {'options': {'n_rxq': 2},
+                     'other_config': {'pmd-rxq-affinity': None}}})
+        self.assertEqual(txn.commit(), [
+            ('set-columns', 'Interface', 'eth1', {
+                'options': {'n_rxq': 2},
+                'other_config': {'pmd-rxq-affinity': None}})])
+        eth1, = [row for row in self.server.rows('Interface')
+                 if row['name'] == 'eth1']
+        self.assertEqual(eth1['options'], {'n_rxq': '2'})
+        self.assertEqual(eth1['other_config'], {})
+        self.assertEqual(bond()[0]['lacp'], 'passive')
+        # New members recreate the bond
+        txn.add_bond('br-data', 'bond0', ['eth1', 'eth3'], settings)
+        txn.commit()
+        self.assertEqual(bond()[1], ['eth1', 'eth3'])
+        self.assertEqual(sorted(row['name']
+                                for row in self.server.rows('Interface')),
+                         ['br-data', 'eth1', 'eth3'])
+
+    def test_rename_bond_native(self):
+        txn = ovs.Transaction()
+        txn.add_bridge('br-data')
+        txn.add_bond('br-data', 'bond0', ['eth1', 'eth2'], BOND_SETTINGS)
+        txn.commit()
+        # The members still belong to bond0
+        txn.add_bond('br-data', 'bond1', ['eth1', 'eth2'], BOND_SETTINGS)
+        self.assertRaises(ovsdb.OVSDBError, txn.commit)
+        txn = ovs.Transaction()
+        txn.del_port('br-data', 'bond0')
+        txn.add_bond('br-data', 'bond1', ['eth1', 'eth2'], BOND_SETTINGS)
+        applied = txn.commit()
+        self.assertEqual([operation[:3] for operation in applied], [
+            ('del-port', 'br-data', 'bond0'),
+            ('add-bond', 'br-data', 'bond1')])
+        self.assertEqual(sorted(row['name']
+                                for row in self.server.rows('Port')),
+                         ['bond1', 'br-data'])
+        # Removing a port which is gone does nothing
+        txn.del_port('br-data', 'bond0')
+        self.assertEqual(txn.commit(), [])
+
+    def test_connection_settings(self):
+        bridge = self.server.add_bridge('br-int',
+                                        controllers=['tcp:10.0.0.1:6653'])
+        for _ in range(2):
+            txn = ovs.Transaction()
+            txn.set_manager('tcp:odl-controller:6640', inactivity_probe=30000,
+                            max_backoff=None)
+            txn.set_controllers(inactivity_probe=30000, max_backoff=16000)
+            txn.commit()
+        manager, = self.server.rows('Manager')
+        self.assertEqual(manager['inactivity_probe'], 30000)
+        self.assertNotIn('max_backoff', manager)
+        controller, = self.server.rows('Controller')
+        self.assertEqual(controller['inactivity_probe'], 30000)
+        self.assertEqual(controller['max_backoff'], 16000)
+        # The settings go with the manager target, and the second commit
+        # only reads
+        transactions = self.server.transactions()
+        self.assertEqual(len(transactions), 3)
+        self.assertEqual(set(op['op'] for op in transactions[-1][1:]),
+                         set(['select']))
+        # A new manager gets the settings again
+        ovs.Transaction().set_manager('tcp:odl-controller2:6640',
+                                      inactivity_probe=30000).commit()
+        manager, = self.server.rows('Manager')
+        self.assertEqual(manager['inactivity_probe'], 30000)
+        ovs.Transaction().set_controllers(max_backoff=None).commit()
+        controller, = self.server.rows('Controller')
+        self.assertEqual(controller['max_backoff'], [])
+        self.assertEqual(len(self.server.tables['Bridge'][bridge][
+            'controller']), 1)
+
+    def test_remove_controllers(self):
+        for i in range(3):
+            self.server.add_bridge('br-{}'.format(i),
+                                   controllers=['tcp:10.0.0.1:6653'])
+        self.server.add_bridge('br-ex')
+        ovs.set_manager('tcp:odl-controller:6640')
+        del self.server.requests[:]
+        removed = ovs.remove_controllers()
+        self.assertEqual(removed, {
+            'managers': ['tcp:odl-controller:6640'],
+            'controllers': dict(('br-{}'.format(i), ['tcp:10.0.0.1:6653'])
+                                for i in range(3)),
+        })
+        # One read and one write
+        self.assertEqual(len(self.server.transactions()), 2)
+        self.assertEqual(self.server.rows('Controller'), [])
+        self.assertEqual(self.server.rows('Manager'), [])
+        self.assertEqual(len(self.server.rows('Bridge')), 4)
+
+    @patch.object(ovs, 'subprocess')
+    def test_remove_controllers_fallback(self, subprocess):
+        self.server.stop()
+        subprocess.check_output.return_value = (
+            '{"data":[["br-int",["uuid","c1"]],["br-ex",["set",[]]]],'
+            '"headings":["name","controller"]}\n'
+            '{"data":[[["uuid","c1"],"tcp:10.0.0.1:6653"]],'
+            '"headings":["_uuid","target"]}\n'
+            '{"data":[],"headings":["target"]}\n')
+        removed = ovs.remove_controllers()
+        self.assertEqual(removed, {
+            'managers': [],
+            'controllers': {'br-int': ['tcp:10.0.0.1:6653']},
+        })
+        subprocess.check_call.assert_called_once_with([
+            'ovs-vsctl', '--', 'del-controller', 'br-int'])
+
+    def test_wait_for_managers(self):
+        ovs.set_manager('tcp:odl-controller:6640')
+        manager = list(self.server.tables['Manager'])[0]
+        managers, waited = ovs.wait_for_managers(0.1)
+        self.assertIsNone(waited)
+        self.assertFalse(ovs.update_manager_stats(managers,
+                                                  waited)['connected'])
+        timer = threading.Timer(0.1, self.server.update_row, (
+            'Manager', manager), {'is_connected': True,
+                                  'status': {'sec_since_connect': '0'}})
+        timer.start()
+        self.addCleanup(timer.cancel)
+        managers, waited = ovs.wait_for_managers(5)
+        self.assertTrue(0 < waited < 5)
+        stats = ovs.update_manager_stats(managers, waited)
+        self.assertTrue(stats['connected'])
+        self.assertEqual(stats['reconnects'], 0)
+        self.assertIsNotNone(stats['time-to-connect'])
+        # Already connected
+        managers, waited = ovs.wait_for_managers(5)
+        self.assertEqual(waited, 0)
+        self.assertEqual(ovs.update_manager_stats(managers,
+                                                  waited)['reconnects'], 0)
+        # A younger connection to the same manager is a reconnect
+        with patch.object(ovs.time, 'time',
+                          return_value=time.time() + 60):
+            stats = ovs.update_manager_stats(managers, 0)
+        self.assertEqual(stats['reconnects'], 1)
+        self.assertEqual(ovs.manager_metrics(stats), [
+            'manager-connected=1', 'manager-reconnects=1',
+            'manager-connect-time={}'.format(stats['time-to-connect'])])
+        # The monitor was cancelled each time
+        self.assertEqual(self.server.monitors, [])
+
+    @patch.object(ovs, 'subprocess')
+    @patch.object(ovs.time, 'sleep')
+    def test_wait_for_managers_fallback(self, sleep, subprocess):
+        self.server.stop()
+        subprocess.check_output.side_effect = [
+            '{"data":[["tcp:odl:6640",false,["map",[]]]],'
+            '"headings":["target","is_connected","status"]}',
+            '{"data":[["tcp:odl:6640",true,'
+            '["map",[["sec_since_connect","0"]]]]],'
+            '"headings":["target","is_connected","status"]}',
+        ]
+        managers, waited = ovs.wait_for_managers(5)
+        self.assertEqual(managers, [{'target': 'tcp:odl:6640',
+                                     'is_connected': True,
+                                     'status': {'sec_since_connect': '0'}}])
+        self.assertIsNotNone(waited)
+        sleep.assert_called_once_with(1)
+
+
+class TestTuning(testtools.TestCase):
+
+    def test_default_tuning(self):
+        self.assertEqual(ovs.default_tuning(1), {
+            'n-handler-threads': 1, 'n-revalidator-threads': 1,
+            'flow-limit': 200000, 'max-idle': 10000,
+            'max-revalidator': 500})
+        tuning = ovs.default_tuning(48)
+        self.assertEqual(tuning['n-revalidator-threads'], 13)
+        self.assertEqual(tuning['n-handler-threads'], 35)
+        self.assertEqual(tuning['flow-limit'], 650000)
@@ -1,5 +1,6 @@
 import testtools
 
+from mock import ANY
 from mock import call
 from mock import patch
 from mock import MagicMock
@@ -8,6 +9,9 @@ import reactive.main as ovs_odl_main
 
 TO_PATCH = [
     'get_address_in_network',
+    'get_iface_from_addr',
+    'get_nic_mtu',
+    'set_nic_mtu',
     'config',
     'log',
     'status_set',
@@ -15,9 +19,14 @@ TO_PATCH = [
     'when',
     'when_not',
     'kv',
-    'subprocess',
     'ovs',
     'gethostname',
+    'hotplug',
+    'ODL',
+    'PCIDev',
+    'dpdk',
+    'apt_install',
+    'filter_installed_packages',
 ]
 
 CONN_STRING = 'tcp:odl-controller:6640'
@@ -45,7 +54,8 @@ class CharmUnitTestCase(testtools.TestCase):
 
 class MockUnitData():
 
-    data = {}
+    def __init__(self):
+        self.data = {}
 
     def set(self, k, v):
         self.data[k] = v
@@ -77,53 +87,227 @@ class TestOVSODL(CharmUnitTestCase):
         self.unitdata.unset('installed')
         odl_ovsdb = MagicMock()
         ovs_odl_main.configure_openvswitch(odl_ovsdb)
-        self.assertFalse(self.subprocess.check_call.called)
+        self.assertFalse(self.ovs.Transaction.called)
 
     def test_configure_openvswitch_installed(self):
         self.unitdata.set('installed', True)
         odl_ovsdb = MagicMock()
         odl_ovsdb.connection_string.return_value = None
         ovs_odl_main.configure_openvswitch(odl_ovsdb)
-        self.assertFalse(self.subprocess.check_call.called)
+        self.assertFalse(self.ovs.Transaction.called)
 
     def test_configure_openvswitch_installed_related(self):
         self.unitdata.set('installed', True)
         self.gethostname.return_value = 'ovs-host'
-        self.subprocess.check_output.return_value = 'local_uuid'
         self.config.return_value = None
         self.get_address_in_network.return_value = LOCALHOST
         odl_ovsdb = MagicMock()
         odl_ovsdb.connection_string.return_value = CONN_STRING
         odl_ovsdb.private_address.return_value = 'odl-controller'
+        odl_ovsdb.connection_options.return_value = {
+            'inactivity_probe': 30000, 'max_backoff': None}
+        self.ovs.wait_for_managers.return_value = ([], 1.5)
+        self.ovs.update_manager_stats.return_value = {
+            'connected': True, 'time-to-connect': 1.5, 'reconnects': 0}
         ovs_odl_main.configure_openvswitch(odl_ovsdb)
-        self.ovs.set_manager.assert_called_with(CONN_STRING)
-        self.ovs.set_config.assert_has_calls([
+        txn = self.ovs.Transaction.return_value
+        txn.set_manager.assert_called_with(CONN_STRING,
+                                           inactivity_probe=30000,
+                                           max_backoff=None)
+        odl_ovsdb.connection_options.assert_called_with(
+            inactivity_probe=None, max_backoff=None)
+        txn.set_controllers.assert_called_with(inactivity_probe=None,
+                                               max_backoff=None)
+        txn.set_config.assert_has_calls([
             call('local_ip', '10.1.1.1'),
             call('controller-ips', 'odl-controller',
                  table='external_ids'),
             call('host-id', 'ovs-host',
                  table='external_ids'),
         ])
+        txn.commit.assert_called_once_with()
         self.get_address_in_network.assert_called_with(None, '10.1.1.1')
-        self.status_set.assert_called_with('active',
-                                           'Open vSwitch configured and ready')
+        self.ovs.update_manager_stats.assert_called_with([], 1.5)
+        self.status_set.assert_called_with(
+            'active', 'Open vSwitch configured and ready '
+            '(connected in 1.5s, 0 reconnects)')
+
+    @patch.object(ovs_odl_main.multiprocessing, 'cpu_count')
+    def test_set_tuning_config(self, cpu_count):
+        cpu_count.return_value = 8
+        self.ovs.TUNING_KEYS = ('n-handler-threads', 'flow-limit')
+        self.ovs.default_tuning.return_value = {'n-handler-threads': 5,
+                                                'flow-limit': 200000}
+        self.config.side_effect = {'flow-limit': 400000}.get
+        txn = MagicMock()
+        ovs_odl_main.set_tuning_config(txn)
+        self.ovs.default_tuning.assert_called_with(8)
+        txn.set_config.assert_has_calls([
+            call('n-handler-threads', 5),
+            call('flow-limit', 400000),
+        ])
+
+    def test_configure_openvswitch_not_connected(self):
+        self.unitdata.set('installed', True)
+        self.config.return_value = None
+        self.get_address_in_network.return_value = LOCALHOST
+        odl_ovsdb = MagicMock()
+        odl_ovsdb.connection_string.return_value = CONN_STRING
+        self.ovs.wait_for_managers.return_value = ([], None)
+        self.ovs.update_manager_stats.return_value = {
+            'connected': False, 'time-to-connect': None, 'reconnects': 0}
+        ovs_odl_main.configure_openvswitch(odl_ovsdb)
+        self.status_set.assert_called_with(
+            'waiting', 'Open vSwitch configured, not connected to the ODL '
+            'OVSDB manager after 30s')
+
+    def test_configure_openvswitch_dpdk(self):
+        self.unitdata.set('installed', True)
+        test_config = {'enable-dpdk': True, 'dpdk-socket-memory': 1024,
+                       'dpdk-pmd-cores': 1}
+        self.config.side_effect = test_config.get
+        self.PCIDev.PCIInfo.return_value = {'devices': {
+            '52:54:00:aa:bb:cc': {'numa_node': 1}}}
+        self.dpdk.CONFIG_KEYS = ('dpdk-init', 'pmd-cpu-mask')
+        self.dpdk.EAL_KEYS = ('dpdk-init',)
+        self.dpdk.get_dpdk_config.return_value = {
+            'dpdk-init': 'true', 'pmd-cpu-mask': '0x2'}
+        self.dpdk.get_pmd_config.return_value = {'smc-enable': 'false'}
+        self.dpdk.CONFIG_KEYS += ('smc-enable',)
+        txn = self.ovs.Transaction.return_value
+        txn.commit.return_value = [
+            ('set', 'Open_vSwitch', '.', 'other_config', 'dpdk-init',
+             'true')]
+        self.ovs.wait_for_managers.return_value = ([], 0)
+        odl_ovsdb = MagicMock()
+        odl_ovsdb.connection_string.return_value = CONN_STRING
+        ovs_odl_main.configure_openvswitch(odl_ovsdb)
+        self.dpdk.get_dpdk_config.assert_called_with(
+            [{'numa_node': 1}], 1024, 1, self.dpdk.OVS_RUNDIR)
+        txn.set_config.assert_has_calls([
+            call('dpdk-init', 'true'),
+            call('pmd-cpu-mask', '0x2'),
+            call('smc-enable', 'false'),
+        ])
+        self.ovs.restart.assert_called_once_with()
+
+    def test_configure_openvswitch_dpdk_no_pmd_cpus(self):
+        self.unitdata.set('installed', True)
+        test_config = {'enable-dpdk': True, 'dpdk-pmd-cores': 0}
+        self.config.side_effect = test_config.get
+        self.PCIDev.PCIInfo.return_value = {'devices': {
+            '52:54:00:aa:bb:cc': {'numa_node': 0}}}
+        self.dpdk.CONFIG_KEYS = ('dpdk-init', 'pmd-cpu-mask')
+        self.ovs.wait_for_managers.return_value = ([], 0)
+        self.ovs.update_manager_stats.return_value = {
+            'connected': True, 'time-to-connect': None, 'reconnects': 0}
+        txn = self.ovs.Transaction.return_value
+        odl_ovsdb = MagicMock()
+        odl_ovsdb.connection_string.return_value = CONN_STRING
+        ovs_odl_main.configure_openvswitch(odl_ovsdb)
+        self.status_set.assert_called_with(
+            'blocked', 'Open vSwitch configured, dpdk-pmd-cores 0 is not 1 '
+            'or more')
+        # A single cpu node only has room for the non-PMD lcore
+        test_config['dpdk-pmd-cores'] = 1
+        self.dpdk.get_pmd_cpus.return_value = {0: []}
+        ovs_odl_main.configure_openvswitch(odl_ovsdb)
+        self.status_set.assert_called_with(
+            'blocked', 'Open vSwitch configured, no cpus left for PMD '
+            'threads on NUMA node 0')
+        self.assertFalse(self.dpdk.get_dpdk_config.called)
+        self.assertNotIn(call('pmd-cpu-mask', ANY),
+                         txn.set_config.call_args_list)
+        self.dpdk.get_pmd_cpus.return_value = {0: [1]}
+        self.dpdk.get_dpdk_config.return_value = {
+            'dpdk-init': 'true', 'pmd-cpu-mask': '0x2'}
+        self.dpdk.get_pmd_config.return_value = {}
+        ovs_odl_main.configure_openvswitch(odl_ovsdb)
+        self.assertIsNone(ovs_odl_main.dpdk_pmd_status())
+        txn.set_config.assert_any_call('pmd-cpu-mask', '0x2')
+
+    def test_configure_openvswitch_invalid_mac_network_map(self):
+        self.unitdata.set('installed', True)
+        self.config.side_effect = {'data-bond': 'bond0'}.get
+        self.PCIDev.MacNetworkMapError = ValueError
+        self.PCIDev.PCIInfo.side_effect = ValueError('bad mac')
+        odl_ovsdb = MagicMock()
+        odl_ovsdb.connection_string.return_value = CONN_STRING
+        ovs_odl_main.configure_openvswitch(odl_ovsdb)
+        self.status_set.assert_called_with(
+            'blocked', 'Invalid mac-network-map: bad mac')
+        self.assertFalse(self.ovs.Transaction.return_value.commit.called)
+
+    def test_configure_openvswitch_hugepages_short(self):
+        self.unitdata.set('installed', True)
+        self.unitdata.set('hugepages', {
+            'size': '2M', 'nodes': [(0, 1024, 1024), (1, 1024, 600)],
+            'mounted': True})
+        self.config.return_value = None
+        self.get_address_in_network.return_value = LOCALHOST
+        self.ovs.wait_for_managers.return_value = ([], 0)
+        self.ovs.update_manager_stats.return_value = {
+            'connected': True, 'time-to-connect': None, 'reconnects': 0}
+        odl_ovsdb = MagicMock()
+        odl_ovsdb.connection_string.return_value = CONN_STRING
+        ovs_odl_main.configure_openvswitch(odl_ovsdb)
+        self.status_set.assert_called_with(
+            'blocked', 'Open vSwitch configured, only node 1 600/1024 2M '
+            'hugepages allocated')
+        self.unitdata.set('hugepages', {
+            'size': '2M', 'nodes': [(0, 1024, 1024)], 'mounted': True})
+        ovs_odl_main.configure_openvswitch(odl_ovsdb)
+        self.status_set.assert_called_with(
+            'active', 'Open vSwitch configured and ready (0 reconnects, '
+            '1024 2M hugepages)')
+
+    def test_configure_hugepages_invalid(self):
+        self.config.side_effect = {'hugepages': 'lots',
+                                   'hugepage-size': '2M'}.get
+        self.dpdk.get_numa_nodes.return_value = [0]
+        ovs_odl_main.configure_hugepages()
+        message = self.status_set.call_args[0][1]
+        self.assertTrue(message.startswith(
+            'Invalid hugepages configuration: '), message)
+        self.assertEqual(ovs_odl_main.hugepages_status(),
+                         (False, message[0].lower() + message[1:]))
+
+    def test_configure_dpdk_packages(self):
+        self.unitdata.set('installed', True)
+        test_config = {'enable-dpdk': True}
+        self.config.side_effect = test_config.get
+        self.filter_installed_packages.side_effect = lambda pkgs: pkgs
+        ovs_odl_main.configure_dpdk_packages()
+        self.apt_install.assert_called_with(self.dpdk.PACKAGES)
+        self.dpdk.select_vswitchd.assert_called_with(True)
+        self.ovs.restart.assert_called_once_with()
+        # Nothing to do until the option changes again
+        ovs_odl_main.configure_dpdk_packages()
+        self.assertEqual(self.ovs.restart.call_count, 1)
+        test_config['enable-dpdk'] = False
+        ovs_odl_main.configure_dpdk_packages()
+        self.dpdk.select_vswitchd.assert_called_with(False)
+        self.assertEqual(self.apt_install.call_count, 1)
 
     def test_unconfigure_openvswitch_not_installed(self):
         self.unitdata.unset('installed')
         odl_ovsdb = MagicMock()
         ovs_odl_main.unconfigure_openvswitch(odl_ovsdb)
-        self.assertFalse(self.subprocess.check_call.called)
+        self.assertFalse(self.ovs.remove_controllers.called)
 
     def test_unconfigure_openvswitch_installed(self):
         self.unitdata.set('installed', True)
-        self.subprocess.check_output.return_value = 'br-int br-ex'
+        self.ovs.remove_controllers.return_value = {
+            'managers': [CONN_STRING],
+            'controllers': {'br-int': ['tcp:odl-controller:6653'],
+                            'br-ex': ['tcp:odl-controller:6653']},
+        }
         odl_ovsdb = MagicMock()
         ovs_odl_main.unconfigure_openvswitch(odl_ovsdb)
-        self.subprocess.check_call.assert_has_calls([
-            call(['ovs-vsctl', 'del-manager']),
-            call(['ovs-vsctl', 'del-controller', 'br-int']),
-            call(['ovs-vsctl', 'del-controller', 'br-ex']),
-        ])
+        self.ovs.remove_controllers.assert_called_once_with()
+        self.log.assert_called_with(
+            'Removed managers tcp:odl-controller:6640 and the controllers '
+            'of 2 bridges: br-ex, br-int')
 
     def test_configure_neutron_plugin(self):
         neutron_plugin = MagicMock()
@@ -145,5 +329,299 @@ class TestOVSODL(CharmUnitTestCase):
                         }
                     }
                 }
-            }
+            },
+            mtu=None,
+            vhost_user=None,
         )
+
+    def test_configure_neutron_plugin_mtu(self):
+        self.unitdata.set('mtu', {'interface': 'eth1', 'address': LOCALHOST,
+                                  'mtu': 9000})
+        neutron_plugin = MagicMock()
+        ovs_odl_main.configure_neutron_plugin(neutron_plugin)
+        self.assertEqual(
+            neutron_plugin.configure_plugin.call_args[1]['mtu'], 8950)
+
+    def test_configure_neutron_plugin_vhost_user(self):
+        self.config.side_effect = {
+            'enable-dpdk': True,
+            'vhost-user-socket-dir': '/var/run/openvswitch/vhost-user',
+            'vhost-user-mode': 'client'}.get
+        ovs_odl_main.configure_vhost_user()
+        self.dpdk.make_socket_dir.assert_called_with(
+            '/var/run/openvswitch/vhost-user')
+        self.assertEqual(ovs_odl_main.vhost_user_status(), (
+            True, 'vhost-user client mode in '
+            '/var/run/openvswitch/vhost-user'))
+        self.unitdata.set('hugepages', {'size': '1G', 'nodes': [],
+                                        'mounted': True})
+        neutron_plugin = MagicMock()
+        ovs_odl_main.configure_neutron_plugin(neutron_plugin)
+        vhost_user = neutron_plugin.configure_plugin.call_args[1][
+            'vhost_user']
+        self.assertEqual(vhost_user['vif_details']['vhostuser_mode'],
+                         'server')
+        self.assertEqual(vhost_user['vif_details']['vhostuser_socket'],
+                         '/var/run/openvswitch/vhost-user/vhu$PORT_ID')
+        self.assertEqual(vhost_user['flavor_extra_specs'],
+                         {'hw:mem_page_size': '1048576'})
+
+    def test_configure_vhost_user_invalid(self):
+        self.config.side_effect = {
+            'enable-dpdk': True, 'vhost-user-socket-dir': '/tmp',
+            'vhost-user-mode': 'client'}.get
+        self.dpdk.get_vhost_sock_dir.side_effect = ValueError(
+            'vhost-user socket directory /tmp is not below '
+            '/var/run/openvswitch')
+        ovs_odl_main.configure_vhost_user()
+        self.assertFalse(self.dpdk.make_socket_dir.called)
+        self.status_set.assert_called_with(
+            'blocked', 'Vhost-user socket directory /tmp is not below '
+            '/var/run/openvswitch')
+        self.assertFalse(ovs_odl_main.vhost_user_status()[0])
+        self.assertIsNone(ovs_odl_main.get_vhost_user_details())
+
+    def test_configure_mtu(self):
+        self.config.side_effect = {'mtu': 9000}.get
+        self.get_address_in_network.return_value = LOCALHOST
+        self.get_iface_from_addr.return_value = 'eth1'
+        self.get_nic_mtu.side_effect = ['1500', '9000']
+        ovs_odl_main.configure_mtu()
+        self.set_nic_mtu.assert_called_once_with('eth1', '9000')
+        self.assertEqual(self.unitdata.get('mtu'), {
+            'interface': 'eth1', 'address': LOCALHOST, 'mtu': 9000})
+        self.assertEqual(ovs_odl_main.mtu_status(),
+                         (True, 'mtu 9000 on eth1'))
+
+    def test_configure_mtu_rejected(self):
+        self.config.side_effect = {'mtu': 9000}.get
+        self.get_address_in_network.return_value = LOCALHOST
+        self.get_iface_from_addr.return_value = 'eth1'
+        self.get_nic_mtu.return_value = '1500'
+        ovs_odl_main.configure_mtu()
+        self.status_set.assert_called_with(
+            'blocked', 'Data interface eth1 has mtu 1500, not 9000')
+        self.assertFalse(ovs_odl_main.mtu_status()[0])
+        self.assertIsNone(ovs_odl_main.get_tenant_mtu())
+
+    def test_configure_mtu_invalid(self):
+        self.config.side_effect = {'mtu': 100}.get
+        ovs_odl_main.configure_mtu()
+        self.assertFalse(self.set_nic_mtu.called)
+        self.status_set.assert_called_with('blocked', 'Invalid mtu 100')
+
+    def test_configure_nic_queues(self):
+        self.config.side_effect = {'nic-channels': 8,
+                                   'nic-queue-affinity': True}.get
+        self.get_address_in_network.return_value = LOCALHOST
+        self.get_iface_from_addr.return_value = 'eth1'
+        net_devices = self.PCIDev.PCINetDevices.load.return_value
+        net_devices.tune_queues.return_value = (['channels'], [])
+        ovs_odl_main.configure_nic_queues()
+        net_devices.tune_queues.assert_called_with(
+            'eth1', channels=8, rss_queues=None, queue_cpus=True)
+        self.log.assert_called_with('Tuned channels of eth1')
+        self.assertEqual(ovs_odl_main.nic_queues_status(), None)
+        net_devices.tune_queues.return_value = ([], ['channels'])
+        ovs_odl_main.configure_nic_queues()
+        self.assertEqual(ovs_odl_main.nic_queues_status(), (
+            True, 'channels not supported by eth1'))
+
+    def test_configure_offloads(self):
+        self.config.side_effect = {'offload-profile': 'tunnel'}.get
+        self.get_address_in_network.return_value = LOCALHOST
+        self.get_iface_from_addr.return_value = 'eth1'
+        self.PCIDev.OFFLOAD_PROFILES = {'tunnel': {}}
+        pcidev = self.PCIDev.PCINetDevices.load.return_value.\
+            get_device_from_interface.return_value
+        pcidev.set_offloads.return_value = ['tx-udp_tnl-csum-segmentation']
+        ovs_odl_main.configure_offloads()
+        pcidev.set_offloads.assert_called_with('tunnel')
+        self.assertEqual(ovs_odl_main.offloads_status(), (
+            True, 'tunnel offloads on eth1 except '
+            'tx-udp_tnl-csum-segmentation'))
+
+    def test_configure_offloads_no_data_interface(self):
+        self.config.side_effect = {'offload-profile': 'tunnel'}.get
+        self.get_address_in_network.return_value = LOCALHOST
+        self.get_iface_from_addr.side_effect = Exception('not configured')
+        self.PCIDev.OFFLOAD_PROFILES = {'tunnel': {}}
+        ovs_odl_main.configure_offloads()
+        self.assertFalse(self.PCIDev.PCINetDevices.load.called)
+        self.assertEqual(ovs_odl_main.offloads_status(), None)
+
+    def test_configure_sriov_invalid(self):
+        self.config.side_effect = {'sriov-numvfs': 'eth2'}.get
+        self.PCIDev.SriovConfigError = ValueError
+        self.PCIDev.parse_sriov_numvfs.side_effect = ValueError(
+            'invalid entry eth2')
+        ovs_odl_main.configure_sriov()
+        self.status_set.assert_called_with('blocked',
+                                           'Invalid sriov-numvfs eth2')
+        self.assertFalse(self.PCIDev.PCINetDevices.load.called)
+        self.assertEqual(ovs_odl_main.sriov_status(), (
+            False, 'invalid sriov-numvfs eth2: invalid entry eth2'))
+
+    def test_configure_offloads_unknown(self):
+        self.config.side_effect = {'offload-profile': 'fast'}.get
+        self.PCIDev.OFFLOAD_PROFILES = {'tunnel': {}}
+        ovs_odl_main.configure_offloads()
+        self.status_set.assert_called_with('blocked',
+                                           'Unknown offload-profile fast')
+        self.assertFalse(ovs_odl_main.offloads_status()[0])
+
+    def test_set_bond_config(self):
+        test_config = {'data-bond': 'bond0', 'data-bond-bridge': 'br-data',
+                       'bond-mode': 'balance-tcp', 'bond-lacp': 'active',
+                       'bond-lacp-time': 'fast',
+                       'bond-rebalance-interval': 5000}
+        self.config.side_effect = test_config.get
+        pci_info = {'devices': {
+            '52:54:00:aa:bb:01': {'interface': 'eth2',
+                                  'pci_address': '0000:03:00.1'},
+            '52:54:00:aa:bb:00': {'interface': 'eth1',
+                                  'pci_address': '0000:03:00.0'},
+        }}
+        txn = MagicMock()
+        ovs_odl_main.set_bond_config(txn, pci_info)
+        txn.add_bridge.assert_called_with('br-data',
+                                          {'datapath_type': 'system'})
+        txn.add_bond.assert_called_with('br-data', 'bond0', ['eth1', 'eth2'], {
+            'bond_mode': 'balance-tcp', 'lacp': 'active',
+            'other_config': {'bond-rebalance-interval': 5000,
+                             'lacp-time': 'fast'}}, {})
+        self.assertEqual(ovs_odl_main.bond_status(), (
+            True, 'bond0 of eth1, eth2 (balance-tcp, lacp active)'))
+        # DPDK members are named after their mac
+        test_config.update({'enable-dpdk': True, 'dpdk-pmd-cores': 2,
+                            'dpdk-rx-queues': 4})
+        self.dpdk.get_port_config.return_value = {
+            '52:54:00:aa:bb:00': {'type': 'dpdk'},
+            '52:54:00:aa:bb:01': {'type': 'dpdk'}}
+        ovs_odl_main.set_bond_config(txn, pci_info)
+        self.dpdk.get_pmd_cpus.assert_called_with(ANY, 2)
+        self.dpdk.get_port_config.assert_called_with(
+            pci_info['devices'], self.dpdk.get_pmd_cpus.return_value,
+            n_rxq=4, pinned=None)
+        txn.add_bond.assert_called_with(
+            'br-data', 'bond0', ['dpdk-525400aabb00', 'dpdk-525400aabb01'],
+            ANY, {'dpdk-525400aabb00': {'type': 'dpdk'},
+                  'dpdk-525400aabb01': {'type': 'dpdk'}})
+
+    def test_set_bond_config_rename_and_clear(self):
+        test_config = {'data-bond': 'bond0', 'data-bond-bridge': 'br-data',
+                       'bond-mode': 'balance-tcp', 'bond-lacp': 'active',
+                       'bond-lacp-time': 'slow'}
+        self.config.side_effect = test_config.get
+        pci_info = {'devices': {
+            '52:54:00:aa:bb:00': {'interface': 'eth1'},
+            '52:54:00:aa:bb:01': {'interface': 'eth2'}}}
+        txn = MagicMock()
+        ovs_odl_main.set_bond_config(txn, pci_info)
+        self.assertFalse(txn.del_port.called)
+        test_config['data-bond'] = 'bond1'
+        ovs_odl_main.set_bond_config(txn, pci_info)
+        # The old bond goes first, freeing its members
+        self.assertEqual([name for name, _, _ in txn.method_calls][-3:],
+                         ['del_port', 'add_bridge', 'add_bond'])
+        txn.del_port.assert_called_once_with('br-data', 'bond0')
+        txn.reset_mock()
+        test_config['data-bond'] = None
+        ovs_odl_main.set_bond_config(txn, pci_info)
+        txn.del_port.assert_called_once_with('br-data', 'bond1')
+        self.assertEqual(ovs_odl_main.bond_status(), None)
+        txn.reset_mock()
+        ovs_odl_main.set_bond_config(txn, pci_info)
+        self.assertFalse(txn.del_port.called)
+
+    def test_set_bond_config_invalid(self):
+        test_config = {'data-bond': 'bond0', 'bond-mode': 'balance-tcp',
+                       'bond-lacp': 'active', 'bond-lacp-time': 'slow'}
+        self.config.side_effect = test_config.get
+        pci_info = {'devices': {
+            '52:54:00:aa:bb:00': {'interface': 'eth1'},
+            '52:54:00:aa:bb:01': {'interface': 'eth2'}}}
+        txn = MagicMock()
+        for option, value, error in [
+                ('bond-mode', 'balance-rr',
+                 'invalid bond-mode balance-rr, not one of balance-tcp, '
+                 'balance-slb, active-backup'),
+                ('bond-lacp', 'on',
+                 'invalid bond-lacp on, not one of active, passive, off'),
+                ('bond-lacp-time', 'medium',
+                 'invalid bond-lacp-time medium, not one of fast, slow')]:
+            ovs_odl_main.set_bond_config(txn, pci_info)
+            self.assertTrue(ovs_odl_main.bond_status()[0])
+            test_config[option], valid = value, test_config[option]
+            txn.reset_mock()
+            ovs_odl_main.set_bond_config(txn, pci_info)
+            self.assertFalse(txn.add_bond.called)
+            self.assertEqual(ovs_odl_main.bond_status(), (False, error))
+            test_config[option] = valid
+
+    def test_set_bond_config_one_nic(self):
+        self.config.side_effect = {'data-bond': 'bond0',
+                                   'bond-mode': 'balance-tcp',
+                                   'bond-lacp': 'active',
+                                   'bond-lacp-time': 'slow'}.get
+        txn = MagicMock()
+        ovs_odl_main.set_bond_config(txn, {'devices': {
+            '52:54:00:aa:bb:00': {'interface': 'eth1'}}})
+        self.assertFalse(txn.add_bond.called)
+        self.assertEqual(ovs_odl_main.bond_status(), (
+            False, 'data-bond bond0 needs 2 or more NICs from '
+            'mac-network-map, found 1'))
+
+    def test_odl_register_macs_bond(self):
+        self.gethostname.return_value = 'ovs-host'
+        self.unitdata.set('bond', {
+            'name': 'bond0', 'interfaces': ['eth1', 'eth2'],
+            'macs': ['52:54:00:aa:bb:00', '52:54:00:aa:bb:01']})
+        self.PCIDev.PCIInfo.return_value = {'local_config': {
+            '52:54:00:aa:bb:00': [{'net': 'physnet1', 'interface': 'eth1'}],
+            '52:54:00:aa:bb:cc': [{'net': 'physnet2', 'interface': 'eth3'}],
+        }}
+        self.PCIDev.parse_mac_network_map.return_value = {
+            '52:54:00:aa:bb:00': [{'net': 'physnet1'}],
+            '52:54:00:aa:bb:01': [{'net': 'physnet1'}],
+            '52:54:00:aa:bb:cc': [{'net': 'physnet2'}],
+        }
+        odl = self.ODL.ODLConfig.return_value
+        odl.get_registered_interfaces.return_value = set()
+        controller = MagicMock()
+        controller.connection.return_value = {'host': 'odl-controller'}
+        ovs_odl_main.odl_register_macs(controller)
+        odl.odl_register_macs_bulk.assert_has_calls([
+            call('ovs-host', 'physnet1', [('bond0', '52:54:00:aa:bb:00')],
+                 device_type='ovs'),
+            call('ovs-host', 'physnet2', [('eth3', '52:54:00:aa:bb:cc')],
+                 device_type='ovs'),
+        ], any_order=True)
+        self.assertEqual(odl.odl_register_macs_bulk.call_count, 2)
+
+    def test_odl_register_macs(self):
+        self.hotplug.current_generation.return_value = 3
+        self.gethostname.return_value = 'ovs-host'
+        self.config.return_value = 'mac=52:54:00:aa:bb:cc;net=physnet1'
+        self.PCIDev.PCIInfo.return_value = {
+            'local_config': {
+                '52:54:00:aa:bb:cc': [{'net': 'physnet1',
+                                       'interface': 'eth2'}],
+            },
+        }
+        odl = self.ODL.ODLConfig.return_value
+        odl.get_registered_interfaces.return_value = set()
+        controller = MagicMock()
+        controller.connection.return_value = {'host': 'odl-controller'}
+        ovs_odl_main.odl_register_macs(controller)
+        odl.odl_register_macs_bulk.assert_called_once_with(
+            'ovs-host', 'physnet1', [('eth2', '52:54:00:aa:bb:cc')],
+            device_type='ovs')
+        # Nothing has changed, so the inventory is not rescanned
+        self.PCIDev.PCIInfo.reset_mock()
+        ovs_odl_main.odl_register_macs(controller)
+        self.assertFalse(self.PCIDev.PCIInfo.called)
+        # A NIC change moves the generation and triggers a rescan
+        self.hotplug.current_generation.return_value = 4
+        ovs_odl_main.odl_register_macs(controller)
+        self.assertTrue(self.PCIDev.PCIInfo.called)
@@ -0,0 +1,664 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.append('hooks')
+import testtools
+
+from mock import patch
+
+from charmhelpers.core import hookenv
+from charmhelpers.core import unitdata
+
+import lib.PCIDev as PCIDev
+import lib.dpdk as dpdk
+from unit_tests.fake_sysfs import FakeHost
+
+
+class TestPCIDev(testtools.TestCase):
+
+    def setUp(self):
+        super(TestPCIDev, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        self.host = FakeHost(self.root)
+        self.kv = unitdata.Storage(os.path.join(self.root, 'unit-state.db'))
+        for attr, value in [
+                ('SYSFS_ROOT', self.host.sys),
+                ('MODULES_ROOT', os.path.join(self.root, 'lib', 'modules')),
+                ('VPE_CLI', os.path.join(self.host.bin, 'confd_cli')),
+                ('kv', lambda: self.kv),
+                ('config', self.config)]:
+            _p = patch.object(PCIDev, attr, value)
+            _p.start()
+            self.addCleanup(_p.stop)
+        _p = patch.dict(os.environ, {
+            'PATH': '{}:{}'.format(self.host.bin, os.environ['PATH'])})
+        _p.start()
+        self.addCleanup(_p.stop)
+        self.mac_network_map = None
+        _p = patch.dict(PCIDev._mac_network_map_cache, clear=True)
+        _p.start()
+        self.addCleanup(_p.stop)
+
+    def config(self, key):
+        return {'mac-network-map': self.mac_network_map,
+                'pci-probe-workers': 1}[key]
+
+    def test_inventory(self):
+        pf = self.host.add_nic(numa_node=1, local_cpulist='8-15',
+                               totalvfs=8, numvfs=2, vf_vlan=100)
+        virtio = self.host.add_nic(driver='virtio-pci', state='up')
+        vpe = self.host.add_nic(driver='igb_uio')
+        self.host.finish()
+        net_devices = PCIDev.PCINetDevices()
+        self.assertEqual(len(net_devices.pci_devices), 5)
+
+        pf_dev = net_devices.get_device_from_pci_address(pf)
+        self.assertEqual(pf_dev.loaded_kmod, 'ixgbe')
+        self.assertEqual(pf_dev.modalias_kmod, 'ixgbe')
+        self.assertEqual(pf_dev.interface_name, 'eth0')
+        self.assertEqual(pf_dev.numa_node, 1)
+        self.assertEqual(pf_dev.local_cpus(), list(range(8, 16)))
+        self.assertEqual(pf_dev.speed, 10000)
+        self.assertEqual(pf_dev.rx_queues, 4)
+        self.assertEqual(pf_dev.pcie_bandwidth(), 64)
+        vfs = net_devices.get_virtual_functions(pf_dev)
+        self.assertEqual([vf.vf_index for vf in vfs], [0, 1])
+        self.assertEqual([vf.vf_vlan for vf in vfs], [100, 100])
+        self.assertEqual(vfs[0].physfn, pf)
+
+        virtio_dev = net_devices.get_device_from_pci_address(virtio)
+        self.assertEqual(virtio_dev.state, 'up')
+        self.assertEqual(
+            net_devices.get_device_from_mac(virtio_dev.mac_address.upper()),
+            virtio_dev)
+
+        vpe_dev = net_devices.get_device_from_pci_address(vpe)
+        self.assertEqual(vpe_dev.state, 'vpebound')
+        self.assertEqual(vpe_dev.modalias_kmod, 'igb')
+
+    def test_vpe_table_shared(self):
+        self.host.add_nic(driver='igb_uio')
+        self.host.add_nic(driver='igb_uio')
+        self.host.finish()
+        PCIDev.PCINetDevices()
+        self.assertEqual(self.host.calls().count('confd_cli'), 1)
+
+    def test_load_cached(self):
+        pf = self.host.add_nic()
+        self.host.finish()
+        PCIDev.PCINetDevices.load()
+        self.host.reset_calls()
+        net_devices = PCIDev.PCINetDevices.load()
+        self.assertNotIn('lspci', self.host.calls())
+        self.assertEqual(
+            net_devices.get_device_from_pci_address(pf).loaded_kmod, 'ixgbe')
+        # Rebinding the device invalidates the cached inventory
+        os.unlink(os.path.join(self.host.pci_root, pf, 'driver'))
+        self.host.bind(pf, 'i40e')
+        net_devices = PCIDev.PCINetDevices.load()
+        self.assertIn('lspci', self.host.calls())
+        self.assertEqual(
+            net_devices.get_device_from_pci_address(pf).loaded_kmod, 'i40e')
+
+    def test_load_cached_refreshes_operstate(self):
+        self.host.add_nic()
+        self.host.finish()
+        PCIDev.PCINetDevices.load()
+        with open(os.path.join(self.host.sys, 'class', 'net', 'eth0',
+                               'operstate'), 'w') as f:
+            f.write('up\n')
+        self.host.reset_calls()
+        net_devices = PCIDev.PCINetDevices.load()
+        self.assertNotIn('lspci', self.host.calls())
+        self.assertEqual(net_devices.get_device_from_interface('eth0').state,
+                         'up')
+
+    def test_inventory_key(self):
+        pf = self.host.add_nic()
+        self.host.finish()
+        key = PCIDev.get_inventory_key()
+        self.assertEqual(PCIDev.get_inventory_key(), key)
+        # A new netdev, or a device hotplugged, changes it
+        os.symlink(os.path.join(self.host.sys, 'class', 'net', 'eth0'),
+                   os.path.join(self.host.sys, 'class', 'net', 'veth0'))
+        self.assertNotEqual(PCIDev.get_inventory_key(), key)
+        key = PCIDev.get_inventory_key()
+        self.host.add_nic()
+        self.assertNotEqual(PCIDev.get_inventory_key(), key)
+        key = PCIDev.get_inventory_key()
+        # So does an unbound driver
+        os.unlink(os.path.join(self.host.pci_root, pf, 'driver'))
+        self.assertNotEqual(PCIDev.get_inventory_key(), key)
+
+    def test_partial_inventory_not_saved(self):
+        pf = self.host.add_nic()
+        self.host.add_nic()
+        self.host.finish()
+        PCIDev.PCINetDevices(pci_addresses=[pf]).save()
+        self.assertIsNone(self.kv.get(PCIDev.INVENTORY_KEY))
+        PCIDev.PCINetDevices().save()
+        self.assertEqual(
+            len(self.kv.get(PCIDev.INVENTORY_KEY)['devices']), 2)
+
+    def test_device_slots(self):
+        pf = self.host.add_nic()
+        self.host.finish()
+        pcidev = PCIDev.PCINetDevices().get_device_from_pci_address(pf)
+        self.assertFalse(hasattr(pcidev, '__dict__'))
+        self.assertRaises(AttributeError, setattr, pcidev, 'bogus', 1)
+
+    def test_device_indexes(self):
+        pf = self.host.add_nic()
+        self.host.finish()
+        net_devices = PCIDev.PCINetDevices()
+        pcidev = net_devices.get_device_from_pci_address(pf)
+        mac = pcidev.mac_address
+        self.assertIs(net_devices.get_device_from_mac(mac), pcidev)
+        self.assertIs(
+            net_devices.get_device_from_mac(mac.upper().replace(':', '-')),
+            pcidev)
+        self.assertIsNone(net_devices.get_device_from_mac(
+            '00:00:00:00:00:01'))
+        self.assertIsNone(
+            net_devices.get_device_from_pci_address('0000:ff:00.0'))
+        # Lookups follow the device list once reindexed
+        net_devices.pci_devices.remove(pcidev)
+        net_devices.reindex()
+        self.assertIsNone(net_devices.get_device_from_mac(mac))
+        self.assertIsNone(net_devices.get_device_from_pci_address(pf))
+
+    def test_devices_round_trip(self):
+        pf = self.host.add_nic(totalvfs=4, numvfs=2)
+        self.host.finish()
+        net_devices = PCIDev.PCINetDevices()
+        devices = [pcidev.to_dict() for pcidev in net_devices.pci_devices]
+        self.host.reset_calls()
+        restored = PCIDev.PCINetDevices(devices=devices)
+        self.assertEqual(self.host.calls(), [])
+        self.assertEqual(
+            [pcidev.to_dict() for pcidev in restored.pci_devices], devices)
+        pcidev = restored.get_device_from_pci_address(pf)
+        self.assertIs(restored.get_device_from_mac(pcidev.mac_address),
+                      pcidev)
+        self.assertEqual(len(restored.get_virtual_functions(pcidev)), 2)
+
+    def test_placement_info(self):
+        pf = self.host.add_nic(speed=25000, numa_node=1,
+                               local_cpulist='8-15')
+        local = self.host.add_nic(numa_node=-1)
+        self.host.finish()
+        net_devices = PCIDev.PCINetDevices()
+        pcidev = net_devices.get_device_from_pci_address(pf)
+        self.assertEqual(pcidev.numa_node, 1)
+        self.assertEqual(pcidev.local_cpulist, '8-15')
+        self.assertEqual(pcidev.local_cpus(), list(range(8, 16)))
+        self.assertEqual(pcidev.speed, 25000)
+        self.assertEqual(pcidev.duplex, 'full')
+        self.assertEqual((pcidev.rx_queues, pcidev.tx_queues), (4, 4))
+        self.assertEqual(pcidev.pcie_bandwidth(), 64.0)
+        # Platforms without locality report -1
+        self.assertIsNone(
+            net_devices.get_device_from_pci_address(local).numa_node)
+
+    def test_rank_devices(self):
+        slow_local = self.host.add_nic(speed=1000, numa_node=0)
+        fast_remote = self.host.add_nic(speed=40000, numa_node=1)
+        down = self.host.add_nic(speed=-1, numa_node=0)
+        self.host.finish()
+        net_devices = PCIDev.PCINetDevices()
+        devices = [net_devices.get_device_from_pci_address(addr)
+                   for addr in (down, slow_local, fast_remote)]
+
+        def ranked(numa_node=None):
+            return [pcidev.pci_address for pcidev in
+                    net_devices.rank_devices(devices, numa_node)]
+
+        self.assertEqual(ranked(), [fast_remote, slow_local, down])
+        self.assertEqual(ranked(0), [slow_local, down, fast_remote])
+        self.assertEqual(ranked(1), [fast_remote, slow_local, down])
+        self.assertEqual(
+            net_devices.get_preferred_interface(['eth0', 'eth1'], 0), 'eth0')
+        self.assertEqual(
+            net_devices.get_preferred_interface(['eth0', 'eth1']), 'eth1')
+        # Unknown interfaces fall back to a stable choice
+        self.assertEqual(
+            net_devices.get_preferred_interface(['ethb', 'etha']), 'etha')
+        self.assertIsNone(net_devices.get_preferred_interface([]))
+
+    def test_probe_workers_from_config(self):
+        self.host.add_nic()
+        self.host.add_nic()
+        self.host.finish()
+        warmed = []
+        probe_map = PCIDev.probe_map
+
+        def checked_probe_map(func, items, workers=1):
+            warmed.append((workers, sorted(hookenv.cache)))
+            return probe_map(func, items, workers)
+
+        self.config = lambda key: {'pci-probe-workers': 4}[key]
+        with patch.object(PCIDev, 'config', self.config), \
+                patch.object(PCIDev, 'probe_map', checked_probe_map):
+            net_devices = PCIDev.PCINetDevices.load()
+        self.assertEqual(net_devices.workers, 4)
+        workers, cache = warmed[0]
+        self.assertEqual(workers, 4)
+        # The per device probes find the shared caches already filled
+        self.assertTrue(any('get_pci_aliases' in key for key in cache))
+        self.assertTrue(any('get_kernel_name' in key for key in cache))
+
+    def test_vpe_cli_failure_queried_once(self):
+        vpe = [self.host.add_nic(driver='igb_uio') for _ in range(3)]
+        self.host.finish()
+        error = subprocess.CalledProcessError(1, ['confd_cli'])
+        with patch.object(PCIDev, 'get_vpe_interfaces_and_macs',
+                          side_effect=error) as query:
+            net_devices = PCIDev.PCINetDevices()
+            self.assertEqual(query.call_count, 1)
+            self.assertEqual(sorted(net_devices.probe_errors), vpe)
+            # A new pass tries the CLI again
+            net_devices.rescan()
+            self.assertEqual(query.call_count, 2)
+
+    def test_pciinfo_lazy(self):
+        self.host.add_nic()
+        pf = self.host.add_nic(numa_node=1)
+        self.host.finish()
+        mac = PCIDev.get_sysnet_pci_addresses_by_mac()
+        mac = dict((v, k) for k, v in mac.items())[pf]
+        self.mac_network_map = 'mac={};net=physnet1;vlan=10'.format(mac)
+        pci_info = PCIDev.PCIInfo()
+        self.assertEqual(pci_info['local_config'], {
+            mac: [{'net': 'physnet1', 'vlan': 10, 'physnet': None,
+                   'interface': 'eth1'}],
+        })
+        self.assertEqual(pci_info['devices'][mac]['numa_node'], 1)
+        self.assertEqual(pci_info['pci_devs'], 'dev {}'.format(pf))
+        # Only the requested device was probed
+        self.assertEqual(self.host.calls().count('lspci'), 2)
+
+    def test_pciinfo_lazy_not_saved(self):
+        self.host.add_nic()
+        pf = self.host.add_nic()
+        self.host.finish()
+        macs = dict((v, k) for k, v in
+                    PCIDev.get_sysnet_pci_addresses_by_mac().items())
+        self.mac_network_map = 'mac={};net=physnet1'.format(macs[pf])
+        PCIDev.PCIInfo()
+        self.assertIsNone(self.kv.get(PCIDev.INVENTORY_KEY))
+        # A later full load still finds every device
+        self.assertEqual(len(PCIDev.PCINetDevices.load().pci_devices), 2)
+
+    def test_pciinfo_lazy_falls_back_to_full_scan(self):
+        self.host.add_nic()
+        vpe = self.host.add_nic(driver='igb_uio')
+        self.host.finish()
+        mac = self.host.vpe_interfaces[0][1]
+        self.mac_network_map = 'mac={};net=physnet1'.format(mac)
+        pci_info = PCIDev.PCIInfo()
+        # The VPE bound device has no netdev so needs the full scan
+        self.assertEqual(pci_info['pci_devs'], 'dev {}'.format(vpe))
+        self.assertEqual(
+            len(self.kv.get(PCIDev.INVENTORY_KEY)['devices']), 2)
+
+    def test_pciinfo_not_lazy(self):
+        self.host.add_nic()
+        pf = self.host.add_nic()
+        self.host.finish()
+        macs = dict((v, k) for k, v in
+                    PCIDev.get_sysnet_pci_addresses_by_mac().items())
+        self.mac_network_map = 'mac={};net=physnet1'.format(macs[pf])
+        pci_info = PCIDev.PCIInfo(lazy=False)
+        self.assertEqual(sorted(pci_info['local_macs']), sorted(macs.values()))
+        self.assertEqual(
+            len(self.kv.get(PCIDev.INVENTORY_KEY)['devices']), 2)
+
+    def test_pciinfo_devices_up_and_userspace_bound(self):
+        up = self.host.add_nic(state='up')
+        bound = self.host.add_nic(numa_node=1)
+        self.host.finish()
+        macs = dict((v, k) for k, v in
+                    PCIDev.get_sysnet_pci_addresses_by_mac().items())
+        self.mac_network_map = ' '.join(
+            'mac={};net=physnet1'.format(macs[addr]) for addr in (up, bound))
+        pci_info = PCIDev.PCIInfo()
+        self.assertEqual(sorted(pci_info['devices']),
+                         sorted([macs[up], macs[bound]]))
+        # Only NICs that are down are offered for registration
+        self.assertEqual(list(pci_info['local_config']), [macs[bound]])
+        self.host.bind_userspace(bound)
+        pci_info = PCIDev.PCIInfo()
+        device = pci_info['devices'][macs[bound]]
+        self.assertEqual(device['pci_address'], bound)
+        self.assertEqual(device['numa_node'], 1)
+        self.assertEqual(device['interface'], None)
+
+    def test_pciinfo_numa_placement_after_dpdk_bind(self):
+        self.host.add_numa_node(0, '0-3')
+        self.host.add_numa_node(1, '4-7')
+        pf = self.host.add_nic(numa_node=1, local_cpulist='4-7')
+        self.host.finish()
+        mac = dict((v, k) for k, v in
+                   PCIDev.get_sysnet_pci_addresses_by_mac().items())[pf]
+        self.mac_network_map = 'mac={};net=physnet1'.format(mac)
+        before = dpdk.get_dpdk_config(
+            PCIDev.PCIInfo()['devices'].values(), 1024, 1)
+        self.host.bind_userspace(pf)
+        after = dpdk.get_dpdk_config(
+            PCIDev.PCIInfo()['devices'].values(), 1024, 1)
+        self.assertEqual(before['dpdk-socket-mem'], '0,1024')
+        self.assertEqual(after, before)
+
+    def test_pciinfo_offloads_ethtool_fails(self):
+        pf = self.host.add_nic()
+        self.host.finish()
+        mac = dict((v, k) for k, v in
+                   PCIDev.get_sysnet_pci_addresses_by_mac().items())[pf]
+        self.mac_network_map = 'mac={};net=physnet1'.format(mac)
+        with open(os.path.join(self.host.bin, 'ethtool'), 'w') as f:
+            f.write('#!/bin/sh\nexit 1\n')
+        devices = PCIDev.PCIInfo()['devices']
+        self.assertEqual(devices[mac]['offloads'], [])
+
+    def sriov_numvfs(self, pci_addr):
+        with open(os.path.join(self.host.pci_root, pci_addr,
+                               'sriov_numvfs')) as f:
+            return f.read().strip()
+
+    def test_set_sriov_numvfs(self):
+        pf = self.host.add_nic(totalvfs=8, numvfs=2)
+        self.host.finish()
+        pf_dev = PCIDev.PCINetDevices().get_device_from_pci_address(pf)
+        # Capped at the VFs the PF supports
+        self.assertTrue(pf_dev.set_sriov_numvfs(16))
+        self.assertEqual(self.sriov_numvfs(pf), '8')
+        self.assertEqual(pf_dev.sriov_numvfs, 8)
+        self.assertFalse(pf_dev.set_sriov_numvfs(8))
+
+    def test_configure_sriov(self):
+        first = self.host.add_nic(totalvfs=4)
+        second = self.host.add_nic(totalvfs=8)
+        self.host.finish()
+        net_devices = PCIDev.PCINetDevices()
+        self.assertTrue(net_devices.configure_sriov('eth0:2'))
+        self.assertEqual(self.sriov_numvfs(first), '2')
+        self.assertEqual(self.sriov_numvfs(second), '0')
+        self.assertFalse(net_devices.configure_sriov('eth0:2'))
+        self.assertTrue(net_devices.configure_sriov('auto'))
+        self.assertEqual(self.sriov_numvfs(first), '4')
+        self.assertEqual(self.sriov_numvfs(second), '8')
+
+    def test_configure_sriov_in_use(self):
+        up = self.host.add_nic(state='up', totalvfs=4)
+        busy = self.host.add_nic(totalvfs=4, numvfs=2)
+        self.host.finish()
+        # eth0 is up; eth1 has VFs eth2 and eth3
+        pf = PCIDev.PCINetDevices().get_device_from_pci_address(busy)
+        self.host.bind_userspace(pf.virtfns[0])
+        net_devices = PCIDev.PCINetDevices()
+        self.assertFalse(net_devices.configure_sriov('auto'))
+        self.assertEqual(self.sriov_numvfs(up), '0')
+        self.assertEqual(self.sriov_numvfs(busy), '2')
+        self.assertFalse(net_devices.configure_sriov('eth1:4'))
+        self.assertEqual(self.sriov_numvfs(busy), '2')
+        # Named explicitly, a PF which is up is resized
+        self.assertTrue(net_devices.configure_sriov('eth0:2'))
+        self.assertEqual(self.sriov_numvfs(up), '2')
+
+    def test_parse_sriov_numvfs(self):
+        self.assertEqual(PCIDev.parse_sriov_numvfs('auto'), None)
+        self.assertEqual(PCIDev.parse_sriov_numvfs('eth0:2 ens3f1:16'),
+                         {'eth0': 2, 'ens3f1': 16})
+        for numvfs in ['eth2', 'eth2:x', ':4', 'eth2:-1']:
+            self.assertRaises(PCIDev.SriovConfigError,
+                              PCIDev.parse_sriov_numvfs, numvfs)
+
+    def test_vf_link_re(self):
+        ip_output = (
+            '4: eth0: <BROADCAST,MULTICAST> mtu 1500 state DOWN\n'
+            '    link/ether 52:54:00:00:00:00 brd ff:ff:ff:ff:ff:ff\n'
+            '    vf 0 MAC 52:54:00:00:00:01, vlan 100, spoof checking on\n'
+            '    vf 1     link/ether 00:00:00:00:00:00 brd '
+            'ff:ff:ff:ff:ff:ff, spoof checking on, link-state auto\n')
+        self.assertEqual(
+            [match.groups() for match in
+             PCIDev.VF_LINK_RE.finditer(ip_output)],
+            [('0', '52:54:00:00:00:01', '100'),
+             ('1', PCIDev.NULL_MAC, None)])
+
+    def test_parse_mac_network_map_invalid(self):
+        for mac_map in ['mac=52:54:00:aa:bb;net=physnet1',
+                        'mac=52:54:00:aa:bb:cc',
+                        'mac=52:54:00:aa:bb:cc;net=physnet1;vlan=4095',
+                        'mac=52:54:00:aa:bb:cc;net=physnet1;port=1',
+                        'mac=52:54:00:aa:bb:cc;net=physnet1;vlan=10 '
+                        'mac=52:54:00:AA:BB:CC;net=physnet1;vlan=20']:
+            self.assertRaises(PCIDev.MacNetworkMapError,
+                              PCIDev.parse_mac_network_map, mac_map)
+
+    def test_parse_mac_network_map(self):
+        self.assertEqual(PCIDev.parse_mac_network_map(None), {})
+        mac_map = ('mac=52-54-00-AA-BB-CC;net=physnet1;vlan=10 '
+                   'mac=52:54:00:aa:bb:cc;net=physnet1;vlan=10 '
+                   'mac=52:54:00:aa:bb:cc;net=physnet2;physnet=data')
+        with patch.object(PCIDev, 'log') as log:
+            self.assertEqual(PCIDev.parse_mac_network_map(mac_map), {
+                '52:54:00:aa:bb:cc': [
+                    {'net': 'physnet1', 'vlan': 10, 'physnet': None},
+                    {'net': 'physnet2', 'vlan': None, 'physnet': 'data'},
+                ],
+            })
+            self.assertEqual(log.call_count, 1)
+        # The same value is only parsed once
+        with patch.object(PCIDev, '_parse_mac_network_map_str') as parse:
+            self.assertIs(PCIDev.parse_mac_network_map(mac_map),
+                          PCIDev.parse_mac_network_map(mac_map))
+            self.assertFalse(parse.called)
+
+    def test_parse_mac_network_map_conflicts(self):
+        for mac_map in [
+                # One net on two vlans
+                'mac=52:54:00:aa:bb:cc;net=physnet1;vlan=10 '
+                'mac=52:54:00:aa:bb:cc;net=physnet1;vlan=20',
+                # One vlan on two nets
+                'mac=52:54:00:aa:bb:cc;net=physnet1;vlan=10 '
+                'mac=52:54:00:aa:bb:cc;net=physnet2;vlan=10']:
+            self.assertRaises(PCIDev.MacNetworkMapError,
+                              PCIDev.parse_mac_network_map, mac_map)
+        # Conflicts are per mac
+        self.assertEqual(len(PCIDev.parse_mac_network_map(
+            'mac=52:54:00:aa:bb:cc;net=physnet1;vlan=10 '
+            'mac=52:54:00:aa:bb:cd;net=physnet1;vlan=10')), 2)
+
+    def test_parse_mac_network_map_file(self):
+        path = os.path.join(self.root, 'map.yaml')
+        with open(path, 'w') as f:
+            f.write('"52:54:00:AA:BB:CC":\n'
+                    '  - net: physnet1\n'
+                    '    vlan: 10\n'
+                    '  - net: physnet2\n')
+        self.assertEqual(PCIDev.parse_mac_network_map(path), {
+            '52:54:00:aa:bb:cc': [
+                {'net': 'physnet1', 'vlan': 10, 'physnet': None},
+                {'net': 'physnet2', 'vlan': None, 'physnet': None},
+            ],
+        })
+
+    def test_parse_mac_network_map_file_invalid_vlan(self):
+        path = os.path.join(self.root, 'map.yaml')
+        for vlan in ['[10, 20]', '{id: 10}', 'true', '10.5', '0']:
+            with open(path, 'w') as f:
+                f.write('- mac: "52:54:00:aa:bb:cc"\n'
+                        '  net: physnet1\n'
+                        '  vlan: {}\n'.format(vlan))
+            PCIDev._mac_network_map_cache.clear()
+            self.assertRaises(PCIDev.MacNetworkMapError,
+                              PCIDev.parse_mac_network_map,
+                              'file://' + path)
+        with open(path, 'w') as f:
+            f.write('- mac: "52:54:00:aa:bb:cc"\n'
+                    '  net: physnet1\n'
+                    '  vlan: "10"\n')
+        self.assertEqual(
+            PCIDev.parse_mac_network_map('file://' + path),
+            {'52:54:00:aa:bb:cc': [
+                {'net': 'physnet1', 'vlan': 10, 'physnet': None}]})
+
+    def test_parallel_probe(self):
+        for numa_node in range(4):
+            self.host.add_nic(numa_node=numa_node, totalvfs=4, numvfs=2)
+        self.host.add_nic(driver='igb_uio')
+        self.host.add_nic(driver='igb_uio')
+        self.host.finish()
+        serial = PCIDev.PCINetDevices()
+        self.host.reset_calls()
+        parallel = PCIDev.PCINetDevices(workers=4)
+        self.assertEqual([pcidev.to_dict() for pcidev in serial.pci_devices],
+                         [pcidev.to_dict()
+                          for pcidev in parallel.pci_devices])
+        self.assertEqual(self.host.calls().count('confd_cli'), 1)
+
+    def test_probe_error_isolated(self):
+        good = self.host.add_nic()
+        bad = self.host.add_nic()
+        self.host.finish()
+        update_loaded_kmod = PCIDev.PCINetDevice.update_loaded_kmod
+
+        def failing_update_loaded_kmod(pcidev):
+            if pcidev.pci_address == bad:
+                raise OSError('lspci failed')
+            update_loaded_kmod(pcidev)
+
+        with patch.object(PCIDev.PCINetDevice, 'update_loaded_kmod',
+                          failing_update_loaded_kmod):
+            net_devices = PCIDev.PCINetDevices(workers=2)
+        self.assertEqual([pcidev.pci_address
+                          for pcidev in net_devices.pci_devices], [good])
+        self.assertIn(bad, net_devices.probe_errors)
+        net_devices.save()
+        self.assertIsNone(self.kv.get(PCIDev.INVENTORY_KEY))
+
+    def read_queue_masks(self, ifname, kind, name):
+        queues = os.path.join(self.host.sys, 'class', 'net', ifname, 'queues')
+        return dict((queue, PCIDev.read_sysfs(
+            os.path.join(queues, queue, name)))
+            for queue in sorted(os.listdir(queues))
+            if queue.startswith(kind))
+
+    def test_tune_queues(self):
+        self.host.add_nic(numa_node=1, local_cpulist='8-11,40-43')
+        self.host.finish()
+        net_devices = PCIDev.PCINetDevices()
+        tuning = {'channels': 8, 'rss_queues': 4, 'queue_cpus': True}
+        self.assertEqual(net_devices.tune_queues('eth0', **tuning),
+                         (['channels', 'rss', 'queue cpus'], []))
+        pcidev = net_devices.get_device_from_interface('eth0')
+        self.assertEqual((pcidev.rx_queues, pcidev.tx_queues), (8, 8))
+        self.assertEqual(set(self.read_queue_masks(
+            'eth0', 'rx', 'rps_cpus').values()),
+            set(['00000f00,00000f00']))
+        self.assertEqual(self.read_queue_masks('eth0', 'tx', 'xps_cpus')[
+            'tx-5'], '00000200,00000000')
+        # Applying the same tuning again changes nothing
+        self.host.reset_calls()
+        self.assertEqual(net_devices.tune_queues('eth0', **tuning),
+                         ([], []))
+        self.assertEqual(self.host.calls(), ['ethtool'] * 3)
+        self.assertIsNone(net_devices.tune_queues('eth9', **tuning))
+
+    def test_rss_queues_capped_at_channels(self):
+        self.host.add_nic(queues=4)
+        self.host.finish()
+        pcidev = PCIDev.PCINetDevices().get_device_from_interface('eth0')
+        self.assertTrue(pcidev.set_rss_queues(2))
+        self.assertEqual(PCIDev.parse_ethtool_rss(subprocess.check_output(
+            ['ethtool', '-x', 'eth0']))[:4], [0, 1, 0, 1])
+        # Only 4 channels are active, so RSS spreads over those
+        self.assertTrue(pcidev.set_rss_queues(8))
+        self.assertEqual(PCIDev.parse_ethtool_rss(subprocess.check_output(
+            ['ethtool', '-x', 'eth0']))[:8], [0, 1, 2, 3, 0, 1, 2, 3])
+        self.assertFalse(pcidev.set_rss_queues(8))
+
+    def test_tune_queues_unsupported(self):
+        self.host.add_nic()
+        self.host.finish()
+        with open(os.path.join(self.host.bin, 'ethtool'), 'w') as f:
+            f.write('#!/bin/sh\nexit 1\n')
+        net_devices = PCIDev.PCINetDevices()
+        self.assertEqual(
+            net_devices.tune_queues('eth0', channels=8, rss_queues=4,
+                                    queue_cpus=True),
+            (['queue cpus'], ['channels', 'rss']))
+
+    def test_retune_after_rebind(self):
+        pf = self.host.add_nic()
+        self.host.finish()
+        net_devices = PCIDev.PCINetDevices()
+        net_devices.tune_queues('eth0', queue_cpus=True)
+        # The driver resets the queue masks when the device is rebound
+        mask = os.path.join(self.host.sys, 'class', 'net', 'eth0', 'queues',
+                            'rx-0', 'rps_cpus')
+        with open(mask, 'w') as f:
+            f.write('00000000\n')
+        net_devices.get_device_from_pci_address(pf).loaded_kmod = None
+        net_devices.get_device_from_pci_address(pf).interface_name = None
+        net_devices.get_device_from_pci_address(pf).mac_address = None
+        with patch.object(PCIDev.PCINetDevice, 'pci_rescan'):
+            net_devices.bind_orphans()
+        self.assertEqual(PCIDev.read_sysfs(mask), '000000ff')
+
+    def test_cpus_to_sysfs_mask(self):
+        self.assertEqual(PCIDev.cpus_to_sysfs_mask([0, 1]), '00000003')
+        self.assertEqual(PCIDev.cpus_to_sysfs_mask([32, 65]),
+                         '00000002,00000001,00000000')
+
+    def test_set_offloads(self):
+        self.host.add_nic()
+        self.host.finish()
+        net_devices = PCIDev.PCINetDevices()
+        pcidev = net_devices.get_device_from_interface('eth0')
+        self.assertIsNone(pcidev.offloads)
+        self.assertEqual(pcidev.set_offloads('tunnel'),
+                         ['tx-udp_tnl-csum-segmentation'])
+        self.assertEqual(pcidev.offloads['tx-udp_tnl-segmentation'],
+                         (True, False))
+        self.assertEqual(pcidev.offloads['large-receive-offload'],
+                         (False, False))
+        # Already applied
+        self.host.reset_calls()
+        self.assertEqual(pcidev.set_offloads('tunnel'),
+                         ['tx-udp_tnl-csum-segmentation'])
+        self.assertEqual(self.host.calls(), [])
+        self.assertEqual(pcidev.set_offloads('off'), [])
+        self.assertFalse(pcidev.offloads['generic-receive-offload'][0])
+
+    def test_set_offloads_rejected(self):
+        self.host.add_nic()
+        self.host.finish()
+        pcidev = PCIDev.PCINetDevices().get_device_from_interface('eth0')
+        pcidev.update_offload_info()
+        # The driver claims a feature it then refuses to change
+        pcidev.offloads['tx-udp_tnl-csum-segmentation'] = (False, False)
+        # ethtool fails without changing anything
+        self.assertEqual(pcidev.set_offloads('tunnel'), [
+            'large-receive-offload', 'tx-udp_tnl-csum-segmentation',
+            'tx-udp_tnl-segmentation'])
+        self.assertEqual(pcidev.offloads['tx-udp_tnl-csum-segmentation'],
+                         (False, True))
+
+    def test_pciinfo_offloads(self):
+        pf = self.host.add_nic()
+        self.host.finish()
+        mac = dict((v, k) for k, v in
+                   PCIDev.get_sysnet_pci_addresses_by_mac().items())[pf]
+        self.mac_network_map = 'mac={};net=physnet1'.format(mac)
+        offloads = PCIDev.PCIInfo()['devices'][mac]['offloads']
+        self.assertIn('tx-udp_tnl-segmentation', offloads)
+        self.assertNotIn('tx-udp_tnl-csum-segmentation', offloads)
+        self.assertIn('rx-vlan-filter', offloads)